@@ -0,0 +1,620 @@
+import jetstream
+import cluster
+import federation
+import durable
+import metrics
+import compression
+import retained
+import time
+import re
+import random
+import collections
+import sys
+import os
+import signal
+import shutil
+import tempfile
+import socket
+import tornado.ioloop
+import iostream
+
+
+class Sink(jetstream.Client):
+    def __init__(self):
+        jetstream.Client.__init__(self)
+        self.received = 0
+
+    def on_message(self, qid, message):
+        self.received += 1
+
+
+def bench_dispatch(n_messages=100000):
+    ''' dispatch cost per message as the number of subscriptions grows,
+        with the subscribers served from the route cache (hot) and resolved
+        for every message (miss, the cache holding a single route). Every
+        exact qid has one subscriber and one in ten subscriptions is a
+        regular expression, with a literal prefix, that never matches the
+        published qids. scan is what trying every regular expression on
+        each qid costs, as routing did before they were indexed.
+    '''
+    print "%10s %10s %14s %14s %14s" % ("exact", "regex", "hot usec",
+            "miss usec", "scan usec")
+    for n_exact in (10, 100, 1000, 10000):
+        n_regex = n_exact / 10
+        qids = ['/queue/%d' % i for i in xrange(n_exact)]
+        patterns = [re.compile(r'/topic/%d/.*' % i) for i in xrange(n_regex)]
+        hot = [random.choice(qids) for i in xrange(1000)]
+        row = []
+        for cache_size in (65536, 1):
+            exchange = jetstream.Exchange(route_cache_size=cache_size)
+            for qid in qids:
+                c = Sink()
+                c.connect(exchange)
+                c.subscribe(qid)
+            for pattern in patterns:
+                c = Sink()
+                c.connect(exchange)
+                c.subscribe(pattern)
+            for qid in hot:
+                exchange.dispatch(qid, 'x', True)
+            t0 = time.time()
+            for i in xrange(n_messages):
+                exchange.dispatch(hot[i % 1000], 'x', True)
+            row.append((time.time() - t0) / n_messages * 1e6)
+
+        count = min(n_messages, 2000000 / max(n_regex, 1))
+        t0 = time.time()
+        for i in xrange(count):
+            qid = hot[i % 1000]
+            for pattern in patterns:
+                pattern.match(qid)
+        row.append((time.time() - t0) / count * 1e6)
+        print "%10d %10d %14.3f %14.3f %14.3f" % ((n_exact, n_regex) +
+                tuple(row))
+
+
+def bench_topics(n_messages=20000):
+    ''' cost of resolving the subscribers of a qid, the route cache being
+        of no help, as the number of '/metrics/<host>/#' subscriptions
+        grows, made as regular expressions and as topics
+    '''
+    print "%14s %14s %14s" % ("subscriptions", "regex usec", "topic usec")
+    for n in (10, 100, 1000, 10000):
+        row = []
+        for kind in ('regex', 'topic'):
+            exchange = jetstream.Exchange(route_cache_size=1)
+            for i in xrange(n):
+                c = Sink()
+                c.connect(exchange)
+                if kind == 'regex':
+                    c.subscribe(re.compile(r'/metrics/host%d/.*' % i))
+                else:
+                    c.subscribe(jetstream.Topic('/metrics/host%d/#' % i))
+            qids = ['/metrics/host%d/cpu' % random.randrange(n)
+                    for i in xrange(1000)]
+            # fewer of them as the regular expressions get slow
+            count = min(n_messages, 2000000 / n)
+            t0 = time.time()
+            for i in xrange(count):
+                exchange.dispatch(qids[i % 1000], 'x', True)
+            row.append((time.time() - t0) / count * 1e6)
+        print "%14d %14.3f %14.3f" % (n, row[0], row[1])
+
+
+def bench_retained(n_messages=200000, n_qids=100000):
+    ''' dispatch cost of a message to one of n_qids qids without and with
+        a RetainedStore already holding all of them, then the cost of
+        subscribing to the last values of 100 of them, '/metrics/<host>/+',
+        by topic, by a regular expression having a literal prefix and by
+        one having none
+    '''
+    print "%14s %14s" % ("store", "usec/dispatch")
+    qids = ['/metrics/host%d/m%d' % (i / 100, i % 100)
+            for i in xrange(n_qids)]
+    message = 'x' * 100
+    for name, store in (('-', None), ('retained', retained.RetainedStore())):
+        exchange = jetstream.Exchange(retained=store)
+        sink = Sink()
+        sink.connect(exchange)
+        for qid in qids:
+            exchange.dispatch(qid, message, True)
+        t0 = time.time()
+        for i in xrange(n_messages):
+            exchange.dispatch(qids[i % n_qids], message, True)
+        t = time.time() - t0
+        print "%14s %14.3f" % (name, t / n_messages * 1e6)
+
+    print "%14s %14s %14s" % ("subscription", "msec", "replayed")
+    for name, subscription in (
+            ('topic', jetstream.Topic('/metrics/host42/+')),
+            ('prefix regex', re.compile(r'/metrics/host42/m\d+\Z')),
+            ('regex', re.compile(r'.*/host42/m\d+\Z'))):
+        sink = Sink()
+        sink.connect(exchange)
+        t0 = time.time()
+        sink.subscribe(subscription)
+        t = time.time() - t0
+        print "%14s %14.3f %14d" % (name, t * 1e3, sink.received)
+
+
+def bench_metrics(n_messages=200000):
+    ''' dispatch cost of a message to one in-process subscriber without
+        metrics and with latencies sampled every 64 and every message
+    '''
+    print "%14s %14s" % ("sample_every", "usec/dispatch")
+    for name, m in (('-', None), ('64', metrics.Metrics(64)),
+            ('1', metrics.Metrics(1))):
+        exchange = jetstream.Exchange(metrics=m)
+        sink = Sink()
+        sink.connect(exchange)
+        sink.subscribe('/metrics')
+        t0 = time.time()
+        for i in xrange(n_messages):
+            exchange.dispatch('/metrics', 'x', True)
+        t = time.time() - t0
+        print "%14s %14.3f" % (name, t / n_messages * 1e6)
+
+
+class BusySink(Sink):
+    def __init__(self, work):
+        Sink.__init__(self)
+        self.work = work
+
+    def on_message(self, qid, message):
+        end = time.time() + self.work
+        while time.time() < end:
+            pass
+        self.received += 1
+
+
+class QueuedBusySink(jetstream.QueuedClient, BusySink):
+    def __init__(self, ioloop, work):
+        BusySink.__init__(self, work)
+        jetstream.QueuedClient.__init__(self, ioloop)
+
+
+def bench_queued(n_messages=20000, work=50e-6):
+    ''' a local subscriber busy for work seconds per message, handling it
+        within dispatch or through a QueuedClient drained on the IOLoop,
+        while a producer sends in chunks of 1000 messages: throughput and
+        the longest the IOLoop went without running its other callbacks
+    '''
+    print "%8s %14s %14s" % ("mode", "Kmessages/s", "max stall ms")
+    for name in ('sync', 'queued'):
+        ioloop = tornado.ioloop.IOLoop()
+        exchange = jetstream.Exchange()
+        if name == 'sync':
+            sink = BusySink(work)
+        else:
+            sink = QueuedBusySink(ioloop, work)
+        sink.connect(exchange)
+        sink.subscribe('/queued')
+        state = {'sent': 0, 'last': None, 'stall': 0}
+
+        def produce():
+            for i in xrange(1000):
+                if sink.send('/queued', 'x'):
+                    sink.wait_drained(produce)
+                    state['sent'] += i + 1
+                    return
+            state['sent'] += 1000
+            if state['sent'] < n_messages:
+                ioloop.add_callback(produce)
+
+        def tick():
+            now = time.time()
+            if state['last'] is not None:
+                state['stall'] = max(state['stall'], now - state['last'])
+            state['last'] = now
+            if sink.received >= n_messages:
+                ioloop.stop()
+            else:
+                ioloop.add_callback(tick)
+        t0 = time.time()
+        ioloop.add_callback(produce)
+        ioloop.add_callback(tick)
+        ioloop.start()
+        t = time.time() - t0
+        print "%8s %14.1f %14.2f" % (name, n_messages / t / 1e3,
+                state['stall'] * 1e3)
+
+
+def bench_durable(n_messages=200000, size=100):
+    ''' unicast messages sent to a local subscriber, in memory and
+        through a DurableQueue, which logs them with group commit first
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        for name in ('memory', 'durable'):
+            ioloop = tornado.ioloop.IOLoop()
+            exchange = jetstream.Exchange()
+            queue = None
+            if name == 'durable':
+                queue = durable.DurableQueue(exchange, '/durable',
+                        os.path.join(directory, 'queue'), ioloop)
+            sink = Sink()
+            sink.connect(exchange)
+            sink.subscribe('/durable')
+            message = 'x' * size
+
+            def check():
+                if sink.received == n_messages:
+                    ioloop.stop()
+                else:
+                    ioloop.add_callback(check)
+            t0 = time.time()
+            for i in xrange(n_messages):
+                exchange.dispatch('/durable', message, False)
+            ioloop.add_callback(check)
+            ioloop.start()
+            t = time.time() - t0
+            if queue is not None:
+                queue.close()
+            print "%8s %d messages of %d bytes: %.1f Kmessages/s" % (name,
+                    n_messages, size, n_messages / t / 1e3)
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_fanout(n_messages=500):
+    ''' cost of delivering a multicast message to every subscribed
+        connection, from dispatch until the frames are written to the
+        sockets, broken down into encoding the frame, once per message,
+        queueing it on each connection, which dispatch does, and writing
+        the queues out, which the loop does. append is the cost of
+        appending a reference to a deque, the floor for queueing.
+    '''
+    print "%12s %12s %12s %12s %12s %12s" % ("subscribers", "encode usec",
+            "queue usec", "write usec", "total usec", "append usec")
+    messages = ['%100d' % i for i in xrange(n_messages)]
+    t0 = time.time()
+    for message in messages:
+        jetstream.FrameCache().message_frame('/fanout', message)
+    encode = (time.time() - t0) / n_messages * 1e6
+    for n_subscribers in (10, 100, 1000):
+        ioloop = tornado.ioloop.IOLoop()
+        exchange = jetstream.Exchange()
+        adapter = jetstream.SocketAdapter(exchange, ioloop)
+        sockets = []
+        connections = []
+        for i in xrange(n_subscribers):
+            a, b = socket.socketpair()
+            sockets.append(b)
+            c = jetstream.Connection(adapter, iostream.IOStream(a, ioloop),
+                    None)
+            c._version = jetstream.PROTOCOL_VERSION
+            c.connect(adapter)
+            c.subscribe('/fanout')
+            connections.append(c)
+        queues = [collections.deque() for c in connections]
+        frame = exchange.frames.message_frame('/fanout', messages[0])
+        t0 = time.time()
+        for message in messages:
+            for q in queues:
+                q.append(frame)
+        append = time.time() - t0
+
+        def drained():
+            if any(c._recving or c._stream.writing() for c in connections):
+                ioloop.add_callback(drained)
+            else:
+                ioloop.stop()
+        t0 = time.time()
+        for message in messages:
+            exchange.dispatch('/fanout', message, True)
+        t1 = time.time()
+        ioloop.add_callback(drained)
+        ioloop.start()
+        t2 = time.time()
+        deliveries = n_messages * n_subscribers / 1e6
+        print "%12d %12.3f %12.3f %12.3f %12.3f %12.3f" % (n_subscribers,
+                encode, ((t1 - t0) / deliveries) - encode / n_subscribers,
+                (t2 - t1) / deliveries, (t2 - t0) / deliveries,
+                append / deliveries)
+        for c in connections:
+            c._stream.close()
+        for b in sockets:
+            b.close()
+
+
+def start_broker(address, setup=None):
+    ''' fork a broker process listening on address, returns its pid.
+        setup(exchange, ioloop) runs in the broker before its loop starts.
+    '''
+    pid = os.fork()
+    if pid == 0:
+        ioloop = tornado.ioloop.IOLoop()
+        exchange = jetstream.Exchange()
+        adapter = jetstream.TcpAdapter(exchange, ioloop)
+        adapter.start(address)
+        if setup:
+            setup(exchange, ioloop)
+        try:
+            ioloop.start()
+        finally:
+            os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+
+class Consumer(jetstream.TcpClient):
+    def __init__(self, ioloop, n_messages, on_ready, qid='/bench'):
+        jetstream.TcpClient.__init__(self, ioloop)
+        self._n_messages = n_messages
+        self._on_ready = on_ready
+        self._qid = qid
+        self.received = 0
+
+    def on_connected(self):
+        self.subscribe(self._qid)
+        self.subscribe(self._qid + '/ready')
+        # our own subscriptions are active once this comes back
+        self.send(self._qid + '/ready', 'ready')
+
+    def on_message(self, qid, message):
+        if qid == self._qid + '/ready':
+            self.t0 = time.time()
+            self._on_ready()
+            return
+        self.received += 1
+        if self.received == self._n_messages:
+            self.t1 = time.time()
+            self._ioloop.stop()
+
+
+class Producer(jetstream.TcpClient):
+    def __init__(self, ioloop, n_messages, message, batch_size=None,
+            qid='/bench'):
+        jetstream.TcpClient.__init__(self, ioloop, batch_size)
+        self._left = n_messages
+        self._message = message
+        self._qid = qid
+
+    def start(self):
+        n = min(self._left, 1000)
+        self.send_many(self._qid, [self._message] * n)
+        self._left -= n
+        if self._left > 0:
+            self.add_callback(self.start)
+
+
+def bench_small_messages(n_messages=200000, size=100, batch_size=None):
+    ''' end to end throughput of small multicast messages over loopback
+        TCP through a broker running in another process.
+    '''
+    address = ('127.0.0.1', 8765)
+    pid = start_broker(address)
+    try:
+        ioloop = tornado.ioloop.IOLoop()
+        producer = Producer(ioloop, n_messages, 'x' * size, batch_size)
+        consumer = Consumer(ioloop, n_messages, producer.start)
+        producer.connect(address)
+        consumer.connect(address)
+        ioloop.start()
+        t = consumer.t1 - consumer.t0
+        print "%d messages of %d bytes in %.2fs: %.1f Kmessages/s" % (
+                n_messages, size, t, n_messages / t / 1e3)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+
+
+def bench_batched_sends():
+    ''' small-messages with producer side batching
+    '''
+    bench_small_messages(batch_size=65536)
+
+
+def _log_lines(size):
+    ''' about size bytes of JSON log records
+    '''
+    random.seed(size)
+    lines = []
+    n = 0
+    while n < size:
+        line = '{"ts": %.6f, "level": "%s", "host": "web-%02d", ' \
+                '"path": "/api/v1/items/%d", "status": %d, "ms": %d}' % (
+                1.5e9 + n, random.choice(('info', 'warn', 'error')),
+                random.randrange(40), random.randrange(100000),
+                random.choice((200, 200, 200, 404, 500)),
+                random.randrange(1000))
+        lines.append(line)
+        n += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+def bench_compression(total=64 << 20):
+    ''' throughput of JSON log payloads over loopback TCP, raw and with
+        the preferred codec negotiated by both clients, and the size of the
+        compressed payloads. Loopback is not the network this is meant for,
+        the rates only show the CPU cost.
+    '''
+    address = ('127.0.0.1', 8766)
+    pid = start_broker(address)
+    codec = compression.choose(compression.FEATURES)
+    try:
+        print "%8s %6s %12s %8s %8s" % ("size", "codec", "Kmessages/s",
+                "MB/s", "ratio")
+        for size in (1024, 65536, 1 << 20):
+            message = _log_lines(size)
+            n_messages = total / size
+            ratio = len(codec.compress(message)) * 1.0 / size
+            for features in (0, compression.FEATURES):
+                ioloop = tornado.ioloop.IOLoop()
+                producer = Producer(ioloop, n_messages, message)
+                consumer = Consumer(ioloop, n_messages, producer.start)
+                producer.request_features = consumer.request_features = \
+                        features
+                producer.connect(address)
+                consumer.connect(address)
+                ioloop.start()
+                t = consumer.t1 - consumer.t0
+                producer.close()
+                consumer.close()
+                print "%8d %6s %12.2f %8.1f %8s" % (size,
+                        codec.name if features else '-',
+                        n_messages / t / 1e3, n_messages * size / t / 1e6,
+                        "%.2f" % ratio if features else '-')
+    finally:
+        os.kill(pid, signal.SIGTERM)
+
+
+def _run_pair(address, qid, n_messages, size):
+    ''' producer and consumer of qid, returns the consumer elapsed time
+    '''
+    ioloop = tornado.ioloop.IOLoop()
+    producer = Producer(ioloop, n_messages, 'x' * size, qid=qid)
+
+    def start():
+        consumer.t0 = time.time()
+        producer.start()
+
+    def on_ready():
+        # the producer may be on another worker, give the subscription
+        # time to get there
+        ioloop.add_timeout(time.time() + 0.5, start)
+    consumer = Consumer(ioloop, n_messages, on_ready, qid)
+    producer.connect(address)
+    consumer.connect(address)
+    ioloop.start()
+    return consumer.t1 - consumer.t0
+
+
+def bench_cluster(n_messages=50000, size=100, pairs=4):
+    ''' aggregate throughput of independent producer/consumer pairs, each
+        in its own process, through a Cluster of 1, 2 and 4 workers. The
+        pairs may land on different workers, their messages then go
+        through a peer link.
+    '''
+    address = ('127.0.0.1', 8766)
+    print "%8s %8s %18s" % ("workers", "pairs", "Kmessages/s")
+    for n_workers in (1, 2, 4):
+        c = cluster.Cluster(address, n_workers)
+        c.start()
+        time.sleep(0.5)
+        try:
+            pids = []
+            r, w = os.pipe()
+            for i in xrange(pairs):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        t = _run_pair(address, '/bench/%d' % i, n_messages,
+                                size)
+                        os.write(w, '%f\n' % t)
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+            os.close(w)
+            f = os.fdopen(r)
+            times = [float(line) for line in f]
+            f.close()
+            for pid in pids:
+                os.waitpid(pid, 0)
+            print "%8d %8d %18.1f" % (n_workers, pairs,
+                    pairs * n_messages / max(times) / 1e3)
+        finally:
+            c.stop()
+
+
+def bench_federation(n_messages=200000, size=100):
+    ''' small-messages from a producer on one broker to a consumer on
+        another one, through a federation link
+    '''
+    a = ('127.0.0.1', 8767)
+    b = ('127.0.0.1', 8768)
+
+    def link_to(address):
+        return lambda exchange, ioloop: \
+                federation.Federation(exchange, ioloop).link(address)
+    pids = [start_broker(b), start_broker(a, link_to(b))]
+    try:
+        ioloop = tornado.ioloop.IOLoop()
+        producer = Producer(ioloop, n_messages, 'x' * size)
+
+        def on_ready():
+            consumer.t0 = time.time()
+            producer.start()
+
+        def on_subscribed():
+            # the subscription has to go through the link first
+            ioloop.add_timeout(time.time() + 0.5, on_ready)
+        consumer = Consumer(ioloop, n_messages, on_subscribed)
+        producer.connect(b)
+        consumer.connect(a)
+        ioloop.start()
+        t = consumer.t1 - consumer.t0
+        print "%d messages of %d bytes in %.2fs: %.1f Kmessages/s" % (
+                n_messages, size, t, n_messages / t / 1e3)
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+
+class UnicastProducer(Producer):
+    def send_many(self, qid, messages):
+        Producer.send_many(self, qid, messages, False)
+
+
+class AckConsumer(Consumer):
+    def __init__(self, ioloop, n_messages, on_ready, prefetch, qid):
+        Consumer.__init__(self, ioloop, n_messages, on_ready, qid)
+        self._prefetch = prefetch
+
+    def on_connected(self):
+        if self._prefetch is not None:
+            self.qos(self._prefetch)
+        Consumer.on_connected(self)
+
+
+def bench_acks(n_messages=100000, size=100):
+    ''' unicast throughput to a consumer acknowledging every message,
+        by prefetch window, against plain unicast
+    '''
+    address = ('127.0.0.1', 8769)
+    pid = start_broker(address)
+    try:
+        print "%10s %14s" % ("prefetch", "Kmessages/s")
+        for prefetch in (None, 1, 10, 100, 1000):
+            ioloop = tornado.ioloop.IOLoop()
+            qid = '/acks/%s' % prefetch
+            producer = UnicastProducer(ioloop, n_messages, 'x' * size,
+                    qid=qid)
+            consumer = AckConsumer(ioloop, n_messages, producer.start,
+                    prefetch, qid)
+            producer.connect(address)
+            consumer.connect(address)
+            ioloop.start()
+            t = consumer.t1 - consumer.t0
+            print "%10s %14.1f" % (prefetch if prefetch is not None else "-",
+                    n_messages / t / 1e3)
+            consumer._stream.close()
+            producer._stream.close()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+
+
+BENCHMARKS = {
+    'acks': bench_acks,
+    'dispatch': bench_dispatch,
+    'durable': bench_durable,
+    'fanout': bench_fanout,
+    'metrics': bench_metrics,
+    'topics': bench_topics,
+    'retained': bench_retained,
+    'queued': bench_queued,
+    'small-messages': bench_small_messages,
+    'batched-sends': bench_batched_sends,
+    'compression': bench_compression,
+    'cluster': bench_cluster,
+    'federation': bench_federation,
+}
+
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print "==", name
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+import os, socket, fcntl, signal, logging, errno
+import multiprocessing
+import tornado.ioloop
+import jetstream
+
+
+class PeerLink(jetstream.IpcClient):
+    ''' Link to another broker, connected as a peer (FEATURE_PEER). It
+        subscribes there to what the local clients subscribed to, as told
+        by interest, and routes the messages it gets to the local clients
+        only: multicast ones to all of them and unicast ones, flagged by the
+        other broker, to one of them.
+    '''
+
+    peer = True
+    request_features = jetstream.FEATURE_PEER
+
+    def __init__(self, ioloop, interest):
+        jetstream.IpcClient.__init__(self, ioloop)
+        self._interest = interest
+        self._local = interest.exchange
+        self._waiting_for = 0
+        # counts the connections, so that a receiver drained after a
+        # reconnection does not resume the new one
+        self._generation = 0
+        self.address = None
+
+
+    def connect(self, address):
+        self.address = address
+        jetstream.IpcClient.connect(self, address)
+
+
+    def on_connected(self):
+        if not self.features & jetstream.FEATURE_PEER:
+            logging.warning("%s does not accept peers, unicast messages "
+                    "will reach every local subscriber", self.address)
+        self._waiting_for = 0
+        self._generation += 1
+        for qid in self._interest.subscriptions():
+            self.subscribe(qid)
+
+
+    def on_disconnected(self):
+        self._interest.remove_link(self)
+
+
+    def _on_frame(self, op, flag, qid, payload):
+        if op == jetstream.OP_MESSAGE:
+            congested = self._local.dispatch(qid, payload, not flag, self)
+            if congested:
+                self._pause(congested)
+        elif op == jetstream.OP_BATCH:
+            self._dispatch_batch(payload)
+        else:
+            jetstream.IpcClient._on_frame(self, op, flag, qid, payload)
+
+
+    def _dispatch_batch(self, records):
+        congested = set()
+        i = 0
+        n = len(records)
+        while i < n:
+            qid, message, flag = records[i]
+            j = i + 1
+            while j < n and records[j][0] == qid and records[j][2] == flag:
+                j += 1
+            c = self._local.dispatch_many(qid,
+                    [r[1] for r in records[i:j]], not flag, self)
+            if c:
+                congested.update(c)
+            i = j
+        if congested:
+            self._pause(list(congested))
+
+
+    def _pause(self, congested):
+        ''' stop reading from the other broker until the local receivers
+            drained
+        '''
+        generation = self._generation
+        self._waiting_for += len(congested)
+        self._stream.pause_reading()
+        for c in congested:
+            c.wait_drained(lambda: self._on_receiver_drained(generation))
+
+
+    def _on_receiver_drained(self, generation):
+        if generation != self._generation:
+            return
+        self._waiting_for -= 1
+        if self._waiting_for == 0:
+            self._stream.resume_reading()
+
+
+
+class Interest(object):
+    ''' Observes an Exchange and counts the subscriptions of its local
+        (non peer) clients, the first subscription to a qid and the last
+        unsubscription are replicated through every connected link.
+    '''
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self._links = []
+        self._subscriptions = {} # (kind, qid string) -> [qid, count]
+        exchange.add_observer(self)
+
+
+    def add_link(self, link):
+        self._links.append(link)
+
+
+    def remove_link(self, link):
+        if link in self._links:
+            self._links.remove(link)
+
+
+    def subscriptions(self):
+        ''' the qids local clients subscribed to
+        '''
+        return [entry[0] for entry in self._subscriptions.itervalues()]
+
+
+    def on_subscribe(self, qid, client):
+        if client.peer:
+            return
+        key = _key(qid)
+        entry = self._subscriptions.get(key)
+        if entry is None:
+            entry = self._subscriptions[key] = [qid, 0]
+            for link in self._links:
+                if link.connected:
+                    link.subscribe(qid)
+        entry[1] += 1
+
+
+    def on_unsubscribe(self, qid, client):
+        if client.peer:
+            return
+        key = _key(qid)
+        entry = self._subscriptions[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._subscriptions[key]
+            for link in self._links:
+                if link.connected:
+                    link.unsubscribe(qid)
+
+
+    def on_credit(self, client):
+        pass
+
+
+def _key(qid):
+    if type(qid) == str:
+        return 'exact', qid
+    if isinstance(qid, jetstream.Topic):
+        return 'topic', qid.filter
+    return 'regex', qid.pattern
+
+
+
+class Worker(Interest):
+    ''' The broker running in one process of a Cluster: an Exchange, its
+        TcpAdapter and a PeerLink to every other worker.
+    '''
+
+    def __init__(self, index, ioloop, exchange, peer_paths):
+        Interest.__init__(self, exchange)
+        self.index = index
+        self.ioloop = ioloop
+        self._peer_paths = peer_paths
+
+
+    def link(self):
+        ''' connect to the other workers
+        '''
+        for i, path in enumerate(self._peer_paths):
+            if i == self.index:
+                continue
+            link = PeerLink(self.ioloop, self)
+            link.connect(path)
+            self.add_link(link)
+
+
+    def remove_link(self, link):
+        logging.warning("worker %d lost its link to %s", self.index,
+                link.address)
+        Interest.remove_link(self, link)
+
+
+
+class Cluster(object):
+    ''' Runs a broker on several cores: workers processes each run an
+        Exchange and a TcpAdapter listening on the same address, either
+        bound by every worker with SO_REUSEPORT or bound once before
+        forking and shared. Workers are linked to one another over Unix
+        sockets at path.N so a message reaches the subscribers of every
+        worker, whichever worker its producer is connected to.
+
+        setup(worker), if given, is called in every worker process before
+        its IOLoop starts, e.g. to connect local clients to worker.exchange.
+        Workers are not restarted when they die.
+    '''
+
+    def __init__(self, address, workers=None, reuse_port=None, path=None,
+            setup=None, exchange_factory=jetstream.Exchange, limits=None,
+            write_budget=65536):
+        self._address = address
+        self._n_workers = workers or multiprocessing.cpu_count()
+        if reuse_port is None:
+            reuse_port = jetstream.SO_REUSEPORT is not None
+        self._reuse_port = reuse_port
+        path = path or '/tmp/jetstream-cluster-%d' % os.getpid()
+        self._peer_paths = ['%s.%d' % (path, i)
+                for i in xrange(self._n_workers)]
+        self._setup = setup
+        self._exchange_factory = exchange_factory
+        self._limits = limits
+        self._write_budget = write_budget
+        self.pids = []
+        self._stopping = False
+
+
+    def start(self):
+        ''' fork the workers, returns in the parent process
+        '''
+        assert not self.pids
+        # every peer socket listens before any worker links to it
+        peer_sockets = [_listen(socket.AF_UNIX, path)
+                for path in self._peer_paths]
+        listener = None
+        if not self._reuse_port:
+            listener = _listen(socket.AF_INET, self._address)
+        for i in xrange(self._n_workers):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(i, peer_sockets, listener)
+            self.pids.append(pid)
+        for s in peer_sockets:
+            s.close()
+        if listener is not None:
+            listener.close()
+
+
+    def _run_worker(self, index, peer_sockets, listener):
+        try:
+            for i, s in enumerate(peer_sockets):
+                if i != index:
+                    s.close()
+            ioloop = tornado.ioloop.IOLoop()
+            exchange = self._exchange_factory()
+            worker = Worker(index, ioloop, exchange, self._peer_paths)
+            jetstream.IpcAdapter(exchange, ioloop).start_socket(
+                    peer_sockets[index])
+            adapter = jetstream.TcpAdapter(exchange, ioloop, self._limits,
+                    self._write_budget, self._reuse_port)
+            if listener is None:
+                adapter.start(self._address)
+            else:
+                adapter.start_socket(listener)
+            worker.link()
+            if self._setup:
+                self._setup(worker)
+            ioloop.start()
+        except:
+            logging.error("worker %d failed", index, exc_info=True)
+        finally:
+            os._exit(0)
+
+
+    def stop(self):
+        ''' terminate the workers and remove their Unix sockets
+        '''
+        self._stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.wait()
+        for path in self._peer_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+    def wait(self):
+        ''' block until every worker exited
+        '''
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self.pids:
+                self.pids.remove(pid)
+                if status and not self._stopping:
+                    logging.warning("worker %d exited with status %d",
+                            pid, status)
+
+
+def _listen(family, address):
+    s = socket.socket(family, socket.SOCK_STREAM, 0)
+    flags = fcntl.fcntl(s.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(s.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.unlink(address)
+    s.bind(address)
+    s.listen(128)
+    return s
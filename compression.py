@@ -0,0 +1,131 @@
+import struct, zlib
+
+try:
+    import lz4.block as _lz4
+except ImportError:
+    _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+
+# payloads under MIN_SIZE bytes are sent as they are
+MIN_SIZE = 512
+
+# broker side, messages of SHARED_SIZE bytes and more are compressed once on
+# their own and the result shared by the connections using the same codec,
+# smaller ones are compressed with the other messages of a batch, which
+# gives a better ratio and costs less
+SHARED_SIZE = 8192
+
+# handshake feature bits, see jetstream.FEATURES
+FEATURE_ZLIB = 1 << 9
+FEATURE_LZ4 = 1 << 10
+FEATURE_ZSTD = 1 << 11
+
+_SIZE = struct.Struct('<I')
+
+
+class ZlibCodec(object):
+    ''' always available, level 1 trades some ratio for speed
+    '''
+
+    name = 'zlib'
+    feature = FEATURE_ZLIB
+
+    def __init__(self, level=1):
+        self._level = level
+
+
+    def compress(self, data):
+        return zlib.compress(data, self._level)
+
+
+    def decompress(self, data, limit):
+        ''' raises ValueError on corrupt data or when it expands over
+            limit bytes
+        '''
+        try:
+            d = zlib.decompressobj()
+            result = d.decompress(data, limit)
+        except zlib.error, e:
+            raise ValueError(str(e))
+        if d.unconsumed_tail:
+            raise ValueError("payload expands over %d bytes" % limit)
+        return result
+
+
+
+class Lz4Codec(object):
+    ''' lz4 block format, needs the lz4 package
+    '''
+
+    name = 'lz4'
+    feature = FEATURE_LZ4
+
+    def compress(self, data):
+        return _lz4.compress(data, store_size=True)
+
+
+    def decompress(self, data, limit):
+        if len(data) < _SIZE.size or _SIZE.unpack_from(data)[0] > limit:
+            raise ValueError("payload expands over %d bytes" % limit)
+        try:
+            return _lz4.decompress(data)
+        except Exception, e:
+            raise ValueError(str(e))
+
+
+
+class ZstdCodec(object):
+    ''' zstandard, needs the zstandard package
+    '''
+
+    name = 'zstd'
+    feature = FEATURE_ZSTD
+
+    def __init__(self, level=3):
+        self._compressor = _zstd.ZstdCompressor(level=level)
+        self._decompressor = _zstd.ZstdDecompressor()
+
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+
+    def decompress(self, data, limit):
+        ''' max_output_size only bounds frames not telling their content
+            size, the others are allocated the size they tell
+        '''
+        try:
+            size = _zstd.frame_content_size(data)
+            if size > limit:
+                raise ValueError("payload expands over %d bytes" % limit)
+            return self._decompressor.decompress(data, max_output_size=limit)
+        except _zstd.ZstdError, e:
+            raise ValueError(str(e))
+
+
+
+# the codecs this side supports, the preferred first
+CODECS = [ZlibCodec()]
+if _lz4 is not None:
+    CODECS.insert(0, Lz4Codec())
+if _zstd is not None:
+    CODECS.insert(0, ZstdCodec())
+
+FEATURES = 0
+for _codec in CODECS:
+    FEATURES |= _codec.feature
+del _codec
+
+
+def choose(features):
+    ''' the preferred codec of those in the features bits, None if none
+    '''
+    for codec in CODECS:
+        if features & codec.feature:
+            return codec
+    return None
@@ -0,0 +1,597 @@
+import os, struct, zlib, mmap, time, logging, bisect
+import threading, functools
+from array import array
+from collections import deque
+from Queue import Queue
+import tornado.ioloop
+
+
+# record: payload length, crc32 of the payload, payload
+_RECORD = struct.Struct('!Ii')
+_CURSOR = struct.Struct('!Q')
+
+
+class Segment(object):
+    ''' One file of a SegmentLog, named after the sequence number of its
+        first record. Records are read through a read only memory map that
+        is extended as the file grows.
+    '''
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.positions = array('l') # file offset of every record
+        self.size = 0
+        self.mtime = time.time()
+        self._map = None
+        self._mapped = 0
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    def load(self):
+        ''' index the records of an existing file, a torn record at the
+            end, from a crash in the middle of a write, is cut off
+        '''
+        size = os.path.getsize(self.path)
+        self.mtime = os.path.getmtime(self.path)
+        if size == 0:
+            return
+        with open(self.path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset + _RECORD.size <= size:
+                length, crc = _RECORD.unpack_from(m, offset)
+                end = offset + _RECORD.size + length
+                if end > size or \
+                        zlib.crc32(m[offset + _RECORD.size:end]) != crc:
+                    break
+                self.positions.append(offset)
+                offset = end
+        finally:
+            m.close()
+        if offset != size:
+            logging.warning("truncating %s from %d to %d bytes", self.path,
+                    size, offset)
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        self.size = offset
+
+
+    def read(self, i):
+        offset = self.positions[i]
+        end = self.positions[i + 1] if i + 1 < len(self.positions) \
+                else self.size
+        if end > self._mapped:
+            self._remap()
+        return self._map[offset + _RECORD.size:end]
+
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), self.size,
+                    access=mmap.ACCESS_READ)
+        self._mapped = self.size
+
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped = 0
+
+
+def _copy_records(source, positions, size, path):
+    ''' copy the records of segment file source from positions[0] to size
+        into a new segment file at path, returns their positions there
+    '''
+    start = positions[0]
+    with open(source, 'rb') as f:
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            for offset in xrange(start, size, 1 << 20):
+                f.write(m[offset:min(offset + (1 << 20), size)])
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        m.close()
+    os.rename(path + '.tmp', path)
+    return array('l', (position - start for position in positions))
+
+
+
+class SegmentLog(object):
+    ''' Append only log of messages kept in segment files of about
+        segment_bytes in directory, each message numbered by a sequence
+        number.
+
+        Appends are buffered and written with a single write (group commit)
+        every sync_interval seconds or once sync_bytes are pending, so they
+        cost about as much as queueing in memory. Records not written yet
+        are read from the buffer.
+
+        Whatever may block on the disk, the fsync following every write,
+        compacting, deleting segments and the jobs handed to submit(), runs
+        on a thread of the log, one job at a time in order, so that the
+        IOLoop goes on meanwhile. on_sync is called on the IOLoop once the
+        records written are on disk.
+
+        Sealed segments are deleted once older than retention_seconds or
+        when the log is over retention_bytes, oldest first, and by
+        release() once every record they hold was consumed.
+    '''
+
+    def __init__(self, directory, ioloop=None, segment_bytes=64 << 20,
+            sync_interval=0.005, sync_bytes=1 << 20,
+            retention_bytes=None, retention_seconds=None):
+        self._directory = directory
+        self._ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self._segment_bytes = segment_bytes
+        self._sync_interval = sync_interval
+        self._sync_bytes = sync_bytes
+        self._retention_bytes = retention_bytes
+        self._retention_seconds = retention_seconds
+        self._segments = []
+        self._bases = [] # base of every segment, for bisect
+        self._file = None # of the last segment
+        self._pending = [] # appended records not written yet
+        self._pending_bytes = 0
+        self._pending_messages = []
+        self._synced = 0 # sequence number of the first pending record
+        self.end = 0 # sequence number of the next record appended
+        self._sync_timeout = None
+        self._compacting = False
+        self._closed = False
+        self.on_sync = None # called after every sync
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+        self._jobs = Queue() # (job, done) for _work, None to stop
+        self._worker = threading.Thread(target=self._work,
+                name='SegmentLog %s' % directory)
+        self._worker.daemon = True
+        self._worker.start()
+
+
+    def _load(self):
+        names = sorted(name for name in os.listdir(self._directory)
+                if name.endswith('.log'))
+        for name in names:
+            segment = Segment(os.path.join(self._directory, name),
+                    int(name[:-4]))
+            segment.load()
+            previous = self._segments[-1] if self._segments else None
+            if previous is not None and \
+                    segment.base < previous.base + len(previous):
+                # compacted into segment, left behind by a crash or close
+                self._segments.pop()
+                self._bases.pop()
+                os.unlink(previous.path)
+            self._add_segment(segment)
+        if not self._segments:
+            self._roll(0)
+        else:
+            self._file = open(self._segments[-1].path, 'ab')
+        last = self._segments[-1]
+        self._synced = self.end = last.base + len(last)
+
+
+    @property
+    def start(self):
+        ''' sequence number of the oldest record kept
+        '''
+        return self._segments[0].base
+
+
+    def size(self):
+        return sum(s.size for s in self._segments) + self._pending_bytes
+
+
+    def append(self, message):
+        ''' append message, returns its sequence number
+        '''
+        seq = self.end
+        self.end += 1
+        self._pending.append(_RECORD.pack(len(message), zlib.crc32(message)))
+        self._pending.append(message)
+        self._pending_messages.append(message)
+        self._pending_bytes += _RECORD.size + len(message)
+        if self._pending_bytes >= self._sync_bytes:
+            self.sync()
+        elif self._sync_timeout is None:
+            self.schedule_sync()
+        return seq
+
+
+    def schedule_sync(self):
+        ''' sync within sync_interval
+        '''
+        if self._sync_timeout is None:
+            self._sync_timeout = self._ioloop.add_timeout(
+                    time.time() + self._sync_interval, self.sync)
+
+
+    def read(self, seq):
+        if seq >= self._synced:
+            return self._pending_messages[seq - self._synced]
+        i = bisect.bisect_right(self._bases, seq) - 1
+        segment = self._segments[i]
+        return segment.read(seq - segment.base)
+
+
+    def read_many(self, seq, n):
+        ''' up to n records from seq on
+        '''
+        if seq >= self._synced:
+            return self._pending_messages[seq - self._synced:
+                    seq - self._synced + n]
+        i = bisect.bisect_right(self._bases, seq) - 1
+        segment = self._segments[i]
+        first = seq - segment.base
+        return [segment.read(j)
+                for j in xrange(first, min(first + n, len(segment)))]
+
+
+    def sync(self):
+        ''' write the pending records, and fsync them on the thread of the
+            log
+        '''
+        if self._sync_timeout is not None:
+            self._ioloop.remove_timeout(self._sync_timeout)
+            self._sync_timeout = None
+        if self._pending:
+            last = self._segments[-1]
+            offset = last.size
+            for message in self._pending_messages:
+                last.positions.append(offset)
+                offset += _RECORD.size + len(message)
+            f = self._file
+            f.write(''.join(self._pending))
+            f.flush()
+            last.size = offset
+            last.mtime = time.time()
+            self._pending = []
+            self._pending_messages = []
+            self._pending_bytes = 0
+            self._synced = self.end
+            self.submit(lambda: os.fsync(f.fileno()), self._on_synced)
+            if last.size >= self._segment_bytes:
+                self._roll(self.end)
+            self._retain()
+        else:
+            self._retain()
+            self._on_synced(None)
+
+
+    def _on_synced(self, result):
+        if self.on_sync and not self._closed:
+            self.on_sync()
+
+
+    def submit(self, job, done=None):
+        ''' run job() on the thread of the log, after the jobs submitted
+            before, then done(its result) on the IOLoop. A job raising is
+            logged and done is not called.
+        '''
+        self._jobs.put((job, done))
+
+
+    def _work(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            job, done = item
+            try:
+                result = job()
+            except Exception:
+                logging.error("error in a job of %s", self._directory,
+                        exc_info=True)
+                continue
+            if done is not None:
+                self._ioloop.add_callback(functools.partial(done, result))
+
+
+    def release(self, seq):
+        ''' records before seq were consumed, drop the segments holding
+            nothing else
+        '''
+        while len(self._segments) > 1 and \
+                self._segments[1].base <= seq:
+            self._drop_first()
+
+
+    def compact(self, seq):
+        ''' rewrite the oldest segment without its records before seq when
+            they are most of it, to give their space back. The copy is made
+            on the thread of the log, and replaces the segment unless it was
+            dropped meanwhile.
+        '''
+        if len(self._segments) < 2 or self._compacting:
+            return
+        first = self._segments[0]
+        consumed = seq - first.base
+        if consumed <= 0 or consumed < len(first) / 2:
+            return
+        path = os.path.join(self._directory, '%020d.log' % seq)
+        # sealed, neither of them changes any more
+        positions = first.positions[consumed:]
+        size = first.size
+        self._compacting = True
+
+        def compacted(result):
+            self._compacting = False
+            if self._closed:
+                return
+            if self._segments[0] is not first:
+                self.submit(lambda: os.unlink(path))
+                return
+            segment = Segment(path, seq)
+            segment.positions = result
+            segment.size = size - positions[0]
+            segment.mtime = first.mtime
+            self._segments[0] = segment
+            self._bases[0] = seq
+            self._remove(first)
+        self.submit(lambda: _copy_records(first.path, positions, size, path),
+                compacted)
+
+
+    def close(self):
+        ''' write the pending records and wait for the jobs submitted
+        '''
+        self.sync()
+        self._jobs.put(None)
+        self._worker.join()
+        self._closed = True
+        self._file.close()
+        for segment in self._segments:
+            segment.close()
+
+
+    def _add_segment(self, segment):
+        self._segments.append(segment)
+        self._bases.append(segment.base)
+
+
+    def _roll(self, base):
+        if self._file is not None:
+            # after the fsync of its last records
+            self.submit(self._file.close)
+        segment = Segment(os.path.join(self._directory, '%020d.log' % base),
+                base)
+        self._file = open(segment.path, 'ab')
+        self._add_segment(segment)
+
+
+    def _drop_first(self):
+        self._remove(self._segments.pop(0))
+        self._bases.pop(0)
+
+
+    def _remove(self, segment):
+        segment.close()
+        self.submit(lambda: os.unlink(segment.path))
+
+
+    def _retain(self):
+        if self._retention_seconds is not None:
+            limit = time.time() - self._retention_seconds
+            while len(self._segments) > 1 and \
+                    self._segments[0].mtime < limit:
+                self._drop_first()
+        if self._retention_bytes is not None:
+            while len(self._segments) > 1 and \
+                    self.size() > self._retention_bytes:
+                self._drop_first()
+
+
+
+class _Handed(str):
+    ''' a message of a DurableQueue on its way to a subscriber, settled once
+        the subscriber acknowledged it, or it was written to a connection
+        not using OP_QOS or handed to an in-process client
+    '''
+
+    def __new__(cls, message, queue, seq):
+        self = str.__new__(cls, message)
+        self.queue = queue
+        self.seq = seq
+        return self
+
+
+    def settle(self):
+        self.queue._settle(self.seq)
+
+
+
+class DurableQueue(object):
+    ''' Keeps the unicast messages sent to qid on exchange in a SegmentLog
+        in directory until a subscriber takes them, across broker restarts
+        and while nobody subscribes. Multicast messages are not stored.
+
+        Messages are handed to subscribers in order, batch at a time on
+        every IOLoop turn, pausing while the picked subscribers are over
+        their queue limits or all of them are out of prefetch credit.
+        The ones handed back, by a connection closing or a consumer
+        rejecting them, are handed out again before the others.
+        The position of the first message not settled yet (see
+        jetstream.Connection) is saved along with every sync of the log, so
+        a restart may deliver again the messages settled since the last
+        sync, and those settled after one that was not, but loses none that
+        was synced. A message dropped by the queue limits, or expired,
+        counts as settled.
+        Options other than ioloop and batch go to the SegmentLog.
+    '''
+
+    peer = False
+
+    def __init__(self, exchange, qid, directory, ioloop=None, batch=256,
+            **options):
+        self.qid = qid
+        self._exchange = exchange
+        self._ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self._batch = batch
+        self._log = SegmentLog(directory, self._ioloop, **options)
+        self._log.on_sync = self._save_cursor
+        self._cursor_path = os.path.join(directory, 'cursor')
+        self._cursor = min(max(self._load_cursor(), self._log.start),
+                self._log.end)
+        self._saved = self._cursor
+        self._floor = self._cursor # the first message maybe not settled
+        self._unsettled = set() # sequence numbers handed out
+        self._returned = deque() # handed out messages handed back
+        self._settling = False # settled some since the last save
+        self._pumping = False
+        self._waiting_for = 0
+        exchange.add_observer(self)
+        exchange.set_durable(qid, self)
+        if self._cursor < self._log.end:
+            self._schedule()
+
+
+    def __len__(self):
+        ''' messages waiting for a subscriber
+        '''
+        return self._log.end - self._cursor + len(self._returned)
+
+
+    def append(self, message):
+        if type(message) is not str and \
+                getattr(message, 'settle', None) is not None:
+            # one of ours, handed back by the exchange
+            self._returned.append(message)
+        else:
+            self._log.append(message)
+        self._schedule()
+
+
+    def append_many(self, messages):
+        for message in messages:
+            self._log.append(message)
+        self._schedule()
+
+
+    def on_subscribe(self, qid, client):
+        if qid == self.qid or (not isinstance(qid, str) and
+                qid.match(self.qid)):
+            self._schedule()
+
+
+    def on_unsubscribe(self, qid, client):
+        pass
+
+
+    def on_credit(self, client):
+        if self._returned or self._cursor < self._log.end:
+            self._schedule()
+
+
+    def close(self):
+        self._exchange.remove_observer(self)
+        self._exchange.set_durable(self.qid, None)
+        self._save_cursor()
+        self._log.close()
+
+
+    def _schedule(self):
+        if not self._pumping and not self._waiting_for:
+            self._pumping = True
+            self._ioloop.add_callback(self._pump)
+
+
+    def _pump(self):
+        self._pumping = False
+        log = self._log
+        # retention may have dropped messages nobody took
+        self._cursor = max(self._cursor, log.start)
+        returned = self._returned
+        if (returned or self._cursor < log.end) and self._has_credit():
+            if returned:
+                messages = [returned.popleft()
+                        for i in xrange(min(len(returned), self._batch))]
+            else:
+                seq = self._cursor
+                messages = [_Handed(message, self, seq + i) for i, message
+                        in enumerate(log.read_many(seq, self._batch))]
+                self._cursor += len(messages)
+                self._unsettled.update(xrange(seq, self._cursor))
+            congested = self._exchange.dispatch_many(self.qid, messages,
+                    False, self)
+            if congested:
+                self._waiting_for = len(congested)
+                for c in congested:
+                    c.wait_drained(self._on_receiver_drained)
+                return
+            if returned or self._cursor < log.end:
+                self._schedule()
+
+
+    def _has_credit(self):
+        ''' a subscriber can take messages, those handed out beyond its
+            prefetch window are parked by the exchange
+        '''
+        for c in self._exchange.subscribers(self.qid):
+            if not c.out_of_credit:
+                return True
+        return False
+
+
+    def _on_receiver_drained(self):
+        self._waiting_for -= 1
+        if self._waiting_for == 0:
+            self._schedule()
+
+
+    def _load_cursor(self):
+        try:
+            with open(self._cursor_path, 'rb') as f:
+                return _CURSOR.unpack(f.read(_CURSOR.size))[0]
+        except (IOError, struct.error):
+            return 0
+
+
+    def _settle(self, seq):
+        self._unsettled.discard(seq)
+        if not self._settling:
+            # save the cursor by the next sync
+            self._settling = True
+            self._log.schedule_sync()
+
+
+    def _save_cursor(self):
+        ''' save the position of the first message not settled yet
+        '''
+        self._settling = False
+        start = self._log.start
+        if self._floor < start:
+            # retention dropped them
+            self._floor = start
+            self._unsettled = set(seq for seq in self._unsettled
+                    if seq >= start)
+        floor = self._floor
+        while floor < self._cursor and floor not in self._unsettled:
+            floor += 1
+        self._floor = floor
+        if floor == self._saved:
+            return
+        self._log.release(floor)
+        self._log.compact(floor)
+        path = self._cursor_path
+        self._log.submit(lambda: _write_cursor(path, floor))
+        self._saved = floor
+
+
+
+def _write_cursor(path, cursor):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(_CURSOR.pack(cursor))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
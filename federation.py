@@ -0,0 +1,170 @@
+import socket, time, logging, errno
+import tornado.ioloop
+import jetstream, compression
+from cluster import PeerLink, Interest
+
+
+class FederationLink(PeerLink):
+    ''' PeerLink to the broker of another node, over TCP. When the connection
+        fails or is lost, it connects again after retry_interval seconds,
+        doubling the delay up to max_retry_interval, and subscribes again
+        once connected. The socket connects in the background, the IOLoop
+        telling once it is writable, and the attempt fails after
+        connect_timeout. The address is expected numeric, resolving a host
+        name blocks. Large payloads are compressed when the other broker
+        supports one of our codecs.
+    '''
+
+    request_features = jetstream.FEATURE_PEER | compression.FEATURES
+
+    def __init__(self, ioloop, interest, retry_interval=0.5,
+            max_retry_interval=30.0, connect_timeout=5.0):
+        PeerLink.__init__(self, ioloop, interest)
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+        self._connect_timeout = connect_timeout
+        self._delay = retry_interval
+        self._retry_timeout = None
+        self._connecting = None # socket connecting
+        self._connect_deadline = None
+        self._closing = False
+
+
+    def connect(self, address):
+        self.address = address
+        self._retry_timeout = None
+        s = None
+        try:
+            family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+                    address[0], address[1], 0, socket.SOCK_STREAM)[0]
+            s = socket.socket(family, socktype, proto)
+            s.setblocking(0)
+            error = s.connect_ex(sockaddr)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(error, errno.errorcode.get(error, error))
+        except socket.error as e:
+            if s is not None:
+                s.close()
+            self._failed(e)
+            return
+        self._connecting = s
+        self._connect_deadline = self.add_timeout(
+                time.time() + self._connect_timeout, self._on_connect_timeout)
+        self._ioloop.add_handler(s.fileno(), self._on_connect_events,
+                tornado.ioloop.IOLoop.WRITE)
+
+
+    def _on_connect_events(self, fd, events):
+        s = self._stop_connecting()
+        error = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            s.close()
+            self._failed(socket.error(error, errno.errorcode.get(error,
+                error)))
+            return
+        self._open(s)
+
+
+    def _on_connect_timeout(self):
+        self._connect_deadline = None
+        self._stop_connecting().close()
+        self._failed("timed out")
+
+
+    def _stop_connecting(self):
+        ''' the socket connecting, which the IOLoop no longer watches
+        '''
+        s, self._connecting = self._connecting, None
+        self._ioloop.remove_handler(s.fileno())
+        if self._connect_deadline is not None:
+            self.remove_timeout(self._connect_deadline)
+            self._connect_deadline = None
+        return s
+
+
+    def _failed(self, e):
+        logging.warning("federation link to %s:%d failed: %s",
+                self.address[0], self.address[1], e)
+        self._retry()
+
+
+    def close(self):
+        ''' close the link for good
+        '''
+        self._closing = True
+        if self._retry_timeout is not None:
+            self.remove_timeout(self._retry_timeout)
+            self._retry_timeout = None
+        if self._connecting is not None:
+            self._stop_connecting().close()
+        if self._stream is not None and not self._stream.closed():
+            PeerLink.close(self)
+        else:
+            self._interest.remove_link(self)
+
+
+    def on_connected(self):
+        self._delay = self._retry_interval
+        PeerLink.on_connected(self)
+
+
+    def on_disconnected(self):
+        if self._closing:
+            self._interest.remove_link(self)
+            return
+        logging.warning("federation link to %s:%d lost", *self.address)
+        self._retry()
+
+
+    def _retry(self):
+        if self._closing:
+            return
+        self._retry_timeout = self.add_timeout(time.time() + self._delay,
+                lambda: self.connect(self.address))
+        self._delay = min(self._delay * 2, self._max_retry_interval)
+
+
+
+class Federation(Interest):
+    ''' Bridges an Exchange with the brokers of other nodes. link(address)
+        connects to the TcpAdapter of a remote broker as a peer and
+        subscribes there to the qids, exact or regular expressions, the
+        local clients subscribed to, so the remote broker only forwards the
+        messages somebody wants here. It queues them on its peer Connection,
+        which packs them in OP_BATCH frames.
+
+        Messages coming from a link are delivered to local clients only and
+        never forwarded to another peer, which keeps them from looping: they
+        travel one hop, so every node links to every node it wants messages
+        from, usually all of them in both directions. Every worker of a
+        Cluster links on its own, from its setup callback.
+    '''
+
+    def __init__(self, exchange, ioloop=None, retry_interval=0.5,
+            max_retry_interval=30.0, connect_timeout=5.0):
+        Interest.__init__(self, exchange)
+        self._ioloop = ioloop
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+        self._connect_timeout = connect_timeout
+
+
+    def link(self, address):
+        ''' link to the broker at address (host, port), returns the link
+        '''
+        link = FederationLink(self._ioloop, self, self._retry_interval,
+                self._max_retry_interval, self._connect_timeout)
+        self.add_link(link)
+        link.connect(address)
+        return link
+
+
+    def unlink(self, address):
+        for link in list(self._links):
+            if link.address == address:
+                link.close()
+
+
+    def close(self):
+        for link in list(self._links):
+            link.close()
@@ -9,18 +9,32 @@ import socket
 
 class IOStream(object):
     def __init__(self, socket, io_loop=None, max_buffer_size=104857600,
-                 read_chunk_size=4096):
+                 read_chunk_size=4096, max_read_chunk_size=1048576,
+                 write_chunk_size=131072, metrics=None):
         self.socket = socket
         self.socket.setblocking(False)
         self.io_loop = io_loop or ioloop.IOLoop.instance()
         self.max_buffer_size = max_buffer_size
         self.read_chunk_size = read_chunk_size
-        self._read_buffer = deque()
+        self.max_read_chunk_size = max_read_chunk_size
+        self.write_chunk_size = write_chunk_size
+        self.metrics = metrics # counts the recv and send calls
+        # received data is _read_buffer[_read_start:_read_end], the buffer
+        # is reused and only grows when a read does not fit in it
+        self._read_buffer = bytearray(read_chunk_size)
+        self._read_start = 0
+        self._read_end = 0
         self._read_buffer_size = 0
+        self._chunk_size = read_chunk_size # adapts to the incoming rate
         self._write_buffer = deque()
         self._write_buffer_size = 0
+        self._write_offset = 0 # bytes of _write_buffer[0] already sent
         self._read_bytes = None
         self._read_callback = None
+        self._dispatching = False # inside _dispatch_reads
+        self._frame_parser = None
+        self._read_paused = False
+        self._peer_closed = False # the rest of the buffer is read first
         self._close_callback = None
         self._state = self.io_loop.ERROR
         self.io_loop.add_handler(
@@ -31,13 +45,51 @@ class IOStream(object):
         """Call callback when we read the given number of bytes."""
         assert not self._read_callback, "Already reading"
         if self._read_buffer_size >= num_bytes:
-            callback(self._consume(num_bytes))
+            self._read_bytes = num_bytes
+            self._read_callback = callback
+            if not self._dispatching:
+                self._dispatch_reads()
             return
         self._check_closed()
         self._read_bytes = num_bytes
         self._read_callback = callback
         self._add_io_state(self.io_loop.READ)
 
+    def read_frames(self, parser):
+        """Hand all received data to parser until the stream is closed.
+
+        parser(buffer, start, end) is called with the read buffer whenever
+        data arrives and returns the number of bytes it consumed, it may
+        leave an incomplete frame in the buffer for the next call. This
+        replaces read_bytes for the lifetime of the stream.
+        """
+        assert not self._read_callback, "Already reading"
+        self._check_closed()
+        self._frame_parser = parser
+        self._add_io_state(self.io_loop.READ)
+        if self._read_buffer_size and not self._dispatching:
+            self._dispatch_reads()
+
+    def pause_reading(self):
+        """Stop reading from the socket, the peer will block once the
+        socket buffers are full."""
+        self._read_paused = True
+        if self.socket:
+            self._remove_io_state(self.io_loop.READ)
+
+    def resume_reading(self):
+        """Undo pause_reading, parsing whatever was left in the buffer."""
+        if not self._read_paused:
+            return
+        self._read_paused = False
+        if not self.socket:
+            return
+        self._add_io_state(self.io_loop.READ)
+        if self._read_buffer_size and not self._dispatching:
+            self._dispatch_reads()
+        if self._peer_closed and not self._dispatching:
+            self._close_at_eof()
+
     def write(self, data, callback=None):
         """Write the given data to this stream.
         """
@@ -54,7 +106,8 @@ class IOStream(object):
     def close(self):
         """Close this stream."""
         if self.socket is not None:
-            self.io_loop.remove_handler(self.socket.fileno())
+            if not self._peer_closed:
+                self.io_loop.remove_handler(self.socket.fileno())
             self.socket.close()
             self.socket = None
             if self._close_callback:
@@ -62,11 +115,16 @@ class IOStream(object):
 
     def reading(self):
         """Returns true if we are currently reading from the stream."""
-        return self._read_callback is not None
+        return self._read_callback is not None or \
+            (self._frame_parser is not None and not self._read_paused)
 
     def writing(self):
         """Returns true if we are currently writing to the stream."""
-        return self._write_buffer_size > 0
+        return bool(self._write_buffer)
+
+    def write_buffer_size(self):
+        """Returns the number of bytes waiting to be written."""
+        return self._write_buffer_size
 
     def closed(self):
         return self.socket is None
@@ -77,19 +135,22 @@ class IOStream(object):
             return
         if events & self.io_loop.READ:
             self._handle_read()
-        if not self.socket:
+        if not self.socket or self._peer_closed:
             return
         if events & self.io_loop.WRITE:
             self._handle_write()
         if not self.socket:
             return
         if events & self.io_loop.ERROR:
-            self.close()
+            # a hang up, what the peer sent before is still read, even
+            # while reading is paused
+            self._handle_read(True)
             return
         state = self.io_loop.ERROR
-        if self._read_bytes:
+        if self._read_bytes or \
+                (self._frame_parser is not None and not self._read_paused):
             state |= self.io_loop.READ
-        if self._write_buffer_size:
+        if self._write_buffer:
             state |= self.io_loop.WRITE
         if state != self._state:
             self._state = state
@@ -97,7 +158,7 @@ class IOStream(object):
 
     def _run_callback(self, callback, *args, **kwargs):
         try:
-            callback(*args, **kwargs)
+            return callback(*args, **kwargs)
         except:
             # Close the socket on an uncaught exception from a user callback
             # (It would eventually get closed when the socket object is
@@ -108,111 +169,229 @@ class IOStream(object):
             # can see it and log the error
             raise
 
-    def _handle_read(self):
-        if self._read_buffer_size >= self.max_buffer_size:
-            #do not recv, the writer on the other side will slow down
-            #until we have consumed enough bytes
-            return
+    def _handle_read(self, to_eof=False):
+        """Read into the receive buffer until the socket is drained.
 
-        try:
-            chunk = self.socket.recv(self.read_chunk_size)
-        except socket.error, e:
-            if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
-                return
-            else:
-                logging.warning("Read error on %d: %s",
-                                self.socket.fileno(), e)
-                self.close()
-                return
+        The size of each recv_into grows while reads fill it and shrinks
+        back when they come back mostly empty. At most max_read_chunk_size
+        bytes more than the pending read needs are read per event, so a fast
+        sender cannot fill the buffer faster than callbacks drain it. Once
+        the peer hung up, to_eof reads everything it left in the socket.
 
+        At the end of the stream, the stream is closed once the buffered
+        data was handled, which waits for resume_reading when paused.
+        """
+        if to_eof:
+            limit = self.max_buffer_size
+        else:
+            limit = min(self.max_buffer_size, self.max_read_chunk_size +
+                        max(self._read_bytes or 0, self._read_buffer_size))
+        eof = to_eof
+        while self._read_buffer_size < limit:
+            chunk_size = min(self._chunk_size,
+                             limit - self._read_buffer_size)
+            self._reserve(chunk_size)
+            try:
+                view = memoryview(self._read_buffer)[self._read_end:]
+                n = self.socket.recv_into(view, chunk_size)
+                del view
+            except socket.error, e:
+                del view
+                if self.metrics is not None:
+                    self.metrics.syscall('recv', 0)
+                if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                else:
+                    logging.warning("Read error on %d: %s",
+                                    self.socket.fileno(), e)
+                    self.close()
+                    return
 
-        if not chunk:
-            self.close()
-            return
-        self._read_buffer.append(chunk)
-        self._read_buffer_size += len(chunk)
+            if self.metrics is not None:
+                self.metrics.syscall('recv', n)
+            if not n:
+                eof = True
+                break
+            self._read_end += n
+            self._read_buffer_size += n
+
+            if n == chunk_size:
+                self._chunk_size = min(self._chunk_size * 2,
+                                       self.max_read_chunk_size)
+            else:
+                if n < chunk_size / 4:
+                    self._chunk_size = max(self._chunk_size / 2,
+                                           self.read_chunk_size)
+                # a short read means the socket is drained, save the
+                # recv that would fail with EAGAIN
+                if not to_eof:
+                    break
 
         if self._read_buffer_size >= self.max_buffer_size:
             logging.error("read buffer overflow, close down")
             self.close()
             return
 
-        if self._read_buffer_size >= self._read_bytes:
-            num_bytes = self._read_bytes
-            callback = self._read_callback
-            self._read_callback = None
-            self._read_bytes = None
-            self._run_callback(callback, self._consume(num_bytes))
+        if eof:
+            # no more events, the socket would keep reporting the hang up
+            self._peer_closed = True
+            self.io_loop.remove_handler(self.socket.fileno())
+        self._dispatch_reads()
+        if eof:
+            self._close_at_eof()
+
+    def _close_at_eof(self):
+        """Close the stream the peer closed unless reading is paused with
+        data left in the buffer."""
+        if self.socket and not (self._read_paused and
+                                self._read_buffer_size):
+            self.close()
 
+    def _dispatch_reads(self):
+        """Run read callbacks while the buffer holds enough data for them.
+
+        A callback asking for more buffered data is served by this loop
+        rather than by a nested call, so a read buffer holding many small
+        frames does not grow the stack.
+        """
+        self._dispatching = True
+        try:
+            if self._frame_parser is not None:
+                if not self._read_paused:
+                    self._discard(self._run_callback(self._frame_parser,
+                        self._read_buffer, self._read_start, self._read_end))
+                return
+            while self._read_bytes is not None and \
+                    self._read_buffer_size >= self._read_bytes:
+                num_bytes = self._read_bytes
+                callback = self._read_callback
+                self._read_callback = None
+                self._read_bytes = None
+                self._run_callback(callback, self._consume(num_bytes))
+        finally:
+            self._dispatching = False
+
+    def _reserve(self, num_bytes):
+        """Make room for num_bytes after the buffered data, moving it to the
+        front of the buffer or growing the buffer."""
+        buf = self._read_buffer
+        if self._read_end + num_bytes <= len(buf):
+            return
+        if self._read_start:
+            size = self._read_buffer_size
+            buf[:size] = buf[self._read_start:self._read_end]
+            self._read_start = 0
+            self._read_end = size
+        needed = self._read_end + num_bytes - len(buf)
+        if needed > 0:
+            buf.extend(bytearray(max(needed, len(buf))))
 
     def _handle_write(self):
-        write_complete = False
-        if self._write_buffer_size:
+        """Write queued data until the socket would block.
 
+        Small buffers are coalesced into a single send and large ones are
+        sent from their current offset through a buffer object, so a partial
+        write never copies the rest of the data. Write callbacks run in
+        order once all of their data has been sent.
+        """
+        while self._write_buffer:
+            data, callback = self._write_buffer[0]
+            remaining = len(data) - self._write_offset
+            if remaining < self.write_chunk_size and \
+                    len(self._write_buffer) > 1:
+                chunk = self._coalesce()
+            elif self._write_offset:
+                chunk = buffer(data, self._write_offset)
+            else:
+                chunk = data
             try:
-                x, callback = self._write_buffer.popleft()
-                num_bytes = self.socket.send(x)
-                if num_bytes < len(x):
-                    self._write_buffer.appendleft( (x[num_bytes:], callback) )
-                else:
-                    write_complete = True
-                self._write_buffer_size -= num_bytes
+                num_bytes = self.socket.send(chunk) if chunk else 0
             except socket.error, e:
-                if not (e[0] in (errno.EWOULDBLOCK, errno.EAGAIN)):
-                    logging.warning("Write error on %d: %s",
-                                    self.socket.fileno(), e)
-                    self.close()
-                    return
+                if self.metrics is not None:
+                    self.metrics.syscall('send', 0)
+                if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                logging.warning("Write error on %d: %s",
+                                self.socket.fileno(), e)
+                self.close()
+                return
+            if self.metrics is not None and chunk:
+                self.metrics.syscall('send', num_bytes)
+            self._write_buffer_size -= num_bytes
+            self._advance(num_bytes)
+            if not self.socket:
+                return
+            if num_bytes < len(chunk):
+                break
 
-        if self._write_buffer_size > 0:
+        if self._write_buffer:
             self._add_io_state(self.io_loop.WRITE)
         else:
             self._remove_io_state(self.io_loop.WRITE)
 
-
-        if write_complete and callback:
-            self._run_callback(callback)
+    def _coalesce(self):
+        """Join queued buffers, from the current offset, up to
+        write_chunk_size bytes."""
+        pieces = []
+        n = 0
+        offset = self._write_offset
+        for data, callback in self._write_buffer:
+            if pieces and n + len(data) - offset > self.write_chunk_size:
+                break
+            pieces.append(data[offset:] if offset else data)
+            n += len(data) - offset
+            offset = 0
+        return ''.join(pieces)
+
+    def _advance(self, num_bytes):
+        """Drop num_bytes of sent data from the write buffer and run the
+        callbacks of the buffers that were completed."""
+        while self._write_buffer:
+            data, callback = self._write_buffer[0]
+            remaining = len(data) - self._write_offset
+            if num_bytes < remaining:
+                self._write_offset += num_bytes
+                return
+            num_bytes -= remaining
+            self._write_buffer.popleft()
+            self._write_offset = 0
+            if callback:
+                self._run_callback(callback)
+                if not self.socket:
+                    return
 
     def _consume(self, loc):
-        x = self._read_buffer.popleft()
-        length = len(x)
-        if length > loc:
-            result = x[:loc]
-            self._read_buffer.appendleft(x[loc:])
-        elif length == loc:
-            result = x
-        elif length < loc:
-            n = len(x)
-            acc = [x]
-            n0 = 0
-            while n < loc:
-                n0 += len(x)
-                x = self._read_buffer.popleft()
-                acc.append(x)
-                n += len(x)
-            if n > loc:
-                x = acc.pop()
-                i = len(x) - (n-loc)
-                acc.append(x[:i])
-                self._read_buffer.appendleft(x[i:])
-            result = ''.join(acc)
-
-        self._read_buffer_size -= len(result)
-
+        start = self._read_start
+        result = memoryview(self._read_buffer)[start:start + loc].tobytes()
+        self._discard(loc)
         return result
 
+    def _discard(self, loc):
+        self._read_buffer_size -= loc
+        if self._read_buffer_size:
+            self._read_start += loc
+        else:
+            self._read_start = self._read_end = 0
+            if len(self._read_buffer) > 4 * self.max_read_chunk_size:
+                # give back the memory of an unusually large message
+                self._read_buffer = bytearray(self.read_chunk_size)
+
     def _check_closed(self):
         if not self.socket:
             raise IOError("Stream is closed")
 
     def _add_io_state(self, state):
+        if self._peer_closed:
+            return
         if not self._state & state:
             self._state = self._state | state
             self.io_loop.update_handler(self.socket.fileno(), self._state)
 
 
     def _remove_io_state(self, state):
-        if not self._state & state:
+        if self._peer_closed:
+            return
+        if self._state & state:
             self._state = self._state &  (~state)
             self.io_loop.update_handler(self.socket.fileno(), self._state)
 
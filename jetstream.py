@@ -1,19 +1,231 @@
-import socket, functools, logging, fcntl, struct, time, types, re, random
+import socket, logging, fcntl, struct, time, types, re, random
+import sys
+import errno
+import bisect
+import threading
+from Queue import Full
 from collections import defaultdict, deque
 import tornado
 import tornado.ioloop
 from iostream import IOStream
+from timingwheel import TimingWheel
+import compression
+# re-exported with FEATURE_PEER, the feature bits documented below
+from compression import FEATURE_ZLIB, FEATURE_LZ4, FEATURE_ZSTD
+from topics import Topic, TopicTrie, QidTrie, PatternIndex, literal_prefix
+
+
+# not exported by the socket module of python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+        15 if sys.platform.startswith('linux') else None)
+
+
+class RandomStrategy(object):
+    ''' Pick one of the matching clients at random.
+    '''
+
+    def pick(self, qid, clients):
+        return random.choice(clients)
+
+
+
+class RoundRobinStrategy(object):
+    ''' Cycle through the matching clients of each qid.
+    '''
+
+    def __init__(self, max_qids=65536):
+        self._next = {} # qid -> counter
+        self._max_qids = max_qids
+
+
+    def pick(self, qid, clients):
+        i = self._next.get(qid, 0)
+        if i == 0 and len(self._next) >= self._max_qids:
+            self._next.clear()
+        self._next[qid] = i + 1
+        return clients[i % len(clients)]
+
+
+
+class LeastQueuedStrategy(object):
+    ''' Pick the less backed up of two randomly sampled clients
+        ("power of two choices"), by queued message count or queued bytes.
+        This keeps the pick O(1) while staying close to a global least
+        outstanding choice.
+    '''
+
+    def __init__(self, by_bytes=False):
+        self._by_bytes = by_bytes
+
+
+    def _load(self, client):
+        if self._by_bytes:
+            return client.outstanding_bytes()
+        return client.outstanding()
+
+
+    def pick(self, qid, clients):
+        n = len(clients)
+        if n == 1:
+            return clients[0]
+        i = random.randrange(n)
+        j = random.randrange(n - 1)
+        if j >= i:
+            j += 1
+        a, b = clients[i], clients[j]
+        return a if self._load(a) <= self._load(b) else b
+
+
+
+class WeightedStrategy(object):
+    ''' Pick a client with a probability proportional to its 'weight'
+        attribute. Cumulative weights are cached per clients tuple, the
+        exchange passing the cached route of a qid or the part of it with
+        credit left, and built again only when the exchange makes a new
+        one, so a pick is a bisect.
+    '''
+
+    def __init__(self, max_qids=65536):
+        # id(clients) -> (clients, cumulative weights), clients kept so
+        # that its id is not reused
+        self._cumulative = {}
+        self._max_qids = max_qids
+
+
+    def pick(self, qid, clients):
+        cached = self._cumulative.get(id(clients))
+        if cached is None or cached[0] is not clients:
+            total = 0
+            cumulative = []
+            for c in clients:
+                total += c.weight
+                cumulative.append(total)
+            if len(self._cumulative) >= self._max_qids:
+                self._cumulative.clear()
+            cached = self._cumulative[id(clients)] = (clients, cumulative)
+
+        cumulative = cached[1]
+        i = bisect.bisect_right(cumulative, random.random() * cumulative[-1])
+        return clients[min(i, len(clients) - 1)]
+
 
 
 class Exchange(object):
     ''' Base exchange class.
-        Implementing random routing for unicast message in case of multiple
-        matching.
+        Unicast messages are routed to one of the matching clients by a
+        strategy object (random by default) having a 'pick(qid, clients)'
+        method.
+
+        Exact qids are indexed in a dict, Topic subscriptions in a trie and
+        the other pattern subscriptions, regular expressions, by their
+        literal prefix in a PatternIndex, so that only those sharing the
+        prefix of a qid are tried on it. The subscribers matching a qid are
+        resolved once and then served from a route cache until a
+        subscription matching it changes.
+
+        Messages sent by a peer (a client whose 'peer' attribute is set,
+        standing for another broker) are only routed to non peer clients,
+        so they are never forwarded back among brokers. Observers added with
+        add_observer are told about every subscribe and unsubscribe.
+
+        A qid can be made durable with set_durable(qid, queue): unicast
+        messages to it are then handed to queue.append (or append_many)
+        rather than to a subscriber, see durable.DurableQueue.
+
+        Unicast messages skip the clients that are out_of_credit (their
+        prefetch window is full), which tell the exchange with
+        on_credit_spent(client); the subscribers of each qid having credit
+        are cached until one of them spends or gets it back. When all of
+        them are out of credit, the messages are parked, in order, until
+        on_credit(client) tells a subscriber can take some again or a new
+        client subscribes. The parked messages are bounded by
+        parked_limits, a QueueLimits: with PAUSE_PRODUCER a producer is
+        paused until the parked messages of the qid are back under the low
+        watermarks, DROP_OLDEST and DROP_NEWEST drop parked messages,
+        DISCONNECT drops the new ones too as the exchange cannot tell which
+        consumer is slow.
+
+        Given a metrics.Metrics, dispatch counts the messages and bytes to
+        every qid and samples its own latency, stats() reports them along
+        with the queue of every connection.
+
+        Given a retained.RetainedStore, the last multicast messages of
+        every qid are kept and handed to each client, peers excepted, that
+        subscribes to them, before any message dispatched after.
     '''
 
-    def __init__(self):
+    def __init__(self, strategy=None, route_cache_size=65536, metrics=None,
+            retained=None, parked_limits=None):
+        self._strategy = strategy or RandomStrategy()
         self._clients = {}  # client -> qid list
-        self._subscribers = defaultdict(set) # qid -> client set
+        self._subscribers = defaultdict(set) # exact qid -> client set
+        self._patterns = PatternIndex()
+        self._topics = TopicTrie()
+        self._routes = {} # qid -> resolved client tuple
+        self._cached = None # the qids of _routes, while there are patterns
+        self._local_routes = {} # qid -> resolved non peer client tuple
+        self._route_cache_size = route_cache_size
+        self._observers = []
+        self._durable = {} # qid -> queue
+        self._parked = {} # qid -> _Parked unicast messages waiting
+        self._parked_limits = parked_limits or \
+                QueueLimits(qid_high_messages=10000)
+        self._parked_messages = 0
+        self._parked_bytes = 0
+        self.parked_dropped = 0
+        self._credited = {} # qid -> subscribers with credit left
+        self._local_credited = {} # qid -> non peer subscribers with credit
+        self._credit_routes = defaultdict(set) # client -> qids credited
+        self.frames = FrameCache() # wire frames shared by the connections
+        self.metrics = metrics
+        self.retained = retained
+
+
+    def stats(self):
+        ''' the metrics gathered so far, see metrics.Metrics.snapshot, and
+            the state of the retained store, if any
+        '''
+        assert self.metrics is not None, "the exchange has no metrics"
+        stats = self.metrics.snapshot(self._clients.keys())
+        stats['parked'] = {
+            'messages': self._parked_messages,
+            'bytes': self._parked_bytes,
+            'dropped': self.parked_dropped,
+        }
+        if self.retained is not None:
+            stats['retained'] = self.retained.stats()
+        return stats
+
+
+    def add_observer(self, observer):
+        ''' observer.on_subscribe(qid, client) and
+            observer.on_unsubscribe(qid, client) get called on every
+            subscription change, observer.on_credit(client) every time a
+            client gets its prefetch credit back
+        '''
+        self._observers.append(observer)
+
+
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+
+
+    def set_durable(self, qid, queue):
+        ''' keep the unicast messages to qid in queue, None to stop
+        '''
+        if queue is None:
+            self._durable.pop(qid, None)
+        else:
+            self._durable[qid] = queue
+
+
+    def subscribers(self, qid):
+        ''' the clients subscribed to qid
+        '''
+        clients = self._routes.get(qid)
+        if clients is None:
+            clients = self._resolve(qid)
+        return clients
 
 
     def connect(self, client):
@@ -22,39 +234,419 @@ class Exchange(object):
 
     def disconnect(self, client):
         if client in self._clients:
-            for qid in self._clients[client]:
+            for qid in list(self._clients[client]):
                 self.unsubscribe(qid, client)
             del self._clients[client]
+            self._credit_routes.pop(client, None)
 
 
     def subscribe(self, qid, client):
-        ''' qid can be a string
+        ''' qid can be a string, a Topic
             or a regular expression like object has 'match' method
         '''
         assert client in self._clients
-        self._subscribers[qid].add(client)
+        if isinstance(qid, Topic):
+            self._topics.add(qid, client)
+            self._invalidate_matching(qid)
+        elif _is_pattern(qid):
+            self._patterns.add(qid, client)
+            self._invalidate_matching(qid)
+        else:
+            self._subscribers[qid].add(client)
+            self._invalidate(qid)
         self._clients[client].append(qid)
+        for observer in self._observers:
+            observer.on_subscribe(qid, client)
+        if self._parked:
+            self._unpark_all()
+        if self.retained is not None and not client.peer:
+            for r_qid, messages in self.retained.replay(qid):
+                for message in messages:
+                    client.on_message(r_qid, message)
 
 
     def unsubscribe(self, qid, client):
         assert client in self._clients
-        self._subscribers[qid].remove(client)
+        if isinstance(qid, Topic):
+            self._topics.remove(qid, client)
+            self._invalidate_matching(qid)
+        elif _is_pattern(qid):
+            self._patterns.remove(qid, client)
+            self._invalidate_matching(qid)
+        else:
+            subscribers = self._subscribers[qid]
+            subscribers.remove(client)
+            if not subscribers:
+                del self._subscribers[qid]
+            self._invalidate(qid)
         self._clients[client].remove(qid)
+        for observer in self._observers:
+            observer.on_unsubscribe(qid, client)
 
 
-    def dispatch(self, qid, message, multicast):
-        clients = set()
+    def _invalidate(self, qid=None):
+        ''' drop the cached routes of qid, or all of them
+        '''
+        if qid is None:
+            self._routes.clear()
+            self._cached = QidTrie() if self._patterns or self._topics \
+                    else None
+            self._local_routes.clear()
+            self._credited.clear()
+            self._local_credited.clear()
+            self._credit_routes.clear()
+        else:
+            if self._routes.pop(qid, None) is not None and \
+                    self._cached is not None:
+                self._cached.remove(qid)
+            self._local_routes.pop(qid, None)
+            self._credited.pop(qid, None)
+            self._local_credited.pop(qid, None)
+
+
+    def _invalidate_matching(self, pattern):
+        ''' drop the cached routes of the qids pattern, a Topic or a
+            regular expression, matches, walking down the cached qids from
+            its literal prefix rather than going through all of them. The
+            cached qids are only indexed while there are pattern
+            subscriptions, so the first one drops the whole cache instead.
+        '''
+        if self._cached is None:
+            self._invalidate()
+            return
+        if isinstance(pattern, Topic):
+            qids = self._cached.match(pattern)
+        else:
+            qids = [qid for qid in
+                    self._cached.prefixed(literal_prefix(pattern))
+                    if pattern.match(qid)]
+        for qid in qids:
+            self._invalidate(qid)
+        if not self._patterns and not self._topics:
+            self._cached = None
+
 
-        for t in self._subscribers:
-            if (type(t) == types.StringType and t == qid) or \
-                    (hasattr(t, 'match') and t.match(qid)):
-                clients.update(self._subscribers[t])
+    def _resolve(self, qid):
+        ''' compute and cache the subscribers of qid
+        '''
+        clients = set(self._subscribers.get(qid, ()))
+        if self._topics:
+            clients.update(self._topics.match(qid))
+        if self._patterns:
+            clients.update(self._patterns.match(qid))
+        clients = tuple(clients)
+
+        if len(self._routes) >= self._route_cache_size:
+            self._invalidate()
+        if self._cached is not None and qid not in self._routes:
+            self._cached.add(qid)
+        self._routes[qid] = clients
+        return clients
+
+
+    def _resolve_local(self, qid):
+        ''' the subscribers of qid which are not peers
+        '''
+        clients = self._routes.get(qid)
+        if clients is None:
+            clients = self._resolve(qid)
+        local = self._local_routes[qid] = tuple(c for c in clients
+                if not c.peer)
+        return local
+
+
+    def dispatch(self, qid, message, multicast, sender=None):
+        ''' deliver message to the clients subscribed to qid.
+            A client returning True from on_message is over its queue limits
+            and asks the producer to hold off, those clients are returned
+            so the caller can wait for them to drain.
+            A unicast message goes through on_unicast of the picked client
+            and is dropped when nobody subscribed to qid, unless qid is
+            durable. The durable queue itself and peers bypass it.
+        '''
+        if self.metrics is not None:
+            return self.metrics.dispatch(self._dispatch, qid, 1, len(message),
+                    message, multicast, sender)
+        return self._dispatch(qid, message, multicast, sender)
 
+
+    def dispatch_many(self, qid, messages, multicast, sender=None):
+        ''' deliver a list of messages to qid, the subscribers are resolved
+            once for all of them
+        '''
+        if self.metrics is not None:
+            return self.metrics.dispatch(self._dispatch_many, qid,
+                    len(messages), sum(len(m) for m in messages),
+                    messages, multicast, sender)
+        return self._dispatch_many(qid, messages, multicast, sender)
+
+
+    def _dispatch(self, qid, message, multicast, sender=None):
+        if sender is not None and sender.peer:
+            clients = self._local_routes.get(qid)
+            if clients is None:
+                clients = self._resolve_local(qid)
+            credited = self._local_credited
+        else:
+            clients = self._routes.get(qid)
+            if clients is None:
+                clients = self._resolve(qid)
+            credited = self._credited
+
+        congested = None
         if multicast:
-            [c.on_message(qid, message) for c in clients]
+            if self.retained is not None:
+                self.retained.append(qid, message)
+            for c in clients:
+                if c.on_message(qid, message):
+                    if congested is None:
+                        congested = []
+                    congested.append(c)
+        else:
+            if self._durable and (sender is None or not sender.peer):
+                queue = self._durable.get(qid)
+                if queue is not None and queue is not sender:
+                    queue.append(message)
+                    return None
+            if clients:
+                c = self._unicast(qid, message, clients, credited)
+                if c is not None:
+                    congested = [c]
+        return congested
+
+
+    def _dispatch_many(self, qid, messages, multicast, sender=None):
+        if sender is not None and sender.peer:
+            clients = self._local_routes.get(qid)
+            if clients is None:
+                clients = self._resolve_local(qid)
+            credited = self._local_credited
         else:
-            c = random.choice([c for c in clients])
-            c.on_message(qid, message)
+            clients = self._routes.get(qid)
+            if clients is None:
+                clients = self._resolve(qid)
+            credited = self._credited
+        if not multicast and self._durable and \
+                (sender is None or not sender.peer):
+            queue = self._durable.get(qid)
+            if queue is not None and queue is not sender:
+                queue.append_many(messages)
+                return None
+        if multicast and self.retained is not None:
+            self.retained.extend(qid, messages)
+        if not clients:
+            return None
+
+        congested = None
+        for message in messages:
+            if multicast:
+                for c in clients:
+                    if c.on_message(qid, message):
+                        if congested is None:
+                            congested = set()
+                        congested.add(c)
+            else:
+                c = self._unicast(qid, message, clients, credited)
+                if c is not None:
+                    if congested is None:
+                        congested = set()
+                    congested.add(c)
+        return list(congested) if congested else None
+
+
+    def _unicast(self, qid, message, clients, credited):
+        ''' hand message to one of clients with credit left, or park it.
+            Returns the client, or the parked queue, when it asks the
+            producer to hold off.
+        '''
+        parked = self._parked.get(qid) if self._parked else None
+        if parked is not None:
+            # keep the order of the messages parked before
+            return self._park(qid, message, parked)
+        c = self._strategy.pick(qid, clients)
+        if c.out_of_credit:
+            ready = credited.get(qid)
+            if ready is None:
+                ready = self._credit(qid, clients, credited)
+            if not ready:
+                return self._park(qid, message, None)
+            c = self._strategy.pick(qid, ready)
+        if c.on_unicast(qid, message):
+            return c
+        return None
+
+
+    def _credit(self, qid, clients, credited):
+        ''' cache in credited, and return, those of clients, the subscribers
+            of qid, which have credit left, until one of them spends or gets
+            it back
+        '''
+        routes = self._credit_routes
+        result = []
+        for c in clients:
+            routes[c].add(qid)
+            if not c.out_of_credit:
+                result.append(c)
+        result = clients if len(result) == len(clients) else tuple(result)
+        credited[qid] = result
+        return result
+
+
+    def _park(self, qid, message, parked):
+        ''' keep message until a subscriber of qid has credit, within
+            parked_limits. Returns parked, the queue of qid, when the
+            producer should wait for it to drain.
+        '''
+        limits = self._parked_limits
+        size = len(message)
+        over = self._parked_messages >= limits.high_messages or \
+                self._parked_bytes + size > limits.high_bytes
+        if parked is not None:
+            over = over or len(parked.messages) >= limits.qid_high_messages \
+                    or parked.bytes + size > limits.qid_high_bytes
+        elif size > limits.qid_high_bytes or not limits.qid_high_messages:
+            over = True
+        if over and limits.policy in (DROP_NEWEST, DISCONNECT):
+            self.parked_dropped += 1
+            _settled(message)
+            return None
+
+        if parked is None:
+            parked = self._parked[qid] = _Parked()
+        queue = parked.messages
+        queue.append(message)
+        parked.bytes += size
+        self._parked_messages += 1
+        self._parked_bytes += size
+        if not over:
+            return None
+        if limits.policy == PAUSE_PRODUCER:
+            return parked
+        while len(queue) > 1 and (len(queue) > limits.qid_high_messages or
+                parked.bytes > limits.qid_high_bytes or
+                self._parked_messages > limits.high_messages or
+                self._parked_bytes > limits.high_bytes):
+            dropped = queue.popleft()
+            size = len(dropped)
+            parked.bytes -= size
+            self._parked_messages -= 1
+            self._parked_bytes -= size
+            self.parked_dropped += 1
+            _settled(dropped)
+        return None
+
+
+    def parked(self, qid):
+        ''' number of unicast messages to qid waiting for credit
+        '''
+        parked = self._parked.get(qid)
+        return len(parked.messages) if parked is not None else 0
+
+
+    def on_credit_spent(self, client):
+        ''' client takes no unicast message for now
+        '''
+        self._forget_credit(client)
+
+
+    def on_credit(self, client):
+        ''' client can take unicast messages again
+        '''
+        self._forget_credit(client)
+        if self._parked:
+            self._unpark_all()
+        for observer in self._observers:
+            observer.on_credit(client)
+
+
+    def _forget_credit(self, client):
+        qids = self._credit_routes.pop(client, None)
+        if qids:
+            for qid in qids:
+                self._credited.pop(qid, None)
+                self._local_credited.pop(qid, None)
+
+
+    def _unpark_all(self):
+        for qid in self._parked.keys():
+            self._unpark(qid)
+
+
+    def _unpark(self, qid):
+        ''' parked messages may come from a peer, they only go to non peer
+            clients. The producers paused on them are called back right
+            away once they are under the low watermarks.
+        '''
+        parked = self._parked.get(qid)
+        if parked is None:
+            return
+        queue = parked.messages
+        credited = self._local_credited
+        clients = credited.get(qid)
+        if clients is None:
+            local = self._local_routes.get(qid)
+            if local is None:
+                local = self._resolve_local(qid)
+            clients = self._credit(qid, local, credited)
+        n = size = 0
+        while queue and clients:
+            message = queue.popleft()
+            n += 1
+            size += len(message)
+            c = self._strategy.pick(qid, clients)
+            c.on_unicast(qid, message)
+            if c.out_of_credit:
+                clients = credited.get(qid)
+                if clients is None:
+                    clients = self._credit(qid, self._local_routes.get(qid)
+                            or self._resolve_local(qid), credited)
+        parked.bytes -= size
+        self._parked_bytes -= size
+        self._parked_messages -= n
+        if not queue:
+            del self._parked[qid]
+        limits = self._parked_limits
+        if parked.waiters and (not queue or
+                (len(queue) <= limits.qid_low_messages and
+                parked.bytes <= limits.qid_low_bytes and
+                self._parked_messages <= limits.low_messages and
+                self._parked_bytes <= limits.low_bytes)):
+            waiters, parked.waiters = parked.waiters, []
+            for callback in waiters:
+                callback()
+
+
+
+class _Parked(object):
+    ''' the unicast messages to a qid waiting for credit, producers paused
+        on them call wait_drained as they would on a congested client
+    '''
+
+    __slots__ = ('messages', 'bytes', 'waiters')
+
+    def __init__(self):
+        self.messages = deque()
+        self.bytes = 0
+        self.waiters = []
+
+
+    def wait_drained(self, callback):
+        self.waiters.append(callback)
+
+
+def _is_pattern(qid):
+    return type(qid) != types.StringType and hasattr(qid, 'match')
+
+
+def _subscription(qid, flag):
+    ''' the qid, Topic or regular expression an OP_SUBSCRIBE or
+        OP_UNSUBSCRIBE frame stands for
+    '''
+    if flag == FLAG_TOPIC:
+        return Topic(qid)
+    if flag:
+        return re.compile(qid)
+    return qid
 
 
 class Adapter(object):
@@ -63,6 +655,8 @@ class Adapter(object):
 
     def __init__(self, exchange):
         self._exchange = exchange
+        self.frames = exchange.frames
+        self.metrics = exchange.metrics
 
     def connect(self, client):
         self._exchange.connect(client)
@@ -76,14 +670,29 @@ class Adapter(object):
     def unsubscribe(self, qid, client):
         self._exchange.unsubscribe(qid, client)
 
-    def dispatch(self, qid, message, multicast):
-        self._exchange.dispatch(qid, message, multicast)
+    def dispatch(self, qid, message, multicast, sender=None):
+        return self._exchange.dispatch(qid, message, multicast, sender)
+
+    def dispatch_many(self, qid, messages, multicast, sender=None):
+        return self._exchange.dispatch_many(qid, messages, multicast, sender)
+
+    def on_credit_spent(self, client):
+        self._exchange.on_credit_spent(client)
+
+    def on_credit(self, client):
+        self._exchange.on_credit(client)
 
 
 class Client(object):
     ''' Base client class. Messages are pushed from exchange to the Client
     '''
 
+    weight = 1 # used by WeightedStrategy
+    peer = False # stands for another broker, see Exchange
+    # takes no unicast message for now, the exchange is told with
+    # on_credit_spent and on_credit, see Exchange
+    out_of_credit = False
+
     def __init__(self):
         self.connected = False
 
@@ -115,8 +724,25 @@ class Client(object):
 
 
     def send(self, qid, message, multicast=True):
+        ''' returns the list of congested receivers, if any
+        '''
+        if self.connected:
+            return self._exchange.dispatch(qid, message, multicast)
+
+
+    def send_many(self, qid, messages, multicast=True):
         if self.connected:
-            self._exchange.dispatch(qid, message, multicast)
+            return self._exchange.dispatch_many(qid, messages, multicast)
+
+
+    def outstanding(self):
+        ''' number of messages delivered but not yet processed
+        '''
+        return 0
+
+
+    def outstanding_bytes(self):
+        return 0
 
 
     def on_connected(self):
@@ -131,16 +757,251 @@ class Client(object):
         pass
 
 
+    def on_unicast(self, qid, message):
+        ''' a message this client was picked for among the subscribers,
+            settled once on_message returns
+        '''
+        congested = self.on_message(qid, message)
+        if type(message) is not str:
+            settle = getattr(message, 'settle', None)
+            if settle is not None:
+                settle()
+        return congested
+
+
+
+class QueuedClient(Client):
+    ''' A Client whose on_message runs apart from Exchange.dispatch, so that
+        a slow handler holds up neither the producer nor the IOLoop. Any
+        Client subclass can switch to it: the on_message it defines becomes
+        handle_message and the exchange is given a queueing on_message.
+
+        Messages wait in a queue bounded by the connection wide watermarks
+        of limits (a QueueLimits, 10000 messages by default, the qid
+        watermarks do not apply), whose policy applies as to a Connection:
+        with PAUSE_PRODUCER a sender is paused through wait_drained.
+
+        They are handled by handler(batch), batch being a list of up to
+        batch_size (qid, message): on the IOLoop, for about budget seconds
+        per turn (batches shrink to fit it as handling slows down), or on
+        executor (anything with the submit of a concurrent.futures
+        executor), one batch at a time so that their order is kept. The
+        default handler, handle_batch, calls handle_message, on the threads
+        of a thread pool then. For a process pool, handler has to be a
+        picklable function. Its result is handed to on_batch_done on the
+        IOLoop.
+
+        Client stays the lowest latency choice, handling every message
+        synchronously within dispatch.
+    '''
+
+    def __init__(self, ioloop=None, limits=None, batch_size=256,
+            budget=0.005, executor=None, handler=None):
+        Client.__init__(self)
+        self._ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self._limits = limits or QueueLimits(high_messages=10000)
+        self._batch_size = batch_size
+        self._budget = budget
+        self._executor = executor
+        self._handler = handler or self.handle_batch
+        self._queue = deque() # (qid, message)
+        self._queued_bytes = 0
+        self._scheduled = False # a _drain is on its way
+        self._running = False # a batch is on the executor
+        self._cost = 0 # seconds per message of the last batch on the IOLoop
+        self._drain_waiters = []
+        self.dropped = 0
+        # dispatch reaches the queue, handle_batch the subclass on_message
+        self.handle_message = self.on_message
+        self.on_message = self._enqueue
+
+
+    def outstanding(self):
+        return len(self._queue)
+
+
+    def outstanding_bytes(self):
+        return self._queued_bytes
+
+
+    def stats(self):
+        return {
+            'address': 'local %s' % type(self).__name__,
+            'peer': self.peer,
+            'queued': len(self._queue),
+            'queued_bytes': self._queued_bytes,
+            'dropped': self.dropped,
+        }
+
+
+    def disconnect(self):
+        Client.disconnect(self)
+        self._notify_drained()
+
+
+    def wait_drained(self, callback):
+        ''' call callback once the queue falls back under the low
+            watermarks or the client disconnects
+        '''
+        self._drain_waiters.append(callback)
+
+
+    def _notify_drained(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for callback in waiters:
+            self._ioloop.add_callback(callback)
+
+
+    def _check_drained(self):
+        if self._drain_waiters and \
+                len(self._queue) <= self._limits.low_messages and \
+                self._queued_bytes <= self._limits.low_bytes:
+            self._notify_drained()
+
+
+    def _enqueue(self, qid, message):
+        ''' the on_message seen by the exchange, returns True when the
+            producer should pause
+        '''
+        if not self.connected:
+            return False
+        limits = self._limits
+        size = len(message)
+        over = len(self._queue) >= limits.high_messages or \
+                self._queued_bytes + size > limits.high_bytes
+        congested = False
+        if over:
+            if limits.policy == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            elif limits.policy == DISCONNECT:
+                logging.warning("disconnecting slow local client %r", self)
+                self.dropped += len(self._queue) + 1
+                self._queue.clear()
+                self._queued_bytes = 0
+                self.disconnect()
+                return False
+            elif limits.policy == PAUSE_PRODUCER:
+                congested = True
+
+        queue = self._queue
+        queue.append((qid, message))
+        self._queued_bytes += size
+        if over and limits.policy == DROP_OLDEST:
+            while len(queue) > 1 and (len(queue) > limits.high_messages or
+                    self._queued_bytes > limits.high_bytes):
+                self._queued_bytes -= len(queue.popleft()[1])
+                self.dropped += 1
+
+        if not self._scheduled and not self._running:
+            self._scheduled = True
+            self._ioloop.add_callback(self._drain)
+        return congested
+
+
+    def _take(self, n):
+        queue = self._queue
+        batch = []
+        size = 0
+        for i in xrange(min(len(queue), n)):
+            item = queue.popleft()
+            size += len(item[1])
+            batch.append(item)
+        self._queued_bytes -= size
+        return batch
+
+
+    def _drain(self):
+        self._scheduled = False
+        if self._executor is not None:
+            self._submit()
+            return
+        now = time.time()
+        deadline = now + self._budget
+        while self._queue:
+            # as many messages as the time left allows at the last cost
+            n = self._batch_size
+            if self._cost:
+                n = max(1, min(n, int((deadline - now) / self._cost)))
+            batch = self._take(n)
+            try:
+                result = self._handler(batch)
+            except Exception:
+                logging.error("error handling %d messages", len(batch),
+                        exc_info=True)
+            else:
+                self.on_batch_done(batch, result)
+            last, now = now, time.time()
+            self._cost = (now - last) / len(batch)
+            if now >= deadline:
+                break
+        if self._queue:
+            # let the other handlers of the IOLoop run in between
+            self._scheduled = True
+            self._ioloop.add_callback(self._drain)
+        self._check_drained()
+
+
+    def _submit(self):
+        if self._running or not self._queue:
+            return
+        batch = self._take(self._batch_size)
+        self._running = True
+        future = self._executor.submit(self._handler, batch)
+        # the future completes on a thread of the executor
+        future.add_done_callback(lambda future: self._ioloop.add_callback(
+                lambda: self._on_done(batch, future)))
+        self._check_drained()
+
+
+    def _on_done(self, batch, future):
+        self._running = False
+        try:
+            result = future.result()
+        except Exception:
+            logging.error("error handling %d messages", len(batch),
+                    exc_info=True)
+        else:
+            self.on_batch_done(batch, result)
+        self._submit()
+
+
+    def handle_batch(self, batch):
+        for qid, message in batch:
+            try:
+                self.handle_message(qid, message)
+            except Exception:
+                logging.error("error handling a message to %s", qid,
+                        exc_info=True)
+
+
+    def on_batch_done(self, batch, result):
+        ''' handler(batch) returned result
+        '''
+        pass
+
+
 
 
 
 class SocketAdapter(Adapter):
-    ''' Unix Socket Server Adapter for Exchange
+    ''' Unix Socket Server Adapter for Exchange.
+        A message delivered to a client in acknowledged mode (see OP_QOS)
+        and not acknowledged within ack_timeout seconds is delivered again,
+        the timeouts of all the connections share one TimingWheel.
+        The connections share their qids' socket time as told by
+        scheduling, a Scheduling.
     '''
 
-    def __init__(self, exchange, ioloop=None):
+    def __init__(self, exchange, ioloop=None, limits=None,
+            write_budget=65536, ack_timeout=None, scheduling=None):
         Adapter.__init__(self, exchange)
         self._ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self._limits = limits or QueueLimits()
+        self._write_budget = write_budget
+        self.ack_timeout = ack_timeout
+        self.scheduling = scheduling or Scheduling()
+        self.timers = TimingWheel(self._ioloop)
         self._socket = None
         self._started = False
 
@@ -151,6 +1012,20 @@ class SocketAdapter(Adapter):
 
     def start(self, address):
         self._bind(address)
+        self._start()
+
+
+    def start_socket(self, sock):
+        ''' accept connections on sock, already bound and listening, e.g.
+            a socket shared by several processes forked after binding it
+        '''
+        assert not self._socket
+        sock.setblocking(0)
+        self._socket = sock
+        self._start()
+
+
+    def _start(self):
         assert not self._started
         self._started = True
         self._ioloop.add_handler(self._socket.fileno(),
@@ -170,26 +1045,43 @@ class SocketAdapter(Adapter):
 
     def _handle_events(self, fd, events):
         try:
-            socket, address = self._socket.accept()
+            s, address = self._socket.accept()
         except socket.error as e:
+            # another process sharing the socket took the connection
             if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return
             raise
         try:
-            stream = IOStream(socket, io_loop=self._ioloop)
-            Connection(self, stream, address)
+            self._connection(self._stream(s), address)
         except:
             logging.error("Error happened when creating a connection",
                     exc_info=True)
 
 
+    def _stream(self, s):
+        return IOStream(s, io_loop=self._ioloop, metrics=self.metrics)
+
+
+    def _connection(self, stream, address):
+        return Connection(self, stream, address, self._limits,
+                self._write_budget)
+
+
 
 class TcpAdapter(SocketAdapter):
-    ''' a TCP Adapter for the Exchange
+    ''' a TCP Adapter for the Exchange.
+        With reuse_port, several processes can each bind the same address
+        and the kernel spreads the connections among them.
     '''
 
-    def __init__(self, exchange, ioloop=None):
-        SocketAdapter.__init__(self, exchange, ioloop)
+    def __init__(self, exchange, ioloop=None, limits=None,
+            write_budget=65536, reuse_port=False, ack_timeout=None,
+            scheduling=None):
+        SocketAdapter.__init__(self, exchange, ioloop, limits, write_budget,
+                ack_timeout, scheduling)
+        assert not reuse_port or SO_REUSEPORT is not None, \
+                "SO_REUSEPORT is not supported on this platform"
+        self._reuse_port = reuse_port
 
 
     def _bind(self, address):
@@ -199,6 +1091,8 @@ class TcpAdapter(SocketAdapter):
         flags |= fcntl.FD_CLOEXEC
         fcntl.fcntl(self._socket.fileno(), fcntl.F_SETFD, flags)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self._reuse_port:
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self._socket.setblocking(0)
         host, port = address
         self._socket.bind((host, port))
@@ -208,8 +1102,10 @@ class TcpAdapter(SocketAdapter):
 
 class IpcAdapter(SocketAdapter):
 
-    def __init__(self, exchange, ioloop=None):
-        SocketAdapter.__init__(self, exchange, ioloop)
+    def __init__(self, exchange, ioloop=None, limits=None,
+            write_budget=65536, ack_timeout=None, scheduling=None):
+        SocketAdapter.__init__(self, exchange, ioloop, limits, write_budget,
+                ack_timeout, scheduling)
 
 
     def _bind(self, address):
@@ -223,6 +1119,101 @@ class IpcAdapter(SocketAdapter):
         self._socket.bind(address)
         self._socket.listen(128)
 
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DISCONNECT = 'disconnect'
+PAUSE_PRODUCER = 'pause-producer'
+
+
+class QueueLimits(object):
+    ''' High/low watermarks for the outbound queues of a Connection, for
+        the whole connection and for each qid, counted in messages and in
+        bytes. None means unlimited; a low watermark defaults to half of the
+        high one.
+
+        policy tells what happens when a high watermark is crossed:
+        DROP_OLDEST and DROP_NEWEST discard messages, DISCONNECT closes the
+        slow consumer and PAUSE_PRODUCER stops reading from the sending
+        connections until the queue falls under the low watermarks.
+    '''
+
+    def __init__(self, high_messages=None, high_bytes=None,
+            low_messages=None, low_bytes=None,
+            qid_high_messages=None, qid_high_bytes=None,
+            qid_low_messages=None, qid_low_bytes=None,
+            policy=PAUSE_PRODUCER):
+        assert policy in (DROP_OLDEST, DROP_NEWEST, DISCONNECT, PAUSE_PRODUCER)
+        self.policy = policy
+        self.high_messages, self.low_messages = \
+                _watermarks(high_messages, low_messages)
+        self.high_bytes, self.low_bytes = _watermarks(high_bytes, low_bytes)
+        self.qid_high_messages, self.qid_low_messages = \
+                _watermarks(qid_high_messages, qid_low_messages)
+        self.qid_high_bytes, self.qid_low_bytes = \
+                _watermarks(qid_high_bytes, qid_low_bytes)
+
+
+def _watermarks(high, low):
+    if high is None:
+        return sys.maxint, sys.maxint
+    if low is None:
+        low = high / 2
+    assert low <= high
+    return high, low
+
+
+
+class Scheduling(object):
+    ''' How a Connection shares its socket among the qids it has messages
+        queued for. They are served by deficit round robin: each qid in
+        turn writes its messages, in order, while they fit in its deficit,
+        credited with quantum * weight bytes at the start of every turn, so
+        the qids get the socket in proportion to their weight, in bytes,
+        whatever the size of their messages. The qids of a higher priority
+        class go first, the lower classes only get what they leave.
+
+        set(qid, priority, weight) applies to a qid or to the qids matching
+        a Topic, exact qids first, then the first Topic set that matches.
+        The other qids have priority 0 and weight 1.
+    '''
+
+    def __init__(self, quantum=16384, cache_size=65536):
+        self.quantum = quantum
+        self._exact = {} # qid -> (priority, weight)
+        self._topics = [] # (Topic, priority, weight), in the order set
+        self._cache = {} # qid -> (priority, quantum)
+        self._cache_size = cache_size
+
+
+    def set(self, qid, priority=0, weight=1):
+        assert weight > 0
+        if isinstance(qid, Topic):
+            self._topics.append((qid, priority, weight))
+        else:
+            self._exact[qid] = (priority, weight)
+        self._cache.clear()
+
+
+    def classify(self, qid):
+        ''' (priority, quantum) of qid
+        '''
+        result = self._cache.get(qid)
+        if result is not None:
+            return result
+        priority, weight = self._exact.get(qid, (None, None))
+        if priority is None:
+            priority, weight = 0, 1
+            for topic, p, w in self._topics:
+                if topic.match(qid):
+                    priority, weight = p, w
+                    break
+        result = (priority, max(1, int(self.quantum * weight)))
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[qid] = result
+        return result
+
+
 
 OP_CONNECT = 0
 OP_CONNECTED = 1
@@ -231,147 +1222,1216 @@ OP_SUBSCRIBE = 3
 OP_UNSUBSCRIBE = 4
 OP_MESSAGE = 5
 OP_SEND = 6
+OP_BATCH = 7
+# extended op codes, only in extended headers
+OP_QOS = 8
+OP_DELIVER = 9
+OP_ACK = 10
+OP_NACK = 11
+
+# Handshake: the low 20 bits of OP_CONNECT carry the highest protocol
+# version the client speaks (bits 0-7) and optional features (bits 8-19),
+# OP_CONNECTED answers with the version and features the broker accepted.
+# Peers that predate versioning send and answer zero.
+# Version 1 adds extended headers, version 2 adds OP_BATCH, version 3 adds
+# acknowledged delivery of unicast messages: a client sends OP_QOS, its
+# payload a 32 bit prefetch count (0 for no limit), and then gets its
+# unicast messages in OP_DELIVER frames, the payload a 64 bit delivery tag
+# then the message, with the flag set for a redelivery. It answers with
+# OP_ACK, or OP_NACK with the flag set to have them delivered again, whose
+# payload is a list of 64 bit delivery tags.
+# Version 4 adds Topic subscriptions: OP_SUBSCRIBE and OP_UNSUBSCRIBE with
+# an extended header whose flags are FLAG_TOPIC, the qid being the filter.
+# Version 5 adds message deadlines: an OP_SEND frame with an extended
+# header whose flags have FLAG_DEADLINE set carries a 64 bit deadline, in
+# microseconds since the epoch, before the message. The broker drops the
+# message rather than deliver it after then, see Expiring.
+PROTOCOL_VERSION = 5
+
+# Feature bits. FEATURE_PEER: the client is another broker, the messages it
+# sends are only routed to non peer clients and the unicast messages it gets
+# have the OP_MESSAGE flag set.
+# FEATURE_ZLIB, FEATURE_LZ4 and FEATURE_ZSTD (see compression.py): the
+# codecs the client can use, the broker answers with the one both sides then
+# use, if any, from version 1 on. A frame whose payload is compressed has an
+# extended header with FLAG_COMPRESSED set in its flags, its payload the
+# compressed OP_SEND or OP_MESSAGE message or OP_BATCH body. Payloads under
+# compression.MIN_SIZE bytes, and the ones it does not make smaller, are
+# sent as they are. The broker compresses a large message once for all the
+# connections sharing a codec, see FrameCache.
+FEATURE_PEER = 1 << 8
+FEATURES = FEATURE_PEER | compression.FEATURES # supported by this side
+
+# Compact frame: op(3) flag(1) qid length(8) payload length(20).
+# From version 1 on, a compact header with an empty qid and a payload
+# length of EXTENDED is followed by an extended header holding the op code,
+# flags, a 32 bit qid length and a 64 bit payload length. The compact op of
+# an extended op code is OP_BATCH, never a handshake op.
+EXTENDED = 0xFFFFF
+FLAG_TOPIC = 2
+FLAG_DEADLINE = 4
+FLAG_COMPRESSED = 0x80
+
+# OP_BATCH carries several OP_SEND (to the broker) or OP_MESSAGE (from the
+# broker) records. Its payload is a sequence of compact frames, or, when the
+# flag is set, every record uses the qid of the batch frame and is a word
+# holding the multicast bit (31) and the payload length, then the payload.
+# Only payloads up to BATCH_RECORD_LIMIT bytes are batched.
+BATCH_RECORD_LIMIT = 0xFFFF
+
+_HEADER = struct.Struct('!I')
+_EXTENDED_HEADER = struct.Struct('!BBHIQ')
+_TAG = struct.Struct('!Q')
+_DEADLINE = struct.Struct('!Q')
+_MESSAGE_WORD = OP_MESSAGE << 29
+
+
+def frame_header(op, flag, qid_length, message_length, version=0):
+    ''' encode a frame header, the extended form is only used for the
+        extended op codes and when the compact one cannot hold the lengths
+        or the flags
+    '''
+    if op <= OP_BATCH and flag <= 1 and qid_length <= 0xFF and \
+            message_length <= 0xFFFFF and \
+            not (version and not qid_length and message_length == EXTENDED):
+        return _HEADER.pack((op << 29) | (flag << 28) | (qid_length << 20)
+                | message_length)
+    if not version:
+        raise ValueError("frame too large for a compact header "
+                "(qid %d bytes, payload %d bytes)" % (qid_length,
+                    message_length))
+    return _HEADER.pack((min(op, OP_BATCH) << 29) | ((flag & 1) << 28) |
+            EXTENDED) + \
+            _EXTENDED_HEADER.pack(op, flag, 0, qid_length, message_length)
+
+
+def extended_header(op, flags, qid_length, message_length):
+    ''' encode an extended frame header whatever the lengths, for the
+        flags a compact header cannot hold
+    '''
+    return _HEADER.pack((OP_BATCH << 29) | EXTENDED) + \
+            _EXTENDED_HEADER.pack(op, flags, 0, qid_length, message_length)
+
+
+def compress_frame(op, flag, qid, payload, codec, pieces):
+    ''' append the pieces of a frame of payload compressed with codec to
+        pieces, returns False, appending nothing, when compressing does not
+        make payload smaller
+    '''
+    data = codec.compress(payload)
+    if len(data) >= len(payload):
+        return False
+    pieces.append(extended_header(op, flag | FLAG_COMPRESSED, len(qid),
+        len(data)) + qid)
+    pieces.append(data)
+    return True
+
+
+
+def encode_frames(op, records, version, codec=None):
+    ''' encode (qid, message, flag) records as a list of string pieces,
+        runs of small records are packed in OP_BATCH frames when the peer
+        speaks protocol version 2, records with flags a batch cannot hold
+        (e.g. FLAG_DEADLINE) being framed on their own. Given the
+        negotiated codec, large messages and batches are compressed.
+    '''
+    pieces = []
+    run = []
+    for record in records:
+        qid, message, flag = record
+        if version >= 2 and flag <= 1 and len(qid) <= 0xFF and \
+                len(message) <= BATCH_RECORD_LIMIT:
+            run.append(record)
+            continue
+        if run:
+            _encode_run(op, run, version, pieces, codec)
+            run = []
+        if codec is not None and len(message) >= compression.MIN_SIZE and \
+                compress_frame(op, flag, qid, message, codec, pieces):
+            continue
+        pieces.append(frame_header(op, flag, len(qid), len(message),
+            version) + qid)
+        pieces.append(message)
+    if run:
+        _encode_run(op, run, version, pieces, codec)
+    return pieces
+
+
+def _encode_run(op, run, version, pieces, codec=None):
+    if len(run) == 1:
+        qid, message, flag = run[0]
+        if codec is not None and len(message) >= compression.MIN_SIZE and \
+                compress_frame(op, flag, qid, message, codec, pieces):
+            return
+        pieces.append(frame_header(op, flag, len(qid), len(message),
+            version) + qid + message)
+        return
+
+    qid = run[0][0]
+    body = []
+    if all(r[0] == qid for r in run):
+        for r_qid, message, flag in run:
+            body.append(_HEADER.pack((flag << 31) | len(message)))
+            body.append(message)
+    else:
+        qid = ''
+        for r_qid, message, flag in run:
+            body.append(frame_header(op, flag, len(r_qid), len(message)))
+            body.append(r_qid)
+            body.append(message)
+    body = ''.join(body)
+    if codec is not None and len(body) >= compression.MIN_SIZE and \
+            compress_frame(OP_BATCH, 1 if qid else 0, qid, body, codec,
+                pieces):
+        return
+    pieces.append(frame_header(OP_BATCH, 1 if qid else 0, len(qid),
+        len(body), version) + qid + body)
+
+
+class FrameCache(object):
+    ''' Encodes the OP_MESSAGE frame of the message being dispatched once.
+        Every Connection a multicast message is fanned out to queues the
+        same (qid, prefix, message, record) tuple, prefix being the frame
+        header and the qid and record the word introducing the message in a
+        shared-qid OP_BATCH frame, so queueing it costs a reference rather
+        than an encoding and a copy per subscriber.
+        The same goes for the compressed frame of a message of at least
+        compression.SHARED_SIZE bytes, made once per codec.
+    '''
+
+    def __init__(self):
+        self._qid = None
+        self._message = None
+        self._frame = None
+        self._compressed = {} # codec -> compressed frame of _message
+
+
+    def message_frame(self, qid, message, codec=None):
+        if message is not self._message or qid is not self._qid:
+            self._qid = qid
+            self._message = message
+            self._frame = _message_frame(qid, message, 0)
+            if self._compressed:
+                self._compressed = {}
+        if codec is None or len(message) < compression.SHARED_SIZE:
+            return self._frame
+        frame = self._compressed.get(codec)
+        if frame is None:
+            frame = self._compressed[codec] = \
+                    _compress_message_frame(self._frame, codec, 0)
+        return frame
+
+
+def _message_frame(qid, message, flag):
+    if len(qid) <= 0xFF and len(message) < EXTENDED:
+        prefix = _HEADER.pack(_MESSAGE_WORD | (flag << 28) |
+                (len(qid) << 20) | len(message)) + qid
+    else:
+        # only peers speaking version 1 and later can decode these
+        prefix = frame_header(OP_MESSAGE, flag, len(qid), len(message), 1) \
+                + qid
+    if len(message) <= BATCH_RECORD_LIMIT:
+        record = _HEADER.pack((flag << 31) | len(message))
+    else:
+        record = None
+    return (qid, prefix, message, record)
+
+
+def _compress_message_frame(frame, codec, flag):
+    ''' frame with its message compressed, or without its batch record
+        when compressing does not make the message smaller, so that batches
+        never hold data that will not shrink
+    '''
+    pieces = []
+    if not compress_frame(OP_MESSAGE, flag, frame[0], frame[2], codec,
+            pieces):
+        return frame[:3] + (None,)
+    return (frame[0], pieces[0], pieces[1], None)
+
+
+
+def encode_message_frames(frames, version, codec=None):
+    ''' turn frames from FrameCache into string pieces, runs of small
+        frames are packed in OP_BATCH frames for version 2 peers, which
+        are compressed given the negotiated codec
+    '''
+    pieces = []
+    run = []
+    for frame in frames:
+        qid, prefix, message, record = frame
+        if version >= 2 and record is not None and len(qid) <= 0xFF:
+            run.append(frame)
+            continue
+        if run:
+            _message_run(run, version, pieces, codec)
+            run = []
+        if not version and not qid and len(message) == EXTENDED:
+            # version 0 peers take the extended header sentinel for a
+            # compact header
+            prefix = frame_header(OP_MESSAGE, 0, 0, EXTENDED)
+        pieces.append(prefix)
+        pieces.append(message)
+    if run:
+        _message_run(run, version, pieces, codec)
+    return pieces
+
+
+def _message_run(run, version, pieces, codec=None):
+    if len(run) == 1:
+        pieces.append(run[0][1] + run[0][2])
+        return
+
+    qid = run[0][0]
+    body = []
+    if all(f[0] == qid for f in run):
+        for f in run:
+            body.append(f[3])
+            body.append(f[2])
+    else:
+        qid = ''
+        for f in run:
+            body.append(f[1])
+            body.append(f[2])
+    body = ''.join(body)
+    if codec is not None and len(body) >= compression.MIN_SIZE and \
+            compress_frame(OP_BATCH, 1 if qid else 0, qid, body, codec,
+                pieces):
+        return
+    pieces.append(frame_header(OP_BATCH, 1 if qid else 0, len(qid),
+        len(body), version) + qid + body)
+
+
+def write_pieces(stream, pieces, callback=None):
+    ''' write pieces to stream, joining the small ones in a single buffer
+        but writing the ones of at least write_chunk_size bytes on their own
+        instead of copying them. callback runs once all of it is written.
+    '''
+    large = stream.write_chunk_size
+    run = []
+    for piece in pieces:
+        if len(piece) >= large:
+            if run:
+                stream.write(''.join(run))
+                run = []
+            stream.write(piece)
+        else:
+            run.append(piece)
+    stream.write(''.join(run), callback)
+
+
+
+class FrameDecoder(object):
+    ''' Parses every complete frame in an IOStream read buffer in one pass
+        and calls handler(op, flag, qid, payload) for each of them in order.
+        Parsing stops early when the stream is paused or closed by a
+        handler, the remaining frames are parsed once reading resumes.
+        The payload of OP_CONNECT and OP_CONNECTED is the handshake word.
+        Extended headers are recognized once version is set to the
+        negotiated protocol version, compressed payloads once codec is set
+        to the negotiated codec.
+    '''
+
+    def __init__(self, stream, handler):
+        self._stream = stream
+        self._handler = handler
+        self.version = 0
+        self.codec = None
+        stream.read_frames(self)
+
+
+    def __call__(self, buf, start, end):
+        offset = start
+        stream = self._stream
+        handler = self._handler
+        while end - offset >= 4 and stream.reading() and not stream.closed():
+            header, = _HEADER.unpack_from(buf, offset)
+            op = header >> 29
+            flag = (header & 0x10000000) >> 28
+            qid_length = (header & 0x0FF00000) >> 20
+            message_length = header & 0x000FFFFF
+            p = offset + 4
+            if op <= OP_CONNECTED:
+                offset = p
+                handler(op, flag, '', header & 0x000FFFFF)
+                continue
+            if self.version and not qid_length and message_length == EXTENDED:
+                if end - p < _EXTENDED_HEADER.size:
+                    break
+                op, flag, _, qid_length, message_length = \
+                        _EXTENDED_HEADER.unpack_from(buf, p)
+                p += _EXTENDED_HEADER.size
+            q = p + qid_length
+            frame_end = q + message_length
+            if frame_end > end:
+                break
+            qid = str(buffer(buf, p, qid_length)) if qid_length else ''
+            if flag & FLAG_COMPRESSED:
+                payload = self._decompress(buffer(buf, q, message_length))
+                if payload is None:
+                    break
+                flag &= ~FLAG_COMPRESSED
+                if op == OP_BATCH:
+                    payload = self._records(payload, 0, len(payload), flag,
+                            qid)
+            elif op == OP_BATCH:
+                payload = self._records(buf, q, frame_end, flag, qid)
+            else:
+                payload = str(buffer(buf, q, message_length)) \
+                        if message_length else ''
+            offset = frame_end
+            handler(op, flag, qid, payload)
+        return offset - start
+
+
+    def _decompress(self, data):
+        ''' the payload of a compressed frame, None when it cannot be
+            decompressed, the stream is closed then
+        '''
+        try:
+            if self.codec is None:
+                raise ValueError("no codec was negotiated")
+            return self.codec.decompress(data, self._stream.max_buffer_size)
+        except ValueError, e:
+            logging.warning("closing the stream on a bad compressed "
+                    "frame: %s", e)
+            self._stream.close()
+            return None
+
+
+    def _records(self, buf, offset, end, shared, qid):
+        ''' decode the body of an OP_BATCH frame as (qid, payload, flag)
+            records
+        '''
+        records = []
+        while offset < end:
+            header, = _HEADER.unpack_from(buf, offset)
+            offset += 4
+            if shared:
+                flag = header >> 31
+            else:
+                flag = (header & 0x10000000) >> 28
+                qid_length = (header & 0x0FF00000) >> 20
+                qid = str(buffer(buf, offset, qid_length))
+                offset += qid_length
+            length = header & (0x7FFFFFFF if shared else 0x000FFFFF)
+            records.append((qid, str(buffer(buf, offset, length)), flag))
+            offset += length
+        return records
+
+
+class _Stamped(tuple):
+    ''' a queued frame with more to it: the time it was queued at when
+        sampled by the metrics, the deadline of its message, the tag of
+        an OP_DELIVER frame and the message to settle once written
+    '''
+
+    queued = None
+    deadline = None
+    tag = None
+    message = None
+
+
+
+class Expiring(str):
+    ''' a message dropped rather than delivered after deadline, in seconds
+        since the epoch: a Connection checks it when queueing the message
+        and when taking it out of its queue to write it, and sweeps its
+        queues for the expired ones from time to time. Expiring.ttl makes
+        one from a time to live, in seconds.
+    '''
+
+    def __new__(cls, message, deadline):
+        self = str.__new__(cls, message)
+        self.deadline = deadline
+        return self
+
+
+    @classmethod
+    def ttl(cls, message, ttl):
+        return cls(message, time.time() + ttl)
+
+
+
+class Redelivery(str):
+    ''' a message delivered again, because its consumer went away, rejected
+        it or did not acknowledge it in time
+    '''
+
+    deadline = None
+    settle = None
+
+
+def _redelivery(message):
+    ''' message as a Redelivery, keeping its deadline and settle
+    '''
+    redelivery = Redelivery(message)
+    deadline = getattr(message, 'deadline', None)
+    if deadline is not None:
+        redelivery.deadline = deadline
+    settle = getattr(message, 'settle', None)
+    if settle is not None:
+        redelivery.settle = settle
+    return redelivery
+
+
+def _settled(message):
+    ''' call the settle of a unicast message, if it has one: the client it
+        was handed to is done with it, see DurableQueue
+    '''
+    settle = None if type(message) is str else \
+            getattr(message, 'settle', None)
+    if settle is not None:
+        settle()
+
 
 
 class Connection(Client):
     ''' Connection handler for the TCP and IPC client.
         It acts like "Client" on behalf of the connected TCP/IPC Client with the
         exchange server associated with the Adapter
+
+        Once the client sent OP_QOS, its unicast messages are delivered in
+        OP_DELIVER frames and kept until acknowledged. It is out_of_credit
+        while prefetch of them are unacknowledged. The unacknowledged
+        messages are handed back to the exchange when rejected with requeue,
+        after the ack timeout of the adapter and when the connection closes.
+        A delivery the queue limits drop is handed back right away, and the
+        connection is out_of_credit until its queues drained.
+
+        Messages with a deadline (see Expiring) are dropped once it passed,
+        when queued and when taken out of their queue. While some are
+        queued, the queues are also swept for them by their deadlines, at
+        most once every sweep_interval seconds, so that the ones a stalled
+        consumer does not read do not hold memory. An expired delivery
+        counts as acknowledged.
+
+        A unicast message with a settle (see DurableQueue) is settled once
+        acknowledged, or written to the socket without OP_QOS, and when
+        dropped or expired. The ones still queued, or being written, when
+        the connection closes are handed back to the exchange instead.
     '''
 
-    def __init__(self, exchange, stream, address):
+    sweep_interval = 1.0
+
+    def __init__(self, exchange, stream, address, limits=None,
+            write_budget=65536):
         Client.__init__(self)
         self._exchange = exchange
         self._stream = stream
         self._address = address
+        self._limits = limits or QueueLimits()
+        self._write_budget = write_budget # bytes packed into one write
         self._is_connected = False
-        self._stream.read_bytes(4, self._on_header)
+        self._version = 0 # negotiated protocol version
+        self._codec = None # negotiated compression codec
+        self._decoder = FrameDecoder(stream, self._on_frame)
         self._stream.set_close_callback(self._on_close)
-        self._mq = defaultdict(deque) #one queue for each qid
-        self._fq = deque()  #fair queue of mq
+        self._frames = exchange.frames
+        self._mq = defaultdict(deque) #one queue for each qid, of frames
+        self._scheduling = exchange.scheduling
+        # priority -> deque of [qid, queue, deficit, quantum] of the qids
+        # with messages queued, in round robin order, see _recv
+        self._classes = {}
+        self._top = None # highest priority in _classes
+        self._turn = None # entry whose turn is running
         self._recving = False
+        self._settles = False # queued frames with a message to settle
+        self._writing = None # frames whose message to settle once written
+        self._queued = 0 # messages in _mq
+        self._queued_bytes = 0
+        self._mq_bytes = defaultdict(int) # qid -> bytes in _mq[qid]
+        self._congested_qids = set()
+        self._drain_waiters = [] # producers paused on this connection
+        self._waiting_for = 0 # congested receivers this connection waits for
+        self.dropped = 0
+        self.expired = 0
+        self._expiring_qids = set() # qids with messages having a deadline
+        self._sweep_timer = None
+        self._prefetch = None # None until OP_QOS, 0 for no limit
+        self._unacked = {} # delivery tag -> (qid, message, timer)
+        self._last_tag = 0
+        self._refusing = False # dropped a delivery, no credit until drained
+        self._timers = exchange.timers
+        self._ack_timeout = exchange.ack_timeout
+        self._metrics = exchange.metrics
+        limits = self._limits
+        # no watermark and no metrics, see on_message
+        self._plain = self._metrics is None and sys.maxint == \
+                limits.high_messages == limits.high_bytes == \
+                limits.qid_high_messages == limits.qid_high_bytes
+        self._max_size = stream.max_buffer_size
+
+
+    def outstanding(self):
+        return self._queued
+
+
+    def outstanding_bytes(self):
+        return self._queued_bytes
+
+
+    def stats(self):
+        ''' the state of the outbound queues, see metrics.Metrics
+        '''
+        return {
+            'address': str(self._address),
+            'peer': self.peer,
+            'queued': self._queued,
+            'queued_bytes': self._queued_bytes,
+            'qids': len(self._mq),
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'unacked': len(self._unacked),
+        }
 
 
     def _on_close(self):
+        exchange = self._exchange
         self.disconnect()
+        if self._sweep_timer is not None:
+            self._timers.remove(self._sweep_timer)
+            self._sweep_timer = None
+        unacked, self._unacked = self._unacked, {}
+        for tag in sorted(unacked):
+            qid, message, timer = unacked[tag]
+            if timer is not None:
+                self._timers.remove(timer)
+            exchange.dispatch(qid, _redelivery(message), False)
+        if self._settles:
+            unsent = self._writing or []
+            self._writing = None
+            for q in self._mq.itervalues():
+                unsent.extend(frame for frame in q
+                        if type(frame) is _Stamped and
+                        frame.message is not None)
+            for frame in unsent:
+                exchange.dispatch(frame[0], _redelivery(frame.message),
+                        False)
+        self._notify_drained()
+
+
+    def wait_drained(self, callback):
+        ''' call callback once this connection falls back under its low
+            watermarks or goes away
+        '''
+        self._drain_waiters.append(callback)
 
 
-    def on_message(self, qid, message):
-        ''' receive message from exchange and send it down to the client
+    def _notify_drained(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for callback in waiters:
+            self._stream.io_loop.add_callback(callback)
+
+
+    def _pause(self, congested):
+        ''' stop reading frames until every congested receiver drained
         '''
+        self._waiting_for = len(congested)
+        self._stream.pause_reading()
+        for c in congested:
+            c.wait_drained(self._on_receiver_drained)
+
+
+    def _on_receiver_drained(self):
+        self._waiting_for -= 1
+        if self._waiting_for == 0:
+            self._stream.resume_reading()
+
+
+    def on_message(self, qid, message, frame=None):
+        ''' receive message from exchange and send it down to the client.
+            Returns True when the producer should pause.
+            A plain message, without deadline or settle, to a connection
+            without queue limits nor metrics only needs queueing, which
+            takes the first branch.
+        '''
+        if self._plain and type(message) is str and self._version and \
+                len(message) <= self._max_size:
+            if frame is None:
+                frame = self._frames.message_frame(qid, message, self._codec)
+            size = len(frame[2])
+            q = self._mq[qid]
+            q.append(frame)
+            self._queued += 1
+            self._queued_bytes += size
+            self._mq_bytes[qid] += size
+            if len(q) == 1:
+                self._activate(qid, q)
+                if not self._recving:
+                    self._recving = True
+                    self._stream.io_loop.add_callback(self._recv)
+            return False
         assert len(message) <= self._stream.max_buffer_size, \
             "message is too large (%d) for iostream to handle (%d)"  % \
             (len(message), self._stream.max_buffer_size)
+        if not self._version and (len(message) > 0xFFFFF or len(qid) > 0xFF):
+            logging.warning("dropping %d bytes message on %s, %s speaks the "
+                    "compact protocol only", len(message), qid, self._address)
+            self.dropped += 1
+            _settled(message)
+            return False
+        if type(message) is str:
+            deadline = settle = None
+        else:
+            deadline = getattr(message, 'deadline', None)
+            # a delivery is settled once acknowledged, see _settle
+            settle = getattr(message, 'settle', None) if \
+                    type(frame) is not _Stamped or frame.tag is None else None
+        if deadline is not None and deadline <= time.time():
+            self._expire(qid, None)
+            if settle is not None:
+                settle()
+            return False
+        if frame is None:
+            frame = self._frames.message_frame(qid, message, self._codec)
+        # queued bytes are counted as sent, after compression
+        size = len(frame[2])
+        limits = self._limits
+        over_qid = len(self._mq.get(qid, ())) >= limits.qid_high_messages or \
+                self._mq_bytes.get(qid, 0) + size > limits.qid_high_bytes
+        over = over_qid or self._queued >= limits.high_messages or \
+                self._queued_bytes + size > limits.high_bytes
+
+        congested = False
+        if over:
+            if limits.policy == DROP_NEWEST:
+                self.dropped += 1
+                if type(frame) is _Stamped and frame.tag is not None:
+                    self._give_back([frame.tag], over_qid and qid)
+                elif settle is not None:
+                    settle()
+                return False
+            elif limits.policy == DISCONNECT:
+                logging.warning("disconnecting slow consumer %s",
+                        self._address)
+                self._stream.close()
+                if settle is not None:
+                    settle()
+                return False
+            elif limits.policy == PAUSE_PRODUCER:
+                if over_qid:
+                    self._congested_qids.add(qid)
+                congested = True
+
+        if deadline is not None:
+            if type(frame) is not _Stamped:
+                frame = _Stamped(frame)
+            frame.deadline = deadline
+            self._expiring_qids.add(qid)
+            if self._sweep_timer is None:
+                self._schedule_sweep(deadline)
+        if settle is not None:
+            if type(frame) is not _Stamped:
+                frame = _Stamped(frame)
+            frame.message = message
+            self._settles = True
+        if self._metrics is not None and self._metrics.sample():
+            if type(frame) is not _Stamped:
+                frame = _Stamped(frame)
+            frame.queued = time.time()
         q = self._mq[qid]
-        q.append(message)
+        q.append(frame)
+        self._queued += 1
+        self._queued_bytes += size
+        self._mq_bytes[qid] += size
         if len(q) == 1:
-            self._fq.append((qid,q))
+            self._activate(qid, q)
+
+        if over and limits.policy == DROP_OLDEST:
+            tags = []
+            while len(q) > 1 and (len(q) > limits.qid_high_messages or
+                    self._mq_bytes[qid] > limits.qid_high_bytes or
+                    self._queued > limits.high_messages or
+                    self._queued_bytes > limits.high_bytes):
+                dropped = q.popleft()
+                x = dropped[2]
+                self._queued -= 1
+                self._queued_bytes -= len(x)
+                self._mq_bytes[qid] -= len(x)
+                self.dropped += 1
+                if type(dropped) is _Stamped:
+                    if dropped.tag is not None:
+                        tags.append(dropped.tag)
+                    elif dropped.message is not None:
+                        _settled(dropped.message)
+            if tags:
+                self._give_back(tags, over_qid and qid)
 
         if not self._recving:
+            self._recving = True
             self._stream.io_loop.add_callback(self._recv)
+        return congested
+
+
+    def _activate(self, qid, q):
+        ''' qid has messages to send again
+        '''
+        priority, quantum = self._scheduling.classify(qid)
+        active = self._classes.get(priority)
+        if active is None:
+            active = self._classes[priority] = deque()
+            if self._top is None or priority > self._top:
+                self._top = priority
+        active.append([qid, q, 0, quantum])
+
+
+    def on_unicast(self, qid, message):
+        ''' a peer broker is told the message is unicast by the frame flag,
+            so that it picks only one of its own subscribers
+        '''
+        if self._prefetch is not None:
+            return self._deliver(qid, message)
+        if self.peer:
+            frame = _message_frame(qid, message, 1)
+            if self._codec is not None and \
+                    len(message) >= compression.SHARED_SIZE:
+                frame = _compress_message_frame(frame, self._codec, 1)
+            return self.on_message(qid, message, frame)
+        return self.on_message(qid, message)
+
+
+    def _deliver(self, qid, message):
+        ''' send message in an OP_DELIVER frame and keep it until it is
+            acknowledged. An expired delivery is not delivered again.
+        '''
+        deadline = None if type(message) is str else \
+                getattr(message, 'deadline', None)
+        if deadline is not None and deadline <= time.time():
+            self._expire(qid, None)
+            return False
+        self._last_tag += 1
+        tag = self._last_tag
+        timer = None
+        if self._ack_timeout:
+            timer = self._timers.add(self._ack_timeout, self._on_ack_timeout,
+                    tag)
+        self._unacked[tag] = (qid, message, timer)
+        if self._prefetch and len(self._unacked) >= self._prefetch:
+            self._spend_credit()
+        prefix = frame_header(OP_DELIVER, int(type(message) is Redelivery),
+                len(qid), _TAG.size + len(message), self._version) + qid + \
+                _TAG.pack(tag)
+        # tagged to settle it, should it expire or be dropped in the queue
+        frame = _Stamped((qid, prefix, message, None))
+        frame.tag = tag
+        return self.on_message(qid, message, frame)
+
+
+    def _give_back(self, tags, qid):
+        ''' hand the deliveries the queue limits dropped back to the
+            exchange, for another subscriber to take, and refuse unicast
+            messages until the queues drained, those of qid too unless it
+            is None
+        '''
+        self._refusing = True
+        if qid:
+            self._congested_qids.add(qid)
+        self._spend_credit()
+        for tag in tags:
+            entry = self._unacked.pop(tag, None)
+            if entry is None:
+                # timed out already
+                continue
+            qid, message, timer = entry
+            if timer is not None:
+                self._timers.remove(timer)
+            self.send(qid, message, False)
+
+
+    def _spend_credit(self):
+        if not self.out_of_credit:
+            self.out_of_credit = True
+            if self.connected:
+                self._exchange.on_credit_spent(self)
+
+
+    def _settle(self, payload, requeue):
+        ''' acknowledge, or reject, the deliveries whose tags are listed in
+            payload. Unknown tags were already delivered again.
+        '''
+        if len(payload) % _TAG.size:
+            raise ValueError("ACK/NACK frame of %d bytes is not a list of "
+                    "tags" % len(payload))
+        tags = struct.unpack('!%dQ' % (len(payload) / _TAG.size), payload)
+        for tag in tags:
+            entry = self._unacked.pop(tag, None)
+            if entry is None:
+                continue
+            qid, message, timer = entry
+            if timer is not None:
+                self._timers.remove(timer)
+            if requeue:
+                self.send(qid, _redelivery(message), False)
+            else:
+                _settled(message)
+        self._check_credit()
+
+
+    def _on_ack_timeout(self, tag):
+        qid, message, timer = self._unacked.pop(tag)
+        logging.debug("delivery %d on %s to %s timed out", tag, qid,
+                self._address)
+        self.send(qid, _redelivery(message), False)
+        self._check_credit()
+
+
+    def _check_credit(self):
+        if self.out_of_credit and not self._refusing and \
+                (not self._prefetch or len(self._unacked) < self._prefetch):
+            self.out_of_credit = False
+            if self.connected:
+                self._exchange.on_credit(self)
 
 
     def _recv(self):
-        try:
-            qid, q = self._fq.pop()
-        except IndexError:
-            assert False, "fq is empty and this should not happen"
-        self._recving = True
-        def on_send_complete():
-            if len(q) > 0:
-                self._fq.append( (qid, q))
+        ''' pack as many queued messages as fit in the write budget into a
+            single write, the next batch is started once it has been handed
+            to the socket.
+            The messages are taken by deficit round robin among the qids of
+            the highest priority class, see Scheduling. A qid is in
+            _classes exactly when its queue is not empty, the one at the
+            left of its class deque being served. Expired messages are
+            dropped on the way, and the messages written last settled.
+        '''
+        if self._writing:
+            writing, self._writing = self._writing, None
+            for frame in writing:
+                frame.message.settle()
+        frames = []
+        total = 0
+        budget = self._write_budget
+        classes = self._classes
+        now = time.time()
+        expired = False
+        while classes:
+            active = classes[self._top]
+            entry = active[0]
+            if self._turn is not entry:
+                self._turn = entry
+                entry[2] += entry[3]
+            qid, q = entry[0], entry[1]
+            frame = q[0]
+            x = frame[2]
+            if type(frame) is _Stamped and frame.deadline is not None and \
+                    frame.deadline <= now:
+                q.popleft()
+                self._expire(qid, frame)
+                expired = True
             else:
+                size = 16 + len(frame[1]) + len(x)
+                if size > entry[2]:
+                    # the deficit left is kept for its next turn
+                    active.rotate(-1)
+                    self._turn = None
+                    continue
+                if frames and total + size > budget:
+                    break
+                entry[2] -= size
+                frames.append(q.popleft())
+                total += size
+            self._queued -= 1
+            self._queued_bytes -= len(x)
+            self._mq_bytes[qid] -= len(x)
+            if self._drain_waiters or self._refusing:
+                self._check_drained(qid, q)
+            if not q:
+                active.popleft()
+                self._turn = None
                 del self._mq[qid]
-            if len(self._fq) > 0:
-                self._stream.io_loop.add_callback(self._recv)
-            else:
-                self._recving = False
-        x = q.pop()
-        header = (OP_MESSAGE << 29) | (len(qid) << 20) | len(x)
-        try:
-            self._stream.write(struct.pack('!I', header))
-            self._stream.write(qid)
-            self._stream.write(x, on_send_complete)
-        except IOError:
-            self._stream.close()
+                del self._mq_bytes[qid]
+                if not active:
+                    del classes[self._top]
+                    self._top = max(classes) if classes else None
+
+        if not frames:
+            self._recving = False
+        else:
+            self._recving = True
+            if self._settles:
+                self._writing = [frame for frame in frames
+                        if type(frame) is _Stamped and
+                        frame.message is not None]
+            callback = self._recv
+            if self._metrics is not None:
+                callback = self._measure(frames)
+            try:
+                write_pieces(self._stream, encode_message_frames(frames,
+                    self._version, self._codec), callback)
+            except IOError:
+                self._stream.close()
+        if expired or self.out_of_credit:
+            # once _recving is right, crediting may queue more messages
+            self._check_credit()
 
 
-    def _on_header(self, header):
-        header,  = struct.unpack('!I', header)
-        op = header >> 29
+    def _expire(self, qid, frame):
+        ''' count an expired message to qid, settling its delivery when
+            frame is that of one. The caller checks the credit once done.
+        '''
+        self.expired += 1
+        if self._metrics is not None:
+            self._metrics.count_expired(qid, 1)
+        if frame is None:
+            return
+        if frame.tag is not None:
+            entry = self._unacked.pop(frame.tag, None)
+            if entry is not None:
+                if entry[2] is not None:
+                    self._timers.remove(entry[2])
+                _settled(entry[1])
+        elif frame.message is not None:
+            _settled(frame.message)
+
+
+    def _schedule_sweep(self, deadline):
+        self._sweep_timer = self._timers.add(max(deadline - time.time(),
+            self.sweep_interval), self._sweep)
+
+
+    def _sweep(self):
+        ''' drop the expired messages of every queue, wherever they are in
+            it, and sweep again by the next deadline
+        '''
+        self._sweep_timer = None
+        now = time.time()
+        earliest = None
+        expired = False
+        for qid in list(self._expiring_qids):
+            q = self._mq.get(qid)
+            kept = []
+            next_deadline = None
+            for frame in q or ():
+                deadline = frame.deadline if type(frame) is _Stamped \
+                        else None
+                if deadline is None or deadline > now:
+                    kept.append(frame)
+                    if deadline is not None and (next_deadline is None or
+                            deadline < next_deadline):
+                        next_deadline = deadline
+                    continue
+                size = len(frame[2])
+                self._queued -= 1
+                self._queued_bytes -= size
+                self._mq_bytes[qid] -= size
+                self._expire(qid, frame)
+            if next_deadline is None:
+                self._expiring_qids.discard(qid)
+            elif earliest is None or next_deadline < earliest:
+                earliest = next_deadline
+            if q is None or len(kept) == len(q):
+                continue
+            expired = True
+            q.clear()
+            q.extend(kept)
+            if self._drain_waiters or self._refusing:
+                self._check_drained(qid, q)
+            if not q:
+                self._retire(qid, q)
+        if earliest is not None:
+            self._schedule_sweep(earliest)
+        if expired:
+            self._check_credit()
+
+
+    def _retire(self, qid, q):
+        ''' forget qid, whose queue q was emptied out of _recv
+        '''
+        del self._mq[qid]
+        del self._mq_bytes[qid]
+        classes = self._classes
+        for priority, active in classes.iteritems():
+            for i, entry in enumerate(active):
+                if entry[1] is q:
+                    del active[i]
+                    if entry is self._turn:
+                        self._turn = None
+                    if not active:
+                        del classes[priority]
+                        self._top = max(classes) if classes else None
+                    return
+
+
+    def _measure(self, frames):
+        ''' count the frames going out, returns the write callback, which
+            also records the delivery latency of the sampled frames
+        '''
+        metrics = self._metrics
+        stamps = []
+        for frame in frames:
+            metrics.count_out(frame[0], 1, len(frame[2]))
+            if type(frame) is _Stamped and frame.queued is not None:
+                stamps.append((frame[0], frame.queued))
+        if not stamps:
+            return self._recv
+
+        def written():
+            metrics.delivered(stamps)
+            self._recv()
+        return written
+
+
+    def _send_batch(self, records):
+        ''' route the records of an OP_BATCH frame, with one exchange call
+            per run of records sharing the same qid and multicast flag
+        '''
+        congested = set()
+        i = 0
+        n = len(records)
+        while i < n:
+            qid, message, multicast = records[i]
+            j = i + 1
+            while j < n and records[j][0] == qid and \
+                    records[j][2] == multicast:
+                j += 1
+            c = self.send_many(qid, [r[1] for r in records[i:j]], multicast)
+            if c:
+                congested.update(c)
+            i = j
+        if congested:
+            self._pause(list(congested))
+
+
+    def _expiring(self, qid, payload):
+        ''' the Expiring message of an OP_SEND frame with a deadline, None
+            when it passed already
+        '''
+        if len(payload) < _DEADLINE.size:
+            raise ValueError("OP_SEND frame too short for its deadline")
+        deadline = _DEADLINE.unpack_from(payload)[0] / 1e6
+        if deadline <= time.time():
+            if self._metrics is not None:
+                self._metrics.count_expired(qid, 1)
+            return None
+        return Expiring(buffer(payload, _DEADLINE.size), deadline)
+
+
+    def _check_drained(self, qid, q):
+        limits = self._limits
+        if qid in self._congested_qids and \
+                len(q) <= limits.qid_low_messages and \
+                self._mq_bytes[qid] <= limits.qid_low_bytes:
+            self._congested_qids.discard(qid)
+        if not self._congested_qids and \
+                self._queued <= limits.low_messages and \
+                self._queued_bytes <= limits.low_bytes:
+            self._refusing = False
+            self._notify_drained()
+
+
+    def _on_frame(self, op, flag, qid, payload):
         try:
             if op == OP_CONNECT:
-                self._stream.write(struct.pack('!I', (OP_CONNECTED << 29)))
+                if self.connected:
+                    raise ValueError("CONNECT frame on a connected stream")
+                self._version = min(payload & 0xFF, PROTOCOL_VERSION)
+                self._decoder.version = self._version
+                features = payload & FEATURES
+                self.peer = bool(features & FEATURE_PEER)
+                # one codec at most, extended headers carry its flag
+                codec = compression.choose(features) if self._version \
+                        else None
+                features &= ~compression.FEATURES
+                if codec is not None:
+                    features |= codec.feature
+                self._codec = self._decoder.codec = codec
+                self._stream.write(_HEADER.pack((OP_CONNECTED << 29) |
+                    features | self._version))
                 self.connect(self._exchange)
-                self._stream.read_bytes(4, self._on_header)
             elif op == OP_DISCONNECT:
                 self._stream.close()
             elif op == OP_SUBSCRIBE:
-                x = (header & 0x10000000) >> 28
-                qid_length = (header & 0x0FF00000) >> 20
-                message_length = header & 0x000FFFFF
-                assert message_length == 0, "SUBSCRIBE frame contains non zero payload"
-                def subscribe(qid):
-                    qid = re.compile(qid) if x else qid
-                    self.subscribe(qid)
-                    self._stream.read_bytes(4, self._on_header)
-                self._stream.read_bytes(qid_length, subscribe)
+                if payload:
+                    raise ValueError("SUBSCRIBE frame contains non zero "
+                            "payload")
+                self.subscribe(_subscription(qid, flag))
             elif op == OP_UNSUBSCRIBE:
-                x = (header & 0x10000000) >> 28
-                qid_length = (header & 0x0FF00000) >> 20
-                message_length = header & 0x000FFFFF
-                assert message_length==0, "UNSUBSCRIBE frame contains non zero payload"
-                def unsubscribe(qid):
-                    qid = re.compile(qid) if x else qid
-                    self.unsubscribe(qid)
-                    self._stream.read_bytes(4, self._on_header)
-                self._stream.read_bytes(qid_length, unsubscribe)
-
+                if payload:
+                    raise ValueError("UNSUBSCRIBE frame contains non zero "
+                            "payload")
+                self.unsubscribe(_subscription(qid, flag))
             elif op == OP_SEND:
-                multicast = (header & 0x10000000) >> 28
-                qid_length = (header & 0x0FF00000) >> 20
-                message_length = header & 0x000FFFFF
-
-                def _send(qid, message):
-                    self.send(qid, message, multicast)
-
-                    def on_header():
-                        try:
-                            self._stream.read_bytes(4, self._on_header)
-                        except IOError:
-                            self._stream.close()
-                    #need to wrap it in callback otherwise risk of infinite recursion
-                    self._stream.io_loop.add_callback(functools.partial(on_header))
-
-                def on_qid(qid):
-                    if message_length > 0 :
-                        try:
-                            self._stream.read_bytes(message_length,
-                                    functools.partial(_send, qid))
-                        except IOError:
-                            self._stream.close()
-                    else:
-                        self._stream.io_loop.add_callback(
-                                functools.partial(_send, qid, ''))
-                if qid_length>0:
-                    self._stream.read_bytes(qid_length, on_qid)
-                else:
-                    on_qid('')
+                if flag & FLAG_DEADLINE:
+                    payload = self._expiring(qid, payload)
+                    if payload is None:
+                        return
+                congested = self.send(qid, payload, flag & 1)
+                if congested:
+                    self._pause(congested)
+            elif op == OP_BATCH:
+                self._send_batch(payload)
+            elif op == OP_QOS:
+                if len(payload) != _HEADER.size:
+                    raise ValueError("QOS frame of %d bytes" % len(payload))
+                self._prefetch, = _HEADER.unpack(payload)
+                self._spend_credit()
+                self._check_credit()
+            elif op == OP_ACK:
+                self._settle(payload, False)
+            elif op == OP_NACK:
+                self._settle(payload, flag)
         except IOError:
             self._stream.close()
+        except (ValueError, re.error), e:
+            logging.warning("closing %s after a bad frame: %s", self._address,
+                    e)
+            self._stream.close()
 
 
 
 class SocketClient(Client):
     ''' An implementation of Unix Socket Client
+
+        Sends are written to the stream right away unless batch_size is
+        given: frames are then accumulated and written as one buffer once
+        batch_size bytes are pending, after linger seconds (on the next
+        IOLoop turn when linger is None) or when flush() is called.
+
+        request_features are asked for in the handshake, features holds the
+        ones the broker accepted once connected. Requesting compression
+        codecs, e.g. compression.FEATURES, has the large payloads compressed
+        both ways with the one the broker picked.
+
+        A message sent with a ttl or a deadline, or as an Expiring, is
+        dropped by the broker rather than delivered after its deadline, from
+        protocol version 5 on. Older brokers deliver it whenever they can.
+
+        After qos(prefetch), unicast messages come through on_delivery and
+        have to be acknowledged with ack(tag) or rejected with nack(tag).
+        Acknowledgements are sent together once per IOLoop turn.
+
+        Like the rest of it, send and send_many may only be called on the
+        IOLoop thread, send_threadsafe and send_many_threadsafe from any
+        other thread: the messages are queued and the IOLoop, woken up once for
+        all those queued meanwhile, writes them in bulk. It only moves
+        producer_limits.high_bytes (a QueueLimits) of them at a time to the
+        stream, the threads then block while more than the high watermarks
+        are queued, until the IOLoop takes them back under the low ones.
     '''
 
-    def __init__(self, ioloop):
+    request_features = 0
+
+    def __init__(self, ioloop, batch_size=None, linger=None):
         Client.__init__(self)
         self._ioloop = ioloop or tornado.ioloop.IOLoop.instance()
         self._stream = None
         self.connected = False
-        self._sending = deque()
+        self._version = 0 # protocol version accepted by the broker
+        self.features = 0
+        self._codec = None # compression codec picked by the broker
+        self._batch_size = batch_size
+        self._linger = linger
+        self._batch = [] # pending (qid, message, flag) records
+        self._batch_bytes = 0
+        self._flush_scheduled = False
+        self._linger_timeout = None
+        self._acks = [] # delivery tags to acknowledge
+        self.producer_limits = QueueLimits(high_bytes=8 << 20)
+        # guards the following, which threads share with the IOLoop
+        self._posted = threading.Condition(threading.Lock())
+        self._inbox = deque() # (qid, message, flag, deadline) from threads
+        self._inbox_bytes = 0
+        self._inbox_paused = False # the threads wait for the low watermarks
+        self._draining = False # a _drain_inbox is on its way
 
 
     def add_timeout(self, t, f):
@@ -395,10 +2455,22 @@ class SocketClient(Client):
 
     def _on_disconnected(self):
         self.connected = False
+        with self._posted:
+            if self._inbox:
+                logging.warning("dropping %d messages sent from other "
+                        "threads", len(self._inbox))
+            self._inbox.clear()
+            self._inbox_bytes = 0
+            self._inbox_paused = False
+            self._draining = False
+            self._posted.notify_all()
         self.on_disconnected()
 
 
     def close(self):
+        self._drain_inbox(True)
+        self.flush()
+        self._flush_acks()
         self._stream.write(struct.pack('!I', OP_DISCONNECT << 29),
                 self._stream.close)
 
@@ -408,128 +2480,355 @@ class SocketClient(Client):
 
 
     def subscribe(self, qid):
-        x = 1 if type(qid) != types.StringType and hasattr(qid, 'pattern') else 0
-        qid = qid.pattern if x else qid
-        qid_length = len(qid)
-        assert qid_length <= 255
-        header = (OP_SUBSCRIBE << 29) | x << 28 | (qid_length << 20)
-        self._stream.write(struct.pack('!I', header))
-        self._stream.write(qid)
+        ''' qid can be a string, a Topic, sent as its regular expression to
+            a broker older than protocol version 4, or a regular expression
+        '''
+        self._stream.write(self._subscription(OP_SUBSCRIBE, qid))
 
 
     def unsubscribe(self, qid):
+        self._stream.write(self._subscription(OP_UNSUBSCRIBE, qid))
+
+
+    def _subscription(self, op, qid):
+        if isinstance(qid, Topic):
+            if self._version >= 4:
+                return extended_header(op, FLAG_TOPIC, len(qid.filter), 0) \
+                        + qid.filter
+            qid = qid.regex()
         x = 1 if type(qid) != types.StringType and hasattr(qid, 'pattern') else 0
         qid = qid.pattern if x else qid
-        assert len(qid)<=255
-        header = (OP_UNSUBSCRIBE << 29) | x << 28 | (qid_length << 20)
-        self._stream.write(struct.pack('!I', header))
-        self._stream.write(qid)
+        return frame_header(op, x, len(qid), 0, self._version) + qid
 
 
-    def send(self, qid, message, multicast=True):
+    def send(self, qid, message, multicast=True, ttl=None, deadline=None):
+        ''' ttl in seconds, deadline in seconds since the epoch
+        '''
         if self._stream.closed():
             raise IOError("Connection to exchange is closed")
+        assert len(message) <= self._stream.max_buffer_size
+        flag = 1 if multicast else 0
+        if ttl is not None:
+            deadline = time.time() + ttl
+        if deadline is not None or type(message) is not str:
+            qid, message, flag = self._record(qid, message, flag, deadline)
+        if self._batch_size is None:
+            pieces = []
+            if self._codec is None or \
+                    len(message) < compression.MIN_SIZE or \
+                    not compress_frame(OP_SEND, flag, qid, message,
+                        self._codec, pieces):
+                pieces.append(frame_header(OP_SEND, flag, len(qid),
+                    len(message), self._version) + qid)
+                pieces.append(message)
+            self._write(pieces)
+        else:
+            self._add_to_batch([(qid, message, flag)],
+                    4 + len(qid) + len(message))
+
 
+    def send_many(self, qid, messages, multicast=True, ttl=None,
+            deadline=None):
+        ''' send every message of the messages list to qid, in a single
+            OP_BATCH frame when the broker supports it. Messages with a
+            deadline are framed one by one.
+        '''
+        if self._stream.closed():
+            raise IOError("Connection to exchange is closed")
+        flag = 1 if multicast else 0
+        if ttl is not None:
+            deadline = time.time() + ttl
+        records = []
+        size = 0
+        for message in messages:
+            assert len(message) <= self._stream.max_buffer_size
+            if deadline is not None or type(message) is not str:
+                record = self._record(qid, message, flag, deadline)
+            else:
+                record = (qid, message, flag)
+            records.append(record)
+            size += 4 + len(qid) + len(record[1])
+        if self._batch_size is None:
+            self._write(encode_frames(OP_SEND, records, self._version,
+                self._codec))
+        else:
+            self._add_to_batch(records, size)
 
-        self._sending.append((qid, message, multicast))
-        if len(self._sending) == 1:
-            self._send()
 
+    def send_threadsafe(self, qid, message, multicast=True, ttl=None,
+            deadline=None, timeout=None):
+        ''' send from a thread other than the IOLoop's, blocking while too
+            many messages are queued for the IOLoop, for at most timeout
+            seconds if given, then raising Full
+        '''
+        if ttl is not None:
+            deadline = time.time() + ttl
+        self._post([(qid, message, 1 if multicast else 0, deadline)],
+                timeout)
 
-    def _send(self):
-        qid, message, multicast = self._sending.popleft()
-        qid_length = len(qid)
-        assert len(qid) <= 255
-        message_length = len(message)
-        assert len(message) <= self._stream.max_buffer_size
-        header = (OP_SEND << 29) | (1 if multicast else 0) << 28 \
-                | (qid_length << 20) | message_length
-        try:
-            self._stream.write(struct.pack('!I', header))
-            self._stream.write(qid)
-            self._stream.write(message)
-        except IOError:
-            self._stream.close()
 
-        if len(self._sending) > 0 and not self._stream.closed():
-            self.add_callback(self._send)
+    def send_many_threadsafe(self, qid, messages, multicast=True, ttl=None,
+            deadline=None, timeout=None):
+        ''' send_threadsafe for every message of the messages list, queued
+            all at once
+        '''
+        if ttl is not None:
+            deadline = time.time() + ttl
+        flag = 1 if multicast else 0
+        self._post([(qid, message, flag, deadline) for message in messages],
+                timeout)
 
 
-    def _on_header(self, header):
-        header, = struct.unpack('!I', header)
-        op = header >> 29
-        try:
-            if op == OP_MESSAGE:
-                qid_length = (header & 0x0FF00000) >> 20
-                message_length = header & 0x000FFFFF
-                def recv(qid, message):
-                    self.on_message(qid, message)
-                    self._stream.read_bytes(4, self._on_header)
-
-                def on_qid(qid):
-                    if message_length > 0 :
-                        self._stream.read_bytes(message_length,
-                                functools.partial(recv, qid))
+    def _post(self, items, timeout):
+        ''' queue items for _drain_inbox, on a thread
+        '''
+        stream = self._stream
+        if stream is None or stream.closed():
+            raise IOError("Connection to exchange is closed")
+        size = 0
+        for item in items:
+            assert len(item[1]) <= stream.max_buffer_size
+            size += len(item[1])
+        limits = self.producer_limits
+        with self._posted:
+            inbox = self._inbox
+            if inbox and (self._inbox_paused or
+                    len(inbox) + len(items) > limits.high_messages or
+                    self._inbox_bytes + size > limits.high_bytes):
+                self._inbox_paused = True
+                end = None if timeout is None else time.time() + timeout
+                while self._inbox_paused:
+                    if end is None:
+                        self._posted.wait()
                     else:
-                        recv(qid,  '')
-                if qid_length > 0:
-                    self._stream.read_bytes(qid_length, on_qid)
+                        left = end - time.time()
+                        if left <= 0:
+                            raise Full("%d messages are waiting for the "
+                                    "IOLoop" % len(inbox))
+                        self._posted.wait(left)
+                if stream.closed():
+                    raise IOError("Connection to exchange is closed")
+            inbox.extend(items)
+            self._inbox_bytes += size
+            if self._draining:
+                return
+            self._draining = True
+        self.add_callback(self._drain_inbox)
+
+
+    def _drain_inbox(self, everything=False):
+        ''' write the messages other threads queued, as many as fit under
+            producer_limits.high_bytes with those already pending, the
+            rest once they are written
+        '''
+        stream = self._stream
+        if stream.closed():
+            return
+        limits = self.producer_limits
+        room = limits.high_bytes - stream.write_buffer_size() - \
+                self._batch_bytes
+        with self._posted:
+            inbox = self._inbox
+            items = []
+            size = 0
+            while inbox and (everything or size < room):
+                item = inbox.popleft()
+                items.append(item)
+                size += len(item[1])
+            self._inbox_bytes -= size
+            more = bool(inbox)
+            self._draining = more
+            if self._inbox_paused and len(inbox) <= limits.low_messages \
+                    and self._inbox_bytes <= limits.low_bytes:
+                self._inbox_paused = False
+                self._posted.notify_all()
+
+        if items:
+            records = []
+            for qid, message, flag, deadline in items:
+                if deadline is not None or type(message) is not str:
+                    records.append(self._record(qid, message, flag,
+                        deadline))
                 else:
-                    on_qid('')
+                    records.append((qid, message, flag))
+            if self._batch_size is None:
+                self._write(encode_frames(OP_SEND, records, self._version,
+                    self._codec))
             else:
-                assert False, "Unknown op code 0x%02X" % op
+                self._add_to_batch(records, size + 4 * len(records))
+        if more:
+            # go on once everything pending is written
+            self.flush()
+            if not stream.closed():
+                stream.write('', self._drain_inbox)
+
+
+    def _record(self, qid, message, flag, deadline):
+        ''' the (qid, payload, flag) record sending message, carrying
+            deadline, or the one of an Expiring message, when the broker
+            takes deadlines
+        '''
+        if deadline is None:
+            deadline = getattr(message, 'deadline', None)
+        if deadline is None or self._version < 5:
+            return (qid, message, flag)
+        return (qid, _DEADLINE.pack(int(deadline * 1e6)) + message,
+                flag | FLAG_DEADLINE)
+
+
+    def qos(self, prefetch):
+        ''' get unicast messages through on_delivery from now on, at most
+            prefetch of them unacknowledged at a time, 0 for no limit
+        '''
+        if self._version < 3:
+            raise ValueError("the broker does not support acknowledgements "
+                    "(protocol version %d)" % self._version)
+        self._stream.write(frame_header(OP_QOS, 0, 0, 4, self._version) +
+                _HEADER.pack(prefetch))
+
+
+    def on_delivery(self, tag, qid, message, redelivered):
+        ''' an acknowledged unicast message, see qos. redelivered is set
+            when it was delivered before. Acknowledges it once on_message
+            returns, unless overridden.
+        '''
+        self.on_message(qid, message)
+        self.ack(tag)
+
+
+    def ack(self, tag):
+        if not self._acks:
+            self.add_callback(self._flush_acks)
+        self._acks.append(tag)
+
+
+    def nack(self, tag, requeue=True):
+        ''' reject a delivery, it is delivered again when requeue is set
+            and dropped otherwise
+        '''
+        self._write([frame_header(OP_NACK, 1 if requeue else 0, 0,
+            _TAG.size, self._version) + _TAG.pack(tag)])
+
+
+    def _flush_acks(self):
+        if not self._acks or self._stream.closed():
+            return
+        tags, self._acks = self._acks, []
+        self._write([frame_header(OP_ACK, 0, 0, _TAG.size * len(tags),
+            self._version), struct.pack('!%dQ' % len(tags), *tags)])
+
+
+    def outstanding_bytes(self):
+        ''' bytes sent but not written to the broker yet, batched ones and
+            the ones other threads queued included
+        '''
+        if self._stream is None:
+            return self._batch_bytes + self._inbox_bytes
+        return self._stream.write_buffer_size() + self._batch_bytes + \
+                self._inbox_bytes
+
+
+    def flush(self):
+        ''' write the pending batch, if any
+        '''
+        if self._linger_timeout is not None:
+            self.remove_timeout(self._linger_timeout)
+            self._linger_timeout = None
+        if not self._batch:
+            return
+        records, self._batch = self._batch, []
+        self._batch_bytes = 0
+        self._write(encode_frames(OP_SEND, records, self._version,
+            self._codec))
+
+
+    def _add_to_batch(self, records, size):
+        self._batch.extend(records)
+        self._batch_bytes += size
+        if self._batch_bytes >= self._batch_size:
+            self.flush()
+        elif self._linger is not None:
+            if self._linger_timeout is None:
+                self._linger_timeout = self.add_timeout(
+                        time.time() + self._linger, self._on_linger)
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.add_callback(self._on_linger)
+
+
+    def _on_linger(self):
+        self._flush_scheduled = False
+        self._linger_timeout = None
+        if not self._stream.closed():
+            self.flush()
+
+
+    def _write(self, pieces):
+        try:
+            write_pieces(self._stream, pieces)
         except IOError:
             self._stream.close()
 
 
+    def _on_frame(self, op, flag, qid, payload):
+        if op == OP_MESSAGE:
+            self.on_message(qid, payload)
+        elif op == OP_BATCH:
+            for qid, message, flag in payload:
+                self.on_message(qid, message)
+        elif op == OP_DELIVER:
+            tag, = _TAG.unpack_from(payload)
+            self.on_delivery(tag, qid, payload[_TAG.size:], flag)
+        elif op == OP_CONNECTED:
+            self._version = payload & 0xFF
+            self.features = payload & 0xFFF00
+            self._decoder.version = self._version
+            self._codec = self._decoder.codec = \
+                    compression.choose(self.features)
+            self._on_connected()
+        else:
+            assert False, "Unknown op code 0x%02X" % op
+
+
+    def _open(self, s):
+        ''' start the handshake on the connected socket s
+        '''
+        self._start(IOStream(s, self._ioloop))
+
+
+    def _start(self, stream):
+        ''' start the handshake on stream, an IOStream or alike
+        '''
+        self._stream = stream
+        stream.set_close_callback(self._on_disconnected)
+        stream.write(_HEADER.pack((OP_CONNECT << 29) |
+            (self.request_features & FEATURES) | PROTOCOL_VERSION))
+        self._decoder = FrameDecoder(stream, self._on_frame)
+
+
 
 class TcpClient(SocketClient):
 
-    def __init__(self, ioloop):
-        SocketClient.__init__(self, ioloop)
+    def __init__(self, ioloop, batch_size=None, linger=None):
+        SocketClient.__init__(self, ioloop, batch_size, linger)
 
 
     def connect(self, address):
         host, port = self._adress = address
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         s.connect((host, port))
-
-        self._stream = stream = IOStream(s, self._ioloop)
-        stream.set_close_callback(self._on_disconnected)
-        stream.write(struct.pack('!I', OP_CONNECT << 29))
-        def on_connected(header):
-            header, = struct.unpack('!I', header)
-            if (header >> 29) != OP_CONNECTED:
-                raise Exception("handshake error with" + str(address))
-
-            self._on_connected()
-            self._stream.read_bytes(4, self._on_header)
-
-        stream.read_bytes(4, on_connected)
+        self._open(s)
 
 
 
 class IpcClient(SocketClient):
 
-    def __init__(self, ioloop):
-        SocketClient.__init__(self, ioloop)
+    def __init__(self, ioloop, batch_size=None, linger=None):
+        SocketClient.__init__(self, ioloop, batch_size, linger)
 
 
     def connect(self, address):
         self._adress = address
         s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
         s.connect(address)
-
-        self._stream = stream = IOStream(s, self._ioloop)
-        stream.set_close_callback(self._on_disconnected)
-        stream.write(struct.pack('!I', OP_CONNECT << 29))
-        def on_connected(header):
-            header, = struct.unpack('!I', header)
-            if (header >> 29) != OP_CONNECTED:
-                raise Exception("handshake error with" + str(address))
-
-            self._on_connected()
-            self._stream.read_bytes(4, self._on_header)
-
-        stream.read_bytes(4, on_connected)
-
+        self._open(s)
@@ -0,0 +1,532 @@
+''' Load generator and benchmark harness.
+
+    Every scenario forks a broker, then consumer processes each holding
+    some of the subscriber connections and producer processes, all talking
+    over loopback TCP, a Unix socket or shared memory. Producers stamp every message with
+    its send time, so consumers measure the end to end latency of each
+    message, and one JSON object per scenario is written with the
+    throughput and the latency percentiles in microseconds.
+
+    python loadgen.py --suite all -o results.json
+    python loadgen.py --size 1024 --subscribers 100 --transport ipc
+'''
+import os, sys, time, re, json, struct, random, socket, signal
+import shutil, tempfile, platform, argparse, cPickle, resource
+import tornado.ioloop
+import jetstream
+import metrics
+import shm
+
+
+_STAMP = struct.Struct('!d') # send time, at the start of every message
+MIN_SIZE = _STAMP.size
+DATA_QID = '/load/%d'
+DATA_PATTERN = r'/load/\d+$'
+READY_QID = '/ready/%d/%d'
+TRANSPORTS = ('tcp', 'ipc', 'shm')
+
+
+class Scenario(object):
+    ''' Parameters of one run. producers processes send messages each,
+        spread round robin over qids qids, to subscribers connections
+        spread over consumers processes. Subscribers subscribe to every qid
+        exactly, or once with a regular expression when regex is set.
+        rate, in messages/s per producer, paces the producers, which
+        otherwise send as fast as the broker takes them.
+    '''
+
+    def __init__(self, transport='tcp', size=100, multicast=True,
+            subscribers=1, consumers=1, producers=1, qids=1, regex=False,
+            messages=10000, rate=None, batch_size=65536, name=None):
+        assert transport in TRANSPORTS
+        assert size >= MIN_SIZE, "messages carry a %d bytes stamp" % MIN_SIZE
+        self.name = name
+        self.transport = transport
+        self.size = size
+        self.multicast = multicast
+        self.subscribers = subscribers
+        self.consumers = min(consumers, subscribers)
+        self.producers = producers
+        self.qids = qids
+        self.regex = regex
+        self.messages = messages
+        self.rate = rate
+        self.batch_size = batch_size
+
+
+    def expected(self):
+        ''' deliveries expected in all, every subscriber gets every
+            multicast message and one of them every unicast message
+        '''
+        n = self.producers * self.messages
+        return n * self.subscribers if self.multicast else n
+
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+
+class LoadClient(jetstream.SocketClient):
+    ''' connects to a (host, port) address over TCP, to a path otherwise,
+        through shared memory when shared is set
+    '''
+
+    def __init__(self, ioloop, shared, batch_size=None):
+        jetstream.SocketClient.__init__(self, ioloop, batch_size)
+        self._shared = shared
+
+
+    def connect(self, address):
+        if self._shared:
+            self._start(shm.open_stream(address, self._ioloop))
+            return
+        family = socket.AF_INET if isinstance(address, tuple) \
+                else socket.AF_UNIX
+        s = socket.socket(family, socket.SOCK_STREAM, 0)
+        s.connect(address)
+        self._open(s)
+
+
+
+class Subscriber(LoadClient):
+    ''' subscribes to the data qids, then tells receiver it is ready once
+        its own message to READY_QID came back, its subscriptions are
+        active by then
+    '''
+
+    def __init__(self, ioloop, receiver, scenario, ready_qid):
+        LoadClient.__init__(self, ioloop, scenario.transport == 'shm')
+        self._receiver = receiver
+        self._scenario = scenario
+        self._ready_qid = ready_qid
+
+
+    def on_connected(self):
+        if self._scenario.regex:
+            self.subscribe(re.compile(DATA_PATTERN))
+        else:
+            for i in xrange(self._scenario.qids):
+                self.subscribe(DATA_QID % i)
+        self.subscribe(self._ready_qid)
+        self.send(self._ready_qid, 'ready')
+
+
+    def on_message(self, qid, message):
+        if qid == self._ready_qid:
+            self._receiver.on_ready()
+        else:
+            self._receiver.on_message(message)
+
+
+
+class Receiver(object):
+    ''' what the subscribers of a consumer process received
+    '''
+
+    def __init__(self, ioloop, expected, subscribers, on_ready):
+        self._ioloop = ioloop
+        self._expected = expected
+        self._on_ready = on_ready
+        self._waiting = subscribers
+        self.histogram = metrics.Histogram()
+        self.received = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+
+
+    def on_ready(self):
+        self._waiting -= 1
+        if self._waiting == 0:
+            self._on_ready()
+
+
+    def on_message(self, message):
+        now = time.time()
+        sent, = _STAMP.unpack_from(message)
+        self.histogram.record((now - sent) * 1e6)
+        self.received += 1
+        self.bytes += len(message)
+        if self.first is None:
+            self.first = now
+        self.last = now
+        if self.received == self._expected:
+            self._ioloop.stop()
+
+
+    def result(self):
+        return {'received': self.received, 'bytes': self.bytes,
+                'first': self.first, 'last': self.last,
+                'histogram': self.histogram}
+
+
+
+class Producer(LoadClient):
+    ''' sends its messages as fast as the broker takes them, keeping at
+        most window bytes unwritten, or at rate messages/s
+    '''
+
+    def __init__(self, ioloop, scenario, window=1 << 20):
+        LoadClient.__init__(self, ioloop, scenario.transport == 'shm',
+                scenario.batch_size)
+        self._scenario = scenario
+        self._window = window
+        self._padding = 'x' * (scenario.size - MIN_SIZE)
+        self._qids = [DATA_QID % i for i in xrange(scenario.qids)]
+        self.sent = 0
+        self.started = None
+        self.finished = None
+
+
+    def on_connected(self):
+        self.started = time.time()
+        self._pump()
+
+
+    def on_disconnected(self):
+        self._ioloop.stop()
+
+
+    def _pump(self):
+        scenario = self._scenario
+        n = scenario.messages
+        if scenario.rate:
+            due = int((time.time() - self.started) * scenario.rate)
+            n = min(n, due)
+        qids = self._qids
+        multicast = scenario.multicast
+        while self.sent < n and self.outstanding_bytes() < self._window:
+            self.send(qids[self.sent % len(qids)],
+                    _STAMP.pack(time.time()) + self._padding, multicast)
+            self.sent += 1
+        self.flush()
+        if self.sent < scenario.messages:
+            self.add_timeout(time.time() + 0.001, self._pump)
+        else:
+            self.finished = time.time()
+            self.close()
+
+
+    def result(self):
+        return {'sent': self.sent, 'started': self.started,
+                'finished': self.finished}
+
+
+
+def _fork(target, *args):
+    ''' run target(*args) in a child process, whatever it returns is sent
+        back through the pipe whose read end is returned with the pid
+    '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            result = target(*args)
+            os.write(w, cPickle.dumps(result, 2))
+        except:
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.close(w)
+    return pid, r
+
+
+def _read_result(r):
+    f = os.fdopen(r, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    return cPickle.loads(data) if data else None
+
+
+def _broker(scenario, address, ready_w, seed):
+    random.seed(seed)
+    ioloop = tornado.ioloop.IOLoop()
+    exchange = jetstream.Exchange()
+    # hold producers back instead of queueing without bound
+    limits = jetstream.QueueLimits(high_bytes=max(1 << 20, 2 * scenario.size))
+    if scenario.transport == 'tcp':
+        adapter = jetstream.TcpAdapter(exchange, ioloop, limits)
+    elif scenario.transport == 'ipc':
+        adapter = jetstream.IpcAdapter(exchange, ioloop, limits)
+    else:
+        adapter = shm.ShmAdapter(exchange, ioloop, limits)
+    adapter.start(address)
+    os.write(ready_w, 'r')
+    signal.signal(signal.SIGTERM, lambda *args: ioloop.stop())
+    ioloop.start()
+
+
+def _consume(scenario, address, index, n_subscribers, ready_w, control_r,
+        idle, timeout):
+    ''' run n_subscribers subscribers until they got every multicast
+        message, or, once the producers are done (control_r readable),
+        until nothing came for idle seconds
+    '''
+    ioloop = tornado.ioloop.IOLoop()
+    expected = scenario.producers * scenario.messages * n_subscribers \
+            if scenario.multicast else None
+    receiver = Receiver(ioloop, expected, n_subscribers,
+            lambda: os.write(ready_w, 'r'))
+    subscribers = []
+    for i in xrange(n_subscribers):
+        s = Subscriber(ioloop, receiver, scenario, READY_QID % (index, i))
+        s.connect(address)
+        subscribers.append(s)
+
+    def check_idle(since):
+        if time.time() - max(receiver.last, since) > idle:
+            ioloop.stop()
+        else:
+            ioloop.add_timeout(time.time() + idle / 4,
+                    lambda: check_idle(since))
+
+    def on_control(fd, events):
+        ioloop.remove_handler(fd)
+        check_idle(time.time())
+    ioloop.add_handler(control_r, on_control, tornado.ioloop.IOLoop.READ)
+    ioloop.add_timeout(time.time() + timeout, ioloop.stop)
+    ioloop.start()
+    return receiver.result()
+
+
+def _produce(scenario, address, start_r):
+    ioloop = tornado.ioloop.IOLoop()
+    producer = Producer(ioloop, scenario)
+    os.read(start_r, 1)
+    producer.connect(address)
+    ioloop.start()
+    return producer.result()
+
+
+def run(scenario, idle=1.0, timeout=120.0, seed=0):
+    ''' run scenario, returns its results as a dict
+    '''
+    directory = tempfile.mkdtemp(prefix='jetstream-loadgen-')
+    if scenario.transport == 'tcp':
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        address = s.getsockname()
+        s.close()
+    else:
+        address = os.path.join(directory, 'broker')
+    pids = []
+    try:
+        ready_r, ready_w = os.pipe()
+        broker, broker_r = _fork(_broker, scenario, address, ready_w, seed)
+        pids.append(broker)
+        os.read(ready_r, 1)
+
+        consumers = []
+        for i in xrange(scenario.consumers):
+            n = scenario.subscribers / scenario.consumers + \
+                    (1 if i < scenario.subscribers % scenario.consumers else 0)
+            control_r, control_w = os.pipe()
+            pid, r = _fork(_consume, scenario, address, i, n, ready_w,
+                    control_r, idle, timeout)
+            os.close(control_r)
+            pids.append(pid)
+            consumers.append((pid, r, control_w))
+        for i in xrange(scenario.consumers):
+            os.read(ready_r, 1)
+
+        start_r, start_w = os.pipe()
+        producers = []
+        for i in xrange(scenario.producers):
+            pid, r = _fork(_produce, scenario, address, start_r)
+            pids.append(pid)
+            producers.append(r)
+        os.close(start_r)
+        os.write(start_w, 'x' * scenario.producers)
+        os.close(start_w)
+
+        sent = [_read_result(r) for r in producers]
+        for pid, r, control_w in consumers:
+            try:
+                os.write(control_w, 'x')
+            except OSError:
+                pass # done already, with every multicast message
+        received = [_read_result(r) for pid, r, control_w in consumers]
+        for pid, r, control_w in consumers:
+            os.close(control_w)
+        os.close(ready_r)
+        os.close(ready_w)
+        return _report(scenario, sent, received)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        os.close(broker_r)
+        shutil.rmtree(directory)
+
+
+def _report(scenario, sent, received):
+    if None in sent or None in received:
+        raise RuntimeError("a producer or consumer failed")
+    histogram = metrics.Histogram()
+    n = 0
+    size = 0
+    for r in received:
+        histogram.merge(r['histogram'])
+        n += r['received']
+        size += r['bytes']
+    started = min(p['started'] for p in sent)
+    finished = max(p['finished'] for p in sent)
+    last = max(r['last'] for r in received if r['last']) if n else finished
+    elapsed = max(last - started, 1e-9)
+    latency = histogram.summary()
+    del latency['count']
+    return {
+        'scenario': scenario.to_dict(),
+        'sent': sum(p['sent'] for p in sent),
+        'expected': scenario.expected(),
+        'received': n,
+        'elapsed': elapsed,
+        'send_rate': sum(p['sent'] for p in sent) /
+                max(finished - started, 1e-9),
+        'messages_per_second': n / elapsed,
+        'bytes_per_second': size / elapsed,
+        'latency_us': latency,
+    }
+
+
+def _messages(size, deliveries_per_message, scale):
+    ''' messages per producer so that a scenario delivers about 200K
+        messages or 200MB, whichever comes first
+    '''
+    n = min(200000 * scale / deliveries_per_message,
+            200e6 * scale / (size * deliveries_per_message))
+    return max(20, int(n))
+
+
+def suite_sizes(scale):
+    ''' one producer and one subscriber, 16 bytes to 1MB messages, over
+        every transport
+    '''
+    for transport in TRANSPORTS:
+        for size in (16, 256, 4096, 65536, 1 << 20):
+            yield Scenario(transport, size, messages=_messages(size, 1, scale),
+                    name='sizes')
+
+
+def suite_fanout(scale):
+    ''' 100 bytes messages multicast to 1 to 1000 subscribers, and unicast
+        to one of them
+    '''
+    for multicast in (True, False):
+        for n in (1, 10, 100, 1000):
+            consumers = min(4, n)
+            yield Scenario(size=100, multicast=multicast, subscribers=n,
+                    consumers=consumers,
+                    messages=_messages(100, n if multicast else 1, scale),
+                    name='fanout')
+
+
+def suite_subscriptions(scale):
+    ''' messages spread over 1 to 10000 qids, every one subscribed to
+        exactly, against a single regular expression matching them all
+    '''
+    for regex in (False, True):
+        for qids in (1, 100, 10000):
+            yield Scenario(size=100, qids=qids, regex=regex,
+                    messages=_messages(100, 1, scale), name='subscriptions')
+
+
+def suite_processes(scale):
+    ''' 1 to 8 producer and consumer processes, multicast to every
+        consumer and unicast to one
+    '''
+    for multicast in (True, False):
+        for n in (1, 2, 4, 8):
+            yield Scenario(size=100, multicast=multicast, subscribers=n,
+                    consumers=n, producers=n,
+                    messages=_messages(100, n * n if multicast else n, scale),
+                    name='processes')
+
+
+def suite_latency(scale):
+    ''' latency at a fixed load, far below the saturation throughput
+    '''
+    for rate in (1000, 10000):
+        yield Scenario(size=100, rate=rate,
+                messages=max(20, int(rate * 5 * scale)), name='latency')
+
+
+SUITES = {
+    'sizes': suite_sizes,
+    'fanout': suite_fanout,
+    'subscriptions': suite_subscriptions,
+    'processes': suite_processes,
+    'latency': suite_latency,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--suite', action='append', default=[],
+            choices=sorted(SUITES) + ['all'],
+            help="run predefined scenarios, may be repeated")
+    parser.add_argument('--scale', type=float, default=1.0,
+            help="multiplies the message counts of the suites")
+    parser.add_argument('--transport', choices=TRANSPORTS,
+            default='tcp')
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--unicast', action='store_true')
+    parser.add_argument('--subscribers', type=int, default=1)
+    parser.add_argument('--consumers', type=int, default=1,
+            help="processes the subscribers are spread over")
+    parser.add_argument('--producers', type=int, default=1)
+    parser.add_argument('--qids', type=int, default=1)
+    parser.add_argument('--regex', action='store_true')
+    parser.add_argument('--messages', type=int, default=100000,
+            help="per producer")
+    parser.add_argument('--rate', type=float, default=None,
+            help="messages/s per producer, unpaced by default")
+    parser.add_argument('--batch-size', type=int, default=65536)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="append the results there")
+    args = parser.parse_args()
+
+    # a broker with 1000 subscribers needs more than the usual 1024 fds
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.suite:
+        names = sorted(SUITES) if 'all' in args.suite else args.suite
+        scenarios = [s for name in names for s in SUITES[name](args.scale)]
+    else:
+        scenarios = [Scenario(args.transport, args.size, not args.unicast,
+            args.subscribers, args.consumers, args.producers, args.qids,
+            args.regex, args.messages, args.rate, args.batch_size)]
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    environment = {'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.sysconf(
+                'SC_NPROCESSORS_ONLN'), 'time': time.time()}
+    for scenario in scenarios:
+        result = run(scenario, seed=args.seed)
+        result['environment'] = environment
+        output.write(json.dumps(result, sort_keys=True) + '\n')
+        output.flush()
+        latency = result['latency_us']
+        print >> sys.stderr, "%-13s %s %7d B %dx%d %s %5d %s: %9.1f msg/s " \
+                "p50 %d p99 %d p999 %d us%s" % (scenario.name or '-',
+                scenario.transport, scenario.size, scenario.producers,
+                scenario.subscribers,
+                'multicast' if scenario.multicast else 'unicast',
+                scenario.qids, 'regex' if scenario.regex else 'exact',
+                result['messages_per_second'], latency['p50'],
+                latency['p99'], latency['p999'],
+                '' if result['received'] == result['expected'] else
+                ' (%d of %d received)' % (result['received'],
+                    result['expected']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+import os, socket, fcntl, time, json, logging, errno
+from array import array
+import tornado.ioloop
+from iostream import IOStream
+
+
+OTHER = '(other)' # counters of the qids beyond max_qids
+
+
+class Histogram(object):
+    ''' HDR style histogram of integer values (microseconds here): values
+        under 2**bits are counted exactly, larger ones in buckets of
+        2**(bits - 1) per power of two, so the relative error stays under
+        2**(1 - bits) whatever the value. Values above max_value are
+        counted as max_value.
+    '''
+
+    def __init__(self, bits=6, max_value=3600 * 1000000):
+        self._bits = bits
+        self._half = 1 << (bits - 1)
+        self._max_value = max_value
+        self._counts = array('L', [0]) * (self._index(max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+
+    def _index(self, value):
+        if value < 1 << self._bits:
+            return value
+        shift = value.bit_length() - self._bits
+        return shift * self._half + (value >> shift)
+
+
+    def _bounds(self, index):
+        ''' lowest and highest value counted at index
+        '''
+        if index < 1 << self._bits:
+            return index, index
+        shift = index / self._half - 1
+        low = (index - shift * self._half) << shift
+        return low, low + (1 << shift) - 1
+
+
+    def record(self, value):
+        value = min(max(int(value), 0), self._max_value)
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+
+    def percentile(self, p):
+        ''' the value p percent of the recorded values are at or under,
+            to the precision of its bucket
+        '''
+        if not self.count:
+            return 0
+        rank = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= rank:
+                return min(self._bounds(index)[1], self.max)
+        return self.max
+
+
+    def merge(self, other):
+        ''' add the values recorded by other, a Histogram of the same
+            geometry, e.g. from another process
+        '''
+        assert len(other._counts) == len(self._counts)
+        for i, n in enumerate(other._counts):
+            if n:
+                self._counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None:
+            self.min = other.min if self.min is None \
+                    else min(self.min, other.min)
+
+
+    def reset(self):
+        for i in xrange(len(self._counts)):
+            self._counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'min': self.min or 0,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+        }
+
+
+
+class Metrics(object):
+    ''' Counters and latency histograms of a broker, given to its Exchange
+        as Exchange(metrics=Metrics()).
+
+        Counted on every message: messages and bytes dispatched to each qid
+        (in) and written to connections for each qid (out), and the recv
+        and send calls of the connection streams. Latencies, in
+        microseconds, are only measured on one message in sample_every
+        (None for never): the 'dispatch' histogram holds the time spent in
+        Exchange.dispatch, per call, and 'delivery' the time from queueing
+        a message on a Connection until it was written to its socket. That
+        queueing delay is also kept for each qid, as its mean and maximum.
+        The messages of each qid dropped past their deadline are counted as
+        expired, see jetstream.Expiring.
+
+        Everything is updated on the IOLoop thread with plain integer
+        additions, no locking. Counters of the qids seen after max_qids
+        others go under OTHER.
+    '''
+
+    def __init__(self, sample_every=64, max_qids=10000):
+        self.sample_every = sample_every
+        self._countdown = sample_every or 0
+        self._max_qids = max_qids
+        # qid -> [messages in, bytes in, messages out, bytes out,
+        #         delay samples, delay total, delay max, expired]
+        self.qids = {}
+        self.syscalls = {'recv': [0, 0], 'send': [0, 0]} # -> [calls, bytes]
+        self.histograms = {'dispatch': Histogram(), 'delivery': Histogram()}
+        self.started = time.time()
+
+
+    def sample(self):
+        ''' True once every sample_every calls
+        '''
+        if not self._countdown:
+            return False
+        self._countdown -= 1
+        if self._countdown:
+            return False
+        self._countdown = self.sample_every
+        return True
+
+
+    def _qid(self, qid):
+        counters = self.qids.get(qid)
+        if counters is None:
+            if len(self.qids) >= self._max_qids:
+                qid = OTHER
+            counters = self.qids.get(qid)
+            if counters is None:
+                counters = self.qids[qid] = [0, 0, 0, 0, 0, 0, 0, 0]
+        return counters
+
+
+    def count_in(self, qid, messages, size):
+        counters = self._qid(qid)
+        counters[0] += messages
+        counters[1] += size
+
+
+    def count_out(self, qid, messages, size):
+        counters = self._qid(qid)
+        counters[2] += messages
+        counters[3] += size
+
+
+    def count_expired(self, qid, messages):
+        self._qid(qid)[7] += messages
+
+
+    def syscall(self, name, size):
+        counters = self.syscalls[name]
+        counters[0] += 1
+        counters[1] += size
+
+
+    def dispatch(self, dispatch, qid, messages, size, *args):
+        ''' count messages to qid and call dispatch(qid, *args), timing
+            the call when sampled
+        '''
+        counters = self.qids.get(qid) or self._qid(qid)
+        counters[0] += messages
+        counters[1] += size
+        if self._countdown != 1:
+            if self._countdown:
+                self._countdown -= 1
+            return dispatch(qid, *args)
+        self._countdown = self.sample_every
+        t0 = time.time()
+        result = dispatch(qid, *args)
+        self.histograms['dispatch'].record((time.time() - t0) * 1e6)
+        return result
+
+
+    def delivered(self, stamps):
+        ''' messages to qid queued at t, for the (qid, t) in stamps, were
+            written
+        '''
+        now = time.time()
+        histogram = self.histograms['delivery']
+        for qid, t in stamps:
+            delay = int((now - t) * 1e6)
+            histogram.record(delay)
+            counters = self.qids.get(qid) or self._qid(qid)
+            counters[4] += 1
+            counters[5] += delay
+            if delay > counters[6]:
+                counters[6] = delay
+
+
+    def reset(self):
+        self.qids.clear()
+        for counters in self.syscalls.itervalues():
+            counters[:] = [0, 0]
+        for histogram in self.histograms.itervalues():
+            histogram.reset()
+        self.started = time.time()
+
+
+    def snapshot(self, clients=()):
+        ''' everything gathered since started as a dict of plain types,
+            with the stats() of those clients having one (the queue depth
+            of every Connection)
+        '''
+        return {
+            'elapsed': time.time() - self.started,
+            'sample_every': self.sample_every,
+            'qids': dict((qid, {'messages_in': c[0], 'bytes_in': c[1],
+                'messages_out': c[2], 'bytes_out': c[3],
+                'delay_samples': c[4],
+                'delay_mean': c[5] / c[4] if c[4] else 0,
+                'delay_max': c[6], 'expired': c[7]})
+                for qid, c in self.qids.iteritems()),
+            'syscalls': dict((name, {'calls': c[0], 'bytes': c[1]})
+                for name, c in self.syscalls.iteritems()),
+            'latency': dict((name, h.summary())
+                for name, h in self.histograms.iteritems()),
+            'connections': [c.stats() for c in clients
+                if hasattr(c, 'stats')],
+        }
+
+
+
+class StatsServer(object):
+    ''' Serves exchange.stats() as JSON on a local address, a (host, port)
+        tuple or a Unix socket path, to plain HTTP GET requests:
+        curl http://127.0.0.1:8001/
+    '''
+
+    def __init__(self, exchange, ioloop=None):
+        self._exchange = exchange
+        self._ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self._socket = None
+
+
+    def start(self, address):
+        assert not self._socket
+        if isinstance(address, tuple):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+            if os.path.exists(address):
+                os.unlink(address)
+        flags = fcntl.fcntl(s.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(s.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        s.setblocking(0)
+        s.bind(address)
+        s.listen(16)
+        self._socket = s
+        self._ioloop.add_handler(s.fileno(), self._handle_events,
+                tornado.ioloop.IOLoop.READ)
+
+
+    def stop(self):
+        self._ioloop.remove_handler(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+
+
+    def _handle_events(self, fd, events):
+        try:
+            s, address = self._socket.accept()
+        except socket.error as e:
+            if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+        stream = IOStream(s, io_loop=self._ioloop)
+
+        def on_request(buf, start, end):
+            # answer once the request headers are in, whatever they ask
+            if buf.find('\r\n\r\n', start, end) < 0 and \
+                    buf.find('\n\n', start, end) < 0:
+                return 0
+            stream.pause_reading()
+            self._respond(stream)
+            return end - start
+        stream.read_frames(on_request)
+
+
+    def _respond(self, stream):
+        try:
+            body = json.dumps(self._exchange.stats(), sort_keys=True)
+        except Exception:
+            logging.error("failed to gather the stats", exc_info=True)
+            stream.write('HTTP/1.0 500 Internal Server Error\r\n\r\n',
+                    stream.close)
+            return
+        stream.write('HTTP/1.0 200 OK\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %d\r\n\r\n' % len(body) + body,
+                stream.close)
@@ -0,0 +1,192 @@
+import time
+from collections import deque
+from topics import Topic, QidTrie, literal_prefix
+
+
+class RetainedStore(object):
+    ''' The last messages multicast to every qid, given to an Exchange as
+        Exchange(retained=RetainedStore()) to replay them to the clients
+        subscribing, so they learn the current state without waiting for
+        the next publish.
+
+        Up to depth messages are kept per exact qid, set(qid, depth) tells
+        another depth for a qid or the qids matching a Topic, exact qids
+        first, then the first Topic set that matches; 0 retains nothing.
+        Set them before dispatching, a qid keeps the depth it was retained
+        with. Past max_bytes of messages, the least recently used qids,
+        published to or replayed, are evicted whole. Recency is tracked the
+        CLOCK way, a bit per qid set on use, so that retaining a message
+        costs no more than a few dict and deque operations: the qids are
+        kept in a ring, the eviction hand skips and clears the set bits, a
+        qid only having its bit set once used again after it was added.
+
+        The qids are indexed in a QidTrie, so a Topic subscription is
+        replayed by walking the levels it names and a regular expression
+        one only goes through the qids starting with its literal prefix.
+        Messages past their deadline (see jetstream.Expiring) are not
+        replayed.
+    '''
+
+    def __init__(self, depth=1, max_bytes=64 << 20, cache_size=65536):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evicted = 0 # qids evicted
+        self._entries = {} # qid -> [messages deque, used since the hand]
+        self._qids = QidTrie()
+        # (qid, entry) in the order retained, the stale ones, whose qid
+        # was discarded since, are skipped
+        self._ring = deque()
+        self._exact = {} # qid -> depth
+        self._topics = [] # (Topic, depth), in the order set
+        self._cache = {} # qid -> depth
+        self._cache_size = cache_size
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def stats(self):
+        return {
+            'qids': len(self._entries),
+            'bytes': self.bytes,
+            'evicted': self.evicted,
+        }
+
+
+    def set(self, qid, depth):
+        assert depth >= 0
+        if isinstance(qid, Topic):
+            self._topics.append((qid, depth))
+        else:
+            self._exact[qid] = depth
+        self._cache.clear()
+
+
+    def _depth(self, qid):
+        depth = self._cache.get(qid)
+        if depth is not None:
+            return depth
+        depth = self._exact.get(qid)
+        if depth is None:
+            depth = self.depth
+            for topic, d in self._topics:
+                if topic.match(qid):
+                    depth = d
+                    break
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[qid] = depth
+        return depth
+
+
+    def append(self, qid, message):
+        ''' retain message, multicast to qid
+        '''
+        entry = self._entries.get(qid)
+        if entry is None:
+            entry = self._add(qid)
+            if entry is None:
+                return
+        else:
+            entry[1] = True
+        retained = entry[0]
+        if len(retained) == retained.maxlen:
+            self.bytes -= len(retained[0])
+        retained.append(message)
+        self.bytes += len(message)
+        if self.bytes > self.max_bytes:
+            self._evict()
+
+
+    def extend(self, qid, messages):
+        ''' retain messages, multicast to qid in that order
+        '''
+        entry = self._entries.get(qid)
+        if entry is None:
+            entry = self._add(qid)
+            if entry is None:
+                return
+        else:
+            entry[1] = True
+        retained = entry[0]
+        for message in messages:
+            if len(retained) == retained.maxlen:
+                self.bytes -= len(retained[0])
+            retained.append(message)
+            self.bytes += len(message)
+        if self.bytes > self.max_bytes:
+            self._evict()
+
+
+    def _add(self, qid):
+        ''' the entry of a qid seen for the first time, None when it is not
+            retained
+        '''
+        depth = self._depth(qid)
+        if not depth:
+            return None
+        entry = self._entries[qid] = [deque(maxlen=depth), False]
+        self._qids.add(qid)
+        self.bytes += len(qid)
+        ring = self._ring
+        ring.append((qid, entry))
+        if len(ring) > 2 * len(self._entries) + 1024:
+            entries = self._entries
+            self._ring = deque(x for x in ring if entries.get(x[0]) is x[1])
+        return entry
+
+
+    def _evict(self):
+        entries = self._entries
+        ring = self._ring
+        while self.bytes > self.max_bytes and ring:
+            qid, entry = ring.popleft()
+            if entries.get(qid) is not entry:
+                continue
+            if entry[1]:
+                # a second chance
+                entry[1] = False
+                ring.append((qid, entry))
+                continue
+            del entries[qid]
+            self._qids.remove(qid)
+            self.bytes -= len(qid) + sum(len(m) for m in entry[0])
+            self.evicted += 1
+
+
+    def discard(self, qid):
+        ''' forget the messages retained for qid
+        '''
+        entry = self._entries.pop(qid, None)
+        if entry is not None:
+            self._qids.remove(qid)
+            self.bytes -= len(qid) + sum(len(m) for m in entry[0])
+
+
+    def replay(self, subscription):
+        ''' the (qid, messages) retained for the qids subscription, an exact
+            qid, a Topic or a regular expression like object, matches
+        '''
+        entries = self._entries
+        if isinstance(subscription, Topic):
+            qids = self._qids.match(subscription)
+        elif type(subscription) is not str and \
+                hasattr(subscription, 'match'):
+            prefix = literal_prefix(subscription)
+            qids = [qid for qid in self._qids.prefixed(prefix)
+                    if subscription.match(qid)]
+        else:
+            qids = [subscription] if subscription in entries else []
+
+        now = time.time()
+        result = []
+        for qid in qids:
+            entry = entries[qid]
+            entry[1] = True
+            messages = [m for m in entry[0] if type(m) is str or
+                    getattr(m, 'deadline', None) is None or m.deadline > now]
+            if messages:
+                result.append((qid, messages))
+        return result
@@ -0,0 +1,705 @@
+''' Shared memory transport for clients on the same host.
+
+    The two sides of a Ring publish its head and tail with plain stores,
+    python has no memory barrier to put between the data and the offset
+    that publishes it. This is only safe where the CPU keeps stores in
+    order, as x86 does, so ShmAdapter and ShmClient refuse to start on
+    other machines (ARM and POWER reorder stores) and IpcAdapter should be
+    used there.
+
+    The rings pay off on multi-core hosts, where the reader and the writer
+    run in parallel without syscalls on the data path. On a single CPU
+    nothing overlaps, and in CPython the ring copies cost as much as the
+    kernel's, so IpcAdapter was measured faster than ShmAdapter there.
+'''
+
+import os, stat, socket, struct, mmap, tempfile, errno, logging, time
+import platform
+from collections import deque
+import tornado.ioloop
+import jetstream
+
+
+# not exported by the socket module of python 2
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+_PEERCRED = struct.Struct('3i') # pid, uid, gid
+_U64 = struct.Struct('Q')
+PREFIX = 'jetstream-shm-'
+DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else \
+        tempfile.gettempdir()
+# machines keeping stores in order, see the module docstring
+SUPPORTED = platform.machine().lower() in ('x86_64', 'amd64', 'i386',
+        'i486', 'i586', 'i686', 'x86')
+
+
+def _check_supported():
+    if not SUPPORTED:
+        raise RuntimeError("shared memory rings need x86 store ordering, "
+                "use IpcAdapter on %s" % platform.machine())
+
+
+class RingError(ValueError):
+    ''' the peer stored a head or a tail out of the bounds of a Ring
+    '''
+
+
+
+class Ring(object):
+    ''' Single producer, single consumer byte ring in a memory mapped
+        file shared by two processes.
+
+        head and tail count the bytes ever written and read, each is only
+        stored by its own side, on its own cache line, and the data is
+        stored before the head that publishes it, which x86 keeps in order.
+        reader_waiting and writer_waiting are set by a side about to sleep,
+        so the other one knows to wake it up. Data starts at HEADER.
+
+        The head or tail the peer stores is checked against our own before
+        use, RingError tells the peer broke the ring.
+    '''
+
+    HEADER = 256
+    _HEAD = 0
+    _TAIL = 64
+    _READER_WAITING = 128
+    _WRITER_WAITING = 192
+
+    def __init__(self, path, size, fd=None):
+        self.path = path
+        f = None
+        if fd is None:
+            f = open(path, 'r+b')
+            fd = f.fileno()
+        try:
+            st = os.fstat(fd)
+            self._identity = (st.st_dev, st.st_ino)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            if f is not None:
+                f.close()
+        self.capacity = size - self.HEADER
+        self._head = _U64.unpack_from(self._map, self._HEAD)[0]
+        self._tail = _U64.unpack_from(self._map, self._TAIL)[0]
+        if not 0 <= self._head - self._tail <= self.capacity:
+            self._map.close()
+            raise RingError("%s holds a broken ring" % path)
+
+
+    @classmethod
+    def create(cls, capacity, directory=DIRECTORY):
+        ''' a new ring in a file only the current user can open
+        '''
+        fd, path = tempfile.mkstemp(prefix=PREFIX, dir=directory)
+        try:
+            os.ftruncate(fd, cls.HEADER + capacity)
+        finally:
+            os.close(fd)
+        return cls(path, cls.HEADER + capacity)
+
+
+    @classmethod
+    def open(cls, path, uid=None):
+        ''' map the ring at path, which has to be a regular file rather than
+            a symbolic link, belonging to uid when given
+        '''
+        fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise ValueError("%s is not a regular file" % path)
+            if uid is not None and st.st_uid != uid:
+                raise ValueError("%s does not belong to the client" % path)
+            if st.st_size <= cls.HEADER:
+                raise ValueError("%s is too small for a ring" % path)
+            return cls(path, st.st_size, fd)
+        finally:
+            os.close(fd)
+
+
+    def unlink(self):
+        ''' remove the file of the ring, unless its name was given to
+            another file since
+        '''
+        try:
+            st = os.lstat(self.path)
+            if (st.st_dev, st.st_ino) == self._identity:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+
+    def close(self):
+        self._map.close()
+
+
+    def _get(self, offset):
+        return _U64.unpack_from(self._map, offset)[0]
+
+
+    def _set(self, offset, value):
+        _U64.pack_into(self._map, offset, value)
+
+
+    @property
+    def reader_waiting(self):
+        return self._get(self._READER_WAITING)
+
+
+    @reader_waiting.setter
+    def reader_waiting(self, value):
+        self._set(self._READER_WAITING, value)
+
+
+    @property
+    def writer_waiting(self):
+        return self._get(self._WRITER_WAITING)
+
+
+    @writer_waiting.setter
+    def writer_waiting(self, value):
+        self._set(self._WRITER_WAITING, value)
+
+
+    def space(self):
+        tail = self._get(self._TAIL)
+        if not self._head - self.capacity <= tail <= self._head:
+            raise RingError("tail %d out of the ring written to %d" %
+                    (tail, self._head))
+        return self.capacity - (self._head - tail)
+
+
+    def _peer_head(self):
+        head = self._get(self._HEAD)
+        if not self._tail <= head <= self._tail + self.capacity:
+            raise RingError("head %d out of the ring read to %d" %
+                    (head, self._tail))
+        return head
+
+
+    def write(self, data, offset=0):
+        ''' copy as much of data[offset:] as fits, returns the byte count
+        '''
+        n = min(len(data) - offset, self.space())
+        if n <= 0:
+            return 0
+        position = self._head % self.capacity
+        first = min(n, self.capacity - position)
+        m = self._map
+        m.seek(self.HEADER + position)
+        m.write(buffer(data, offset, first))
+        if n > first:
+            m.seek(self.HEADER)
+            m.write(buffer(data, offset + first, n - first))
+        self._head += n
+        self._set(self._HEAD, self._head)
+        return n
+
+
+    def available(self):
+        ''' bytes written and not read yet
+        '''
+        return self._peer_head() - self._tail
+
+
+    def readable(self):
+        ''' the offsets in map of the longest run of unread bytes that does
+            not wrap around
+        '''
+        available = self._peer_head() - self._tail
+        position = self._tail % self.capacity
+        start = self.HEADER + position
+        return start, start + min(available, self.capacity - position)
+
+
+    @property
+    def map(self):
+        return self._map
+
+
+    def consume(self, n):
+        self._tail += n
+        self._set(self._TAIL, self._tail)
+
+
+
+class ShmStream(object):
+    ''' Stands for an IOStream between two processes of the same host: the
+        bytes go through a pair of Rings, the Unix socket only carries one
+        byte wake-ups to a side waiting for data or for room.
+
+        Frames lying in one piece in the ring are parsed right out of the
+        shared memory, so a payload is copied once, into the string handed
+        to the handler. A frame wrapping around the end of the ring, or
+        not written completely yet, is gathered in a staging buffer first.
+
+        Writes are copied into the ring once per IOLoop turn, their
+        callbacks run once the ring took all of their data. Both sides
+        also check their rings every poll_interval seconds, guarding
+        against a wake-up lost between a store and a load seen out of order.
+        What the peer wrote before closing its socket is still read, as a
+        socket would.
+    '''
+
+    def __init__(self, socket, io_loop=None, max_buffer_size=104857600,
+            write_chunk_size=131072, poll_interval=0.05):
+        self.socket = socket
+        self.socket.setblocking(False)
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.max_buffer_size = max_buffer_size
+        self.write_chunk_size = write_chunk_size
+        self._poll_interval = poll_interval
+        self._rx = None
+        self._tx = None
+        self._setup = '' # control data received before attach
+        self._on_setup = None
+        self._frame_parser = None
+        self._read_paused = False
+        self._reading = False # inside _handle_read
+        self._staging = bytearray()
+        self._write_buffer = deque()
+        self._write_buffer_size = 0
+        self._write_offset = 0
+        self._write_scheduled = False
+        self._wakeup_scheduled = False
+        self._close_callback = None
+        self._poll_timeout = None
+        self._peer_closed = False # the rest of rx is read before closing
+        self.io_loop.add_handler(self.socket.fileno(), self._handle_events,
+                self.io_loop.READ | self.io_loop.ERROR)
+
+
+    def attach(self, rx, tx):
+        ''' start reading from ring rx and writing to ring tx
+        '''
+        self._rx = rx
+        self._tx = tx
+        self._schedule_poll()
+        self._handle_read()
+        self._handle_write()
+
+
+    def wait_setup(self, callback):
+        ''' call callback(line) with the first line received on the
+            socket, before attach
+        '''
+        self._on_setup = callback
+
+
+    def read_frames(self, parser):
+        self._check_closed()
+        self._frame_parser = parser
+        if self._rx is not None:
+            self._handle_read()
+
+
+    def pause_reading(self):
+        self._read_paused = True
+
+
+    def resume_reading(self):
+        if not self._read_paused:
+            return
+        self._read_paused = False
+        if self.socket and self._rx is not None and not self._reading:
+            self._handle_read()
+
+
+    def write(self, data, callback=None):
+        self._check_closed()
+        self._write_buffer.append((data, callback))
+        self._write_buffer_size += len(data)
+        if not self._write_scheduled:
+            self._write_scheduled = True
+            self.io_loop.add_callback(self._on_write_turn)
+
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+
+    def close(self):
+        if self.socket is None:
+            return
+        if not self._peer_closed:
+            self.io_loop.remove_handler(self.socket.fileno())
+        self.socket.close()
+        self.socket = None
+        if self._poll_timeout is not None:
+            self.io_loop.remove_timeout(self._poll_timeout)
+            self._poll_timeout = None
+        for ring in (self._rx, self._tx):
+            if ring is not None:
+                ring.unlink()
+                ring.close()
+        if self._close_callback:
+            self._run_callback(self._close_callback)
+
+
+    def reading(self):
+        return self._frame_parser is not None and not self._read_paused
+
+
+    def writing(self):
+        return bool(self._write_buffer)
+
+
+    def write_buffer_size(self):
+        return self._write_buffer_size
+
+
+    def closed(self):
+        return self.socket is None
+
+
+    def _check_closed(self):
+        if not self.socket:
+            raise IOError("Stream is closed")
+
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except:
+            self.close()
+            raise
+
+
+    def _handle_events(self, fd, events):
+        if not self.socket:
+            return
+        if events & self.io_loop.READ:
+            data = self._drain_socket()
+            if data is None:
+                self._on_peer_closed()
+                return
+            if self._rx is None and self._on_setup is not None:
+                self._setup += data
+                if '\n' in self._setup:
+                    line = self._setup.split('\n', 1)[0]
+                    callback, self._on_setup = self._on_setup, None
+                    self._run_callback(callback, line)
+        if events & self.io_loop.ERROR:
+            self.close()
+            return
+        if self._rx is not None:
+            self._handle_read()
+            self._handle_write()
+
+
+    def _drain_socket(self):
+        ''' read what the socket holds, None once the peer closed it
+        '''
+        chunks = []
+        while True:
+            try:
+                chunk = self.socket.recv(4096)
+            except socket.error, e:
+                if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                logging.warning("Read error on %d: %s", self.socket.fileno(),
+                        e)
+                return None
+            if not chunk:
+                return None
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+
+    def _on_peer_closed(self):
+        ''' the peer closed its end, possibly leaving data in rx as a
+            socket leaves data in its receive buffer
+        '''
+        if self._rx is None:
+            self.close()
+            return
+        self._peer_closed = True
+        self.io_loop.remove_handler(self.socket.fileno())
+        self._handle_read()
+
+
+    def _wake_peer(self):
+        if not self._wakeup_scheduled:
+            self._wakeup_scheduled = True
+            self.io_loop.add_callback(self._send_wakeup)
+
+
+    def _send_wakeup(self):
+        self._wakeup_scheduled = False
+        if not self.socket or self._peer_closed:
+            return
+        try:
+            self.socket.send('w')
+        except socket.error, e:
+            # a full socket holds enough wake-ups already
+            if e[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                self.close()
+
+
+    def _schedule_poll(self):
+        self._poll_timeout = self.io_loop.add_timeout(
+                time.time() + self._poll_interval, self._on_poll)
+
+
+    def _on_poll(self):
+        self._poll_timeout = None
+        if not self.socket:
+            return
+        self._handle_read()
+        self._handle_write()
+        if self.socket:
+            self._schedule_poll()
+
+
+    def _handle_read(self):
+        ''' parse the frames in rx until it is empty or reading pauses
+        '''
+        rx = self._rx
+        parser = self._frame_parser
+        if parser is None or self._reading:
+            return
+        self._reading = True
+        try:
+            consumed = self._read_frames(rx, parser)
+            left = self.socket and self._peer_closed and rx.available()
+        except RingError, e:
+            self._on_ring_error(e)
+            return
+        finally:
+            self._reading = False
+        if not self.socket:
+            return
+        if self._peer_closed:
+            if not left and not self._staging:
+                self.close()
+            return
+        if consumed and rx.writer_waiting:
+            rx.writer_waiting = 0
+            self._wake_peer()
+
+
+    def _read_frames(self, rx, parser):
+        ''' the loop of _handle_read, True if it consumed data
+        '''
+        consumed = False
+        while self.socket and not self._read_paused:
+            rx.reader_waiting = 0
+            start, end = rx.readable()
+            if self._staging:
+                staging = self._staging
+                n = self._parse(parser, staging, 0, len(staging))
+                del staging[:n]
+                if not staging or not self.socket or self._read_paused:
+                    continue
+                # a partial frame is left, complete it from the ring
+                if start == end:
+                    if self._sleep(rx):
+                        break
+                    continue
+                if len(staging) + end - start > self.max_buffer_size:
+                    logging.error("read buffer overflow, close down")
+                    self.close()
+                    return consumed
+                staging += buffer(rx.map, start, end - start)
+                rx.consume(end - start)
+                consumed = True
+                continue
+            if start == end:
+                if not self._sleep(rx):
+                    continue
+                break
+            n = self._parse(parser, rx.map, start, end)
+            if n < end - start and self.socket and not self._read_paused:
+                available = rx.available()
+                if available > end - start or available == rx.capacity:
+                    # the frame left continues past the end of the ring or
+                    # does not fit in it, gather it apart
+                    self._staging += buffer(rx.map, start + n,
+                            end - start - n)
+                    n = end - start
+                else:
+                    # the rest of the frame is on its way
+                    if n:
+                        rx.consume(n)
+                        consumed = True
+                    rx.reader_waiting = 1
+                    if rx.available() == available - n:
+                        break
+                    continue
+            if n:
+                rx.consume(n)
+                consumed = True
+        return consumed
+
+
+    def _parse(self, parser, buf, start, end):
+        try:
+            return parser(buf, start, end)
+        except:
+            self.close()
+            raise
+
+
+    def _sleep(self, rx):
+        ''' tell the writer we wait, True unless data came meanwhile
+        '''
+        rx.reader_waiting = 1
+        start, end = rx.readable()
+        if start != end:
+            rx.reader_waiting = 0
+            return False
+        return True
+
+
+    def _on_write_turn(self):
+        self._write_scheduled = False
+        if self.socket and self._tx is not None:
+            self._handle_write()
+
+
+    def _on_ring_error(self, e):
+        if not self.socket:
+            return
+        logging.warning("closing shared memory stream %d: %s",
+                self.socket.fileno(), e)
+        self.close()
+
+
+    def _handle_write(self):
+        try:
+            self._write_ring()
+        except RingError, e:
+            self._on_ring_error(e)
+
+
+    def _write_ring(self):
+        ''' copy the writes queued so far into tx, the callbacks of the
+            completed ones run afterwards so that their own writes wait for
+            the next turn
+        '''
+        tx = self._tx
+        callbacks = []
+        written = 0
+        pending = len(self._write_buffer)
+        while pending:
+            data, callback = self._write_buffer[0]
+            remaining = len(data) - self._write_offset
+            if remaining > tx.space() and remaining <= tx.capacity / 2:
+                # pieces go in whole, so that the reader rarely sees a
+                # partial frame, unless they are large
+                tx.writer_waiting = 1
+                if remaining > tx.space():
+                    break
+                tx.writer_waiting = 0
+            n = tx.write(data, self._write_offset)
+            written += n
+            self._write_buffer_size -= n
+            self._write_offset += n
+            if self._write_offset < len(data):
+                tx.writer_waiting = 1
+                if not tx.space():
+                    break
+                tx.writer_waiting = 0
+                continue
+            self._write_buffer.popleft()
+            self._write_offset = 0
+            pending -= 1
+            if callback:
+                callbacks.append(callback)
+        if written and tx.reader_waiting:
+            self._wake_peer()
+        for callback in callbacks:
+            if not self.socket:
+                return
+            self._run_callback(callback)
+
+
+
+def open_stream(address, ioloop, ring_size=4 << 20, directory=DIRECTORY):
+    ''' connect to the ShmAdapter at address, returns the ShmStream
+    '''
+    _check_supported()
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+    s.connect(address)
+    tx = Ring.create(ring_size, directory)
+    rx = Ring.create(ring_size, directory)
+    try:
+        s.sendall('%s\0%s\n' % (tx.path, rx.path))
+    except:
+        tx.unlink()
+        rx.unlink()
+        raise
+    stream = ShmStream(s, ioloop)
+    stream.attach(rx, tx)
+    return stream
+
+
+
+class ShmClient(jetstream.SocketClient):
+    ''' Client of a ShmAdapter on the same host, it works as an IpcClient
+        but messages go through shared memory rings of ring_size bytes
+    '''
+
+    def __init__(self, ioloop, batch_size=None, linger=None,
+            ring_size=4 << 20, directory=DIRECTORY):
+        _check_supported()
+        jetstream.SocketClient.__init__(self, ioloop, batch_size, linger)
+        self._ring_size = ring_size
+        self._directory = directory
+
+
+    def connect(self, address):
+        self._adress = address
+        self._start(open_stream(address, self._ioloop, self._ring_size,
+            self._directory))
+
+
+
+class ShmAdapter(jetstream.IpcAdapter):
+    ''' Unix socket adapter for ShmClients. A client creates its two rings
+        in directory and sends their paths, they are only mapped when they
+        are regular files of directory, opened without following symbolic
+        links, belonging to the user at the other end of the socket.
+    '''
+
+    def __init__(self, exchange, ioloop=None, limits=None,
+            write_budget=65536, ack_timeout=None, directory=DIRECTORY,
+            scheduling=None):
+        _check_supported()
+        jetstream.IpcAdapter.__init__(self, exchange, ioloop, limits,
+                write_budget, ack_timeout, scheduling)
+        self._directory = os.path.realpath(directory)
+
+
+    def _stream(self, s):
+        stream = ShmStream(s, self._ioloop)
+        stream.wait_setup(lambda line: self._attach(s, stream, line))
+        return stream
+
+
+    def _attach(self, s, stream, line):
+        rings = []
+        try:
+            pid, uid, gid = _PEERCRED.unpack(s.getsockopt(socket.SOL_SOCKET,
+                SO_PEERCRED, _PEERCRED.size))
+            paths = line.split('\0')
+            if len(paths) != 2:
+                raise ValueError("bad setup line")
+            for path in paths:
+                # only the name is taken from the client, the ring is
+                # opened in our own directory
+                directory, name = os.path.split(path)
+                if os.path.realpath(directory) != self._directory or \
+                        not name.startswith(PREFIX):
+                    raise ValueError("%s is not a ring" % path)
+                rings.append(Ring.open(os.path.join(self._directory, name),
+                    uid))
+        except (EnvironmentError, ValueError), e:
+            logging.warning("refusing shared memory client: %s", e)
+            for ring in rings:
+                ring.close()
+            stream.close()
+            return
+        rx, tx = rings
+        rx.unlink()
+        tx.unlink()
+        stream.attach(rx, tx)
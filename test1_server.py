@@ -1,4 +1,5 @@
 import jetstream
+import sys
 import time
 import re
 import tornado
@@ -43,12 +44,25 @@ class Client(jetstream.Client):
                 print self._name, "throughtput ", n*1.0/t/1e3,'Kmessages/s' ,s*1.0/t/1024./1024.,'MB/S'
 
 
+class QueuedClient(jetstream.QueuedClient, Client):
+    ''' handles its messages on the ioloop after the dispatch, so that the
+        tcp producers are not held up by the printing
+    '''
+    def __init__(self, exchange, name, ioloop):
+        jetstream.QueuedClient.__init__(self, ioloop)
+        Client.__init__(self, exchange, name)
+
+
 def main():
     ioloop = tornado.ioloop.IOLoop()
     exchange = jetstream.Exchange()
 
-    client_a1 = Client(exchange, "A1")
-    client_a2 = Client(exchange, "A2")
+    if '--queued' in sys.argv:
+        client_a1 = QueuedClient(exchange, "A1", ioloop)
+        client_a2 = QueuedClient(exchange, "A2", ioloop)
+    else:
+        client_a1 = Client(exchange, "A1")
+        client_a2 = Client(exchange, "A2")
 
 
     tcp_adapter = jetstream.TcpAdapter(exchange, ioloop)
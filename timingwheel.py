@@ -0,0 +1,136 @@
+import time, math, logging
+import tornado.ioloop
+
+
+class Timer(object):
+    ''' a callback scheduled on a TimingWheel, see TimingWheel.remove
+    '''
+
+    __slots__ = ('expires', 'callback', 'args', 'slot')
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires # in ticks
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+
+
+class TimingWheel(object):
+    ''' Hierarchical timing wheel: many timers driven by a single IOLoop
+        timeout per tick, with O(1) add and remove.
+
+        Level 0 has one slot per tick, each level above has slots spanning
+        a whole turn of the level below and is cascaded down one slot at a
+        time as the lower level wraps around. Timers fire on the first tick
+        at or after their deadline, so they are late by up to one tick.
+        The IOLoop timeout is only kept while timers are pending.
+    '''
+
+    def __init__(self, ioloop=None, tick=0.01, bits=6, levels=4):
+        self._ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self._tick = tick
+        self._bits = bits
+        self._mask = (1 << bits) - 1
+        self._wheels = [[set() for i in xrange(1 << bits)]
+                for level in xrange(levels)]
+        self._start = time.time()
+        self._now = 0 # ticks elapsed since _start
+        self._count = 0
+        self._timeout = None
+
+
+    def __len__(self):
+        return self._count
+
+
+    def add(self, delay, callback, *args):
+        ''' call callback(*args) in delay seconds, returns the Timer
+        '''
+        elapsed = (time.time() - self._start) / self._tick
+        if self._count == 0:
+            # the wheel did not turn while idle, catch up with the clock
+            self._now = int(elapsed)
+        expires = max(self._now + 1,
+                int(math.ceil(elapsed + delay / self._tick)))
+        timer = Timer(expires, callback, args)
+        self._insert(timer)
+        self._count += 1
+        if self._timeout is None:
+            self._schedule()
+        return timer
+
+
+    def remove(self, timer):
+        ''' cancel timer, if it did not fire yet
+        '''
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._count -= 1
+
+
+    def _insert(self, timer):
+        delta = timer.expires - self._now
+        levels = len(self._wheels)
+        for level in xrange(levels):
+            if delta < 1 << (self._bits * (level + 1)) or level == levels - 1:
+                break
+        # beyond the top level, wait in its farthest slot and get
+        # inserted again when it is cascaded
+        expires = min(timer.expires,
+                self._now + (1 << (self._bits * levels)) - 1)
+        slot = self._wheels[level][(expires >> (self._bits * level))
+                & self._mask]
+        slot.add(timer)
+        timer.slot = slot
+
+
+    def _schedule(self):
+        self._timeout = self._ioloop.add_timeout(
+                self._start + (self._now + 1) * self._tick, self._on_tick)
+
+
+    def _on_tick(self):
+        self._timeout = None
+        target = int((time.time() - self._start) / self._tick)
+        try:
+            while self._now < target and self._count:
+                self._now += 1
+                self._turn()
+        finally:
+            if self._count and self._timeout is None:
+                self._schedule()
+
+
+    def _turn(self):
+        now = self._now
+        for level in xrange(1, len(self._wheels)):
+            if now & ((1 << (self._bits * level)) - 1):
+                break
+            slot = self._wheels[level][(now >> (self._bits * level))
+                    & self._mask]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+
+        slot = self._wheels[0][now & self._mask]
+        if not slot:
+            return
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            if timer.slot is not slot:
+                # removed by a callback before
+                continue
+            if timer.expires > now:
+                self._insert(timer)
+                continue
+            timer.slot = None
+            self._count -= 1
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.error("Exception in timer callback %r",
+                        timer.callback, exc_info=True)
@@ -0,0 +1,388 @@
+import re, sre_parse, sre_constants, bisect
+
+
+class Topic(object):
+    ''' An MQTT style topic filter, to subscribe with instead of a qid.
+        Qids are split in levels on '/', a '+' level of the filter stands
+        for any single level and a last '#' level for any number of levels,
+        none included: '/metrics/+/cpu' matches '/metrics/host42/cpu' and
+        '/metrics/#' matches '/metrics' and every qid under it.
+
+        The Exchange indexes topic subscriptions in a TopicTrie, so that
+        matching a qid costs O(levels) however many of them there are.
+    '''
+
+    def __init__(self, filter):
+        levels = filter.split('/')
+        for i, level in enumerate(levels):
+            if level == '#':
+                if i != len(levels) - 1:
+                    raise ValueError("'#' is not the last level of %r" %
+                            filter)
+            elif level != '+' and ('+' in level or '#' in level):
+                raise ValueError("a wildcard is not a whole level of %r" %
+                        filter)
+        self.filter = filter
+        self.levels = tuple(levels)
+
+
+    def match(self, qid):
+        levels = qid.split('/')
+        for i, level in enumerate(self.levels):
+            if level == '#':
+                return True
+            if i >= len(levels) or (level != '+' and level != levels[i]):
+                return False
+        return len(levels) == len(self.levels)
+
+
+    def regex(self):
+        ''' the equivalent regular expression, for a broker which does not
+            know about topics
+        '''
+        levels = self.levels
+        tail = ''
+        if levels[-1] == '#':
+            levels = levels[:-1]
+            tail = '(/.*)?' if levels else '.*'
+        pattern = '/'.join('[^/]*' if level == '+' else re.escape(level)
+                for level in levels)
+        return re.compile(pattern + tail + r'\Z', re.DOTALL)
+
+
+    def __eq__(self, other):
+        return isinstance(other, Topic) and other.filter == self.filter
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __hash__(self):
+        return hash(self.filter)
+
+
+    def __repr__(self):
+        return 'Topic(%r)' % self.filter
+
+
+
+class _Node(object):
+    __slots__ = ('children', 'clients')
+
+    def __init__(self):
+        self.children = {} # level -> _Node
+        self.clients = set() # subscribed to the filter ending here
+
+
+
+class TopicTrie(object):
+    ''' Topic filters and their subscribers, in a trie of levels. A qid is
+        matched by walking its levels down the trie, following the child of
+        the same level and the '+' one, and taking the subscribers of the
+        '#' children on the way.
+    '''
+
+    def __init__(self):
+        self._root = _Node()
+        self._filters = 0
+
+
+    def __len__(self):
+        return self._filters
+
+
+    def add(self, topic, client):
+        node = self._root
+        for level in topic.levels:
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        if not node.clients:
+            self._filters += 1
+        node.clients.add(client)
+
+
+    def remove(self, topic, client):
+        ''' forget that client subscribed to topic, and the nodes left
+            without subscribers or children
+        '''
+        path = [self._root]
+        for level in topic.levels:
+            path.append(path[-1].children[level])
+        node = path[-1]
+        node.clients.remove(client)
+        if node.clients:
+            return
+        self._filters -= 1
+        for i in xrange(len(topic.levels), 0, -1):
+            node = path[i]
+            if node.clients or node.children:
+                break
+            del path[i - 1].children[topic.levels[i - 1]]
+
+
+    def match(self, qid):
+        ''' the set of the clients subscribed to a topic matching qid
+        '''
+        clients = set()
+        nodes = [self._root]
+        for level in qid.split('/'):
+            matched = []
+            for node in nodes:
+                children = node.children
+                child = children.get('#')
+                if child is not None:
+                    clients.update(child.clients)
+                child = children.get(level)
+                if child is not None:
+                    matched.append(child)
+                child = children.get('+')
+                if child is not None:
+                    matched.append(child)
+            if not matched:
+                return clients
+            nodes = matched
+        for node in nodes:
+            clients.update(node.clients)
+            # 'a/#' matches 'a' too
+            child = node.children.get('#')
+            if child is not None:
+                clients.update(child.clients)
+        return clients
+
+
+
+# nodes with more children than this keep their levels sorted, for prefixed
+_SORTED_CHILDREN = 64
+
+
+class _QidNode(object):
+    __slots__ = ('children', 'qid', 'levels')
+
+    def __init__(self):
+        self.children = {} # level -> _QidNode
+        self.qid = None # the qid ending here, if any
+        self.levels = None # sorted children levels, once prefixed needs it
+
+
+
+class QidTrie(object):
+    ''' Qids in a trie of levels, the other way round from TopicTrie: finds
+        the qids a Topic, or a literal prefix, matches by walking down the
+        levels it names rather than going through every qid.
+    '''
+
+    def __init__(self):
+        self._root = _QidNode()
+        self._qids = 0
+
+
+    def __len__(self):
+        return self._qids
+
+
+    def add(self, qid):
+        node = self._root
+        for level in qid.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _QidNode()
+                if node.levels is not None:
+                    bisect.insort(node.levels, level)
+            node = child
+        if node.qid is None:
+            self._qids += 1
+        node.qid = qid
+
+
+    def remove(self, qid):
+        ''' forget qid, and the nodes left without qid or children
+        '''
+        levels = qid.split('/')
+        path = [self._root]
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].qid = None
+        self._qids -= 1
+        for i in xrange(len(levels), 0, -1):
+            node = path[i]
+            if node.qid is not None or node.children:
+                break
+            parent = path[i - 1]
+            del parent.children[levels[i - 1]]
+            if parent.levels is not None:
+                del parent.levels[bisect.bisect_left(parent.levels,
+                    levels[i - 1])]
+
+
+    def match(self, topic):
+        ''' the list of the qids topic matches
+        '''
+        nodes = [self._root]
+        for level in topic.levels:
+            if level == '#':
+                # 'a/#' matches 'a' too
+                return _qids(nodes)
+            matched = []
+            for node in nodes:
+                if level == '+':
+                    matched.extend(node.children.itervalues())
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        matched.append(child)
+            if not matched:
+                return []
+            nodes = matched
+        return [node.qid for node in nodes if node.qid is not None]
+
+
+    def prefixed(self, prefix):
+        ''' the list of the qids starting with prefix. The levels starting
+            with a partial last level are found by bisecting the sorted
+            levels of a node with many children, kept from then on.
+        '''
+        levels = prefix.split('/')
+        node = self._root
+        for level in levels[:-1]:
+            node = node.children.get(level)
+            if node is None:
+                return []
+        last = levels[-1]
+        children = node.children
+        if not last:
+            return _qids(children.values())
+        if len(children) <= _SORTED_CHILDREN:
+            return _qids([child for level, child in children.iteritems()
+                    if level.startswith(last)])
+        if node.levels is None:
+            node.levels = sorted(children)
+        nodes = []
+        for i in xrange(bisect.bisect_left(node.levels, last),
+                len(node.levels)):
+            level = node.levels[i]
+            if not level.startswith(last):
+                break
+            nodes.append(children[level])
+        return _qids(nodes)
+
+
+def _qids(nodes):
+    ''' every qid in the subtrees of nodes
+    '''
+    qids = []
+    while nodes:
+        node = nodes.pop()
+        if node.qid is not None:
+            qids.append(node.qid)
+        nodes.extend(node.children.itervalues())
+    return qids
+
+
+
+class PatternIndex(object):
+    ''' Regular expression subscriptions and their subscribers, indexed by
+        the literal prefix of the qids each one matches. A qid is matched
+        by looking its own prefixes of the indexed lengths up, one dict
+        lookup per distinct length, and only trying the patterns found
+        there, so the cost grows with the patterns sharing the prefix of
+        the qid rather than with all of them. Patterns without a literal
+        prefix are tried on every qid.
+    '''
+
+    def __init__(self):
+        self._prefixes = {} # prefix -> {pattern: client set}
+        self._prefix_of = {} # pattern -> prefix
+        self._lengths = [] # lengths of the prefixes, sorted
+        self._counts = {} # length -> prefixes of that length
+
+
+    def __len__(self):
+        return len(self._prefix_of)
+
+
+    def add(self, pattern, client):
+        prefix = self._prefix_of.get(pattern)
+        if prefix is None:
+            prefix = self._prefix_of[pattern] = literal_prefix(pattern)
+        patterns = self._prefixes.get(prefix)
+        if patterns is None:
+            patterns = self._prefixes[prefix] = {}
+            n = self._counts.get(len(prefix), 0)
+            if not n:
+                bisect.insort(self._lengths, len(prefix))
+            self._counts[len(prefix)] = n + 1
+        clients = patterns.get(pattern)
+        if clients is None:
+            clients = patterns[pattern] = set()
+        clients.add(client)
+
+
+    def remove(self, pattern, client):
+        ''' forget that client subscribed to pattern
+        '''
+        prefix = self._prefix_of[pattern]
+        patterns = self._prefixes[prefix]
+        clients = patterns[pattern]
+        clients.remove(client)
+        if clients:
+            return
+        del patterns[pattern]
+        del self._prefix_of[pattern]
+        if patterns:
+            return
+        del self._prefixes[prefix]
+        self._counts[len(prefix)] -= 1
+        if not self._counts[len(prefix)]:
+            del self._counts[len(prefix)]
+            self._lengths.remove(len(prefix))
+
+
+    def match(self, qid):
+        ''' the set of the clients subscribed to a pattern matching qid
+        '''
+        clients = set()
+        prefixes = self._prefixes
+        n = len(qid)
+        for length in self._lengths:
+            if length > n:
+                break
+            patterns = prefixes.get(qid[:length])
+            if patterns:
+                for pattern, subscribers in patterns.iteritems():
+                    if pattern.match(qid):
+                        clients.update(subscribers)
+        return clients
+
+
+
+def literal_prefix(pattern):
+    ''' the literal prefix of every qid pattern, a Topic or a regular
+        expression, matches from its start, '' when it cannot tell
+    '''
+    if isinstance(pattern, Topic):
+        levels = pattern.levels
+        for i, level in enumerate(levels):
+            if level == '+':
+                return '/'.join(levels[:i] + ('',))
+            if level == '#':
+                # 'a/#' matches 'a' too
+                return '/'.join(levels[:i])
+        return pattern.filter
+    if not hasattr(pattern, 'pattern') or not hasattr(pattern, 'flags') or \
+            pattern.flags & re.IGNORECASE:
+        return ''
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (re.error, TypeError):
+        return ''
+    if parsed.pattern.flags & re.IGNORECASE:
+        return ''
+    prefix = []
+    for op, av in parsed:
+        if op != sre_constants.LITERAL or av > 0xFF:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)